@@ -1,12 +1,72 @@
+import json
 import re
+from datetime import datetime
+from typing import Optional
 
-from fastapi import FastAPI, Header, HTTPException, status
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Response, status
+from fastapi.responses import JSONResponse, StreamingResponse
 
-from app_builder import event_queue, lifespan
+from app_builder import READINESS_TIMEOUT, build_lifespan, event_queue
+from models.access import AccessBatchRequest
 from models.event import Event
+from models.rules import PlatformFeature
 from services.event_registry import EventTypeNotRegistered
+from services.export import ARROW_STREAM_MEDIA_TYPE, ExportUnavailable
+from services.feature_registry import PlatformFeaturesRegistry
+from services.freshness import FreshnessTracker
+from services.grant_table import GrantTableError
+from services.ingest import InvalidEvent
+from services.memory_diagnostics import TracingNotStartedError
+from services.replication import ReplicationLagError
+from services.user_feature import UserFeatureService
 
-app = FastAPI(lifespan=lifespan)
+
+# how long a /can<feature> check waits for fresh_as_of by default, and at most
+DEFAULT_FRESHNESS_WAIT_MS = 100
+MAX_FRESHNESS_WAIT_MS = 5000
+
+
+def on_state_loaded(app: FastAPI):
+    register_feature_routes(
+        app, app.state.feature_registry, app.state.user_feature_service
+    )
+
+
+app = FastAPI(lifespan=build_lifespan(on_state_loaded=on_state_loaded))
+
+
+async def require_ready():
+    if not await app.state.readiness.wait(READINESS_TIMEOUT):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Service is starting up",
+            headers={"Retry-After": "1"},
+        )
+
+
+@app.exception_handler(GrantTableError)
+@app.exception_handler(ReplicationLagError)
+async def grants_unavailable_handler(request, exc: Exception):
+    return JSONResponse(
+        {"detail": str(exc)},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": "1"},
+    )
+
+
+async def require_writer():
+    if app.state.read_only:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="This instance only serves access checks",
+        )
+    # events queued before loading finished are processed once it does, after
+    # a failure nothing ever would
+    if app.state.readiness.failed:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Failed to load state",
+        )
 
 
 @app.get("/")
@@ -14,33 +74,19 @@ async def read_root():
     return {"Hello": "World"}
 
 
-@app.post("/event")
+@app.post("/event", dependencies=[Depends(require_writer)])
 async def publish_event(event: Event):
     try:
-        event_properties_schema = await app.state.schema_registry.get_schema_by_name(
-            event.name
-        )
-    except EventTypeNotRegistered as e:
+        duplicate = await app.state.event_ingestor.ingest(event)
+    except (EventTypeNotRegistered, InvalidEvent) as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
 
-    if not isinstance(event.event_properties, dict):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Invalid event format for event type {event.name}",
-        )
-
-    parsed_event = Event(
-        uuid=event.uuid,
-        name=event.name,
-        timestamp=event.timestamp,
-        event_properties=event_properties_schema(**event.event_properties),
-    )
-
-    await event_queue.put(parsed_event)
+    if duplicate:
+        return {"event_id": event.uuid, "duplicate": True}
     return {"event_id": event.uuid}
 
 
@@ -60,20 +106,430 @@ async def get_queue_size():
         )
 
 
+@app.get("/queue-lanes")
+async def get_queue_lanes():
+    """
+    Endpoint to return depth, queue wait percentiles and waits over target
+    per event lane. Not gated on readiness: the queue takes events from the
+    start, like /queue-size.
+    """
+    return event_queue.lane_stats()
+
+
+@app.get(
+    "/consumer-pool", dependencies=[Depends(require_ready), Depends(require_writer)]
+)
+async def get_consumer_pool():
+    """
+    Endpoint to return the consumer count, the load it was sized for and the
+    recent scaling decisions.
+    """
+    return app.state.consumer_pool.stats()
+
+
+@app.get("/freshness", dependencies=[Depends(require_writer)])
+async def get_freshness():
+    """
+    Endpoint to return the processed event time watermark and the lag of
+    events per hop, from their timestamp until their grants are visible.
+    """
+    return app.state.freshness.stats()
+
+
+@app.get("/ready")
+async def get_readiness():
+    """
+    Readiness probe, 200 once access checks can be answered.
+    """
+    if not app.state.readiness.is_ready:
+        return JSONResponse(
+            {"ready": False}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+    return {"ready": True}
+
+
+@app.get("/startup-profile")
+async def get_startup_profile():
+    """
+    Endpoint to return the time spent in each startup phase.
+    """
+    return app.state.startup_profiler.report()
+
+
+@app.get("/dedupe-stats")
+async def get_dedupe_stats():
+    """
+    Endpoint to return the size and hit counts of the ingest dedupe store.
+    Not gated on readiness: the store is built before events are accepted.
+    """
+    return app.state.event_deduplicator.stats()
+
+
+@app.get("/ingest-stats")
+async def get_ingest_stats():
+    """
+    Endpoint to return the counters of the msgpack ingest listener.
+    """
+    if app.state.ingest_server is None:
+        return {"enabled": False}
+    return {"enabled": True, **app.state.ingest_server.stats()}
+
+
+@app.get("/notification-stats", dependencies=[Depends(require_ready)])
+async def get_notification_stats():
+    """
+    Endpoint to return the http notification delivery counters.
+    """
+    if app.state.delivery_engine is None:
+        return {"enabled": False}
+    return {"enabled": True, **app.state.delivery_engine.stats()}
+
+
+@app.get("/rule-pruning", dependencies=[Depends(require_ready)])
+async def get_rule_pruning():
+    """
+    Endpoint to return how many rule evaluations monotonicity pruning saved.
+    """
+    return app.state.rules_store.pruning_stats()
+
+
+@app.get("/rule-ordering", dependencies=[Depends(require_ready)])
+async def get_rule_ordering():
+    """
+    Endpoint to return rule cost/failure statistics and each feature's rule order.
+    """
+    return app.state.rules_store.ordering_stats()
+
+
+@app.get("/shadow-rules", dependencies=[Depends(require_ready)])
+async def get_shadow_rules():
+    """
+    Endpoint to return would-grant/would-revoke divergence of shadow rules.
+    """
+    if app.state.shadow_evaluator is None:
+        return {"rules": {}}
+    return app.state.shadow_evaluator.stats()
+
+
+@app.get("/circuit-breakers", dependencies=[Depends(require_ready)])
+async def get_circuit_breakers():
+    """
+    Endpoint to return the circuit state of every feature segment.
+    """
+    return app.state.user_feature_service.circuit_breaker_stats()
+
+
+@app.get("/aggregate-tiers", dependencies=[Depends(require_ready)])
+async def get_aggregate_tiers():
+    """
+    Endpoint to return hot/cold user counts and cold read latency per aggregate.
+    """
+    return app.state.aggregate_store.tier_stats()
+
+
+@app.get("/debug/memory", dependencies=[Depends(require_ready)])
+async def get_memory_usage():
+    """
+    Endpoint to return estimated memory use per structure.
+    """
+    return app.state.memory_diagnostics.report()
+
+
+@app.post("/debug/memory/tracemalloc")
+async def start_memory_tracing(frames: int = Query(1, ge=1, le=50)):
+    # tracing doesn't depend on loaded state, and can start before loading to
+    # see what it allocates
+    app.state.memory_diagnostics.start_tracing(frames)
+    return {"tracing": True}
+
+
+@app.delete("/debug/memory/tracemalloc")
+async def stop_memory_tracing():
+    app.state.memory_diagnostics.stop_tracing()
+    return {"tracing": False}
+
+
+@app.get("/debug/memory/tracemalloc")
+async def get_memory_diff(limit: int = Query(20, ge=1, le=500)):
+    """
+    Endpoint to return the allocation sites that grew most since the last call.
+    """
+    try:
+        return app.state.memory_diagnostics.snapshot_diff(limit)
+    except TracingNotStartedError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+
+@app.get("/grant-table", dependencies=[Depends(require_ready)])
+async def get_grant_table():
+    """
+    Endpoint to return the size of the shared grant table and reader retries.
+    """
+    if app.state.grant_table is None:
+        return {"enabled": False}
+    return {"enabled": True, **app.state.grant_table.stats()}
+
+
+@app.get("/replication", dependencies=[Depends(require_ready)])
+async def get_replication():
+    """
+    Endpoint to return connected replicas on a primary, lag on a replica.
+    """
+    if app.state.replication is None:
+        return {"enabled": False}
+    return {"enabled": True, **app.state.replication.stats()}
+
+
+@app.get("/lock-stats", dependencies=[Depends(require_ready), Depends(require_writer)])
+async def get_lock_stats():
+    """
+    Endpoint to return acquisition and contention counts per lock stripe.
+    """
+    return {"user_feature_service": app.state.user_feature_service.lock_stats()}
+
+
+@app.post("/access/batch", dependencies=[Depends(require_ready)])
+async def can_access_features_batch(request: AccessBatchRequest):
+    feature_registry = app.state.feature_registry
+    if request.features is None:
+        features = feature_registry.list_features()
+    else:
+        try:
+            features = await feature_registry.get_features_by_names(request.features)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+
+    results = await app.state.user_feature_service.has_grants(
+        request.user_ids, features
+    )
+    return {"results": results}
+
+
+@app.get("/access/{user_id}", dependencies=[Depends(require_ready)])
+async def can_access_all_features(user_id: str):
+    features = app.state.feature_registry.list_features()
+    results = await app.state.user_feature_service.has_grants([user_id], features)
+    return {"user_id": user_id, "features": results[user_id]}
+
+
+@app.get(
+    "/grants/changes", dependencies=[Depends(require_ready), Depends(require_writer)]
+)
+async def get_grant_changes(since: str = "0", timeout: float = Query(30, ge=0, le=60)):
+    """
+    Long-poll for grant transitions after the `cursor` of an earlier response.
+    Returns as soon as there are changes or after `timeout` seconds with an
+    empty list. Cursors from before a restart come back truncated.
+    """
+    change_feed = app.state.user_feature_service.change_feed
+    seq, reset = change_feed.parse_cursor(since)
+    if reset:
+        changes, _ = change_feed.since(seq)
+        truncated = True
+    else:
+        changes, truncated = await change_feed.wait_since(seq, timeout=timeout)
+    last_seq = changes[-1]["seq"] if changes else seq
+    return {
+        "changes": changes,
+        "last_seq": last_seq,
+        "cursor": change_feed.cursor(last_seq),
+        "truncated": truncated,
+    }
+
+
+@app.get(
+    "/grants/changes/stream",
+    dependencies=[Depends(require_ready), Depends(require_writer)],
+)
+async def stream_grant_changes(
+    since: Optional[str] = None, last_event_id: Optional[str] = Header(None)
+):
+    """
+    Server-sent events stream of grant transitions. Reconnecting clients
+    resume from the Last-Event-ID header, new clients start at the current
+    end of the feed unless a `since` cursor is given.
+    """
+    change_feed = app.state.user_feature_service.change_feed
+    cursor = last_event_id if last_event_id is not None else since
+    if cursor is not None:
+        seq, reset = change_feed.parse_cursor(cursor)
+    else:
+        seq, reset = change_feed.last_seq, False
+
+    async def events():
+        nonlocal seq, reset
+        while True:
+            changes, truncated = await change_feed.wait_since(seq, timeout=15)
+            if truncated or reset:
+                # the client missed changes or saw ids of another boot, it has
+                # to drop its cache
+                reset = False
+                yield "event: reset\ndata: {}\n\n"
+            if not changes:
+                yield ": keepalive\n\n"
+            for change in changes:
+                seq = change["seq"]
+                yield (
+                    f"id: {change_feed.cursor(seq)}\nevent: grant\n"
+                    f"data: {json.dumps(change)}\n\n"
+                )
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get(
+    "/export/aggregates",
+    dependencies=[Depends(require_ready), Depends(require_writer)],
+)
+async def export_aggregates(aggregates: Optional[str] = None):
+    """
+    Streams every user's aggregate values as an Arrow IPC stream, all
+    aggregates or the comma separated ones given.
+    """
+    exporter = app.state.exporter
+    names = aggregates.split(",") if aggregates else None
+    try:
+        exporter.aggregates(names)
+        schema = exporter.aggregate_schema()
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except ExportUnavailable as e:
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail=str(e))
+    return StreamingResponse(
+        exporter.arrow_stream(schema, exporter.aggregate_batches(names)),
+        media_type=ARROW_STREAM_MEDIA_TYPE,
+    )
+
+
+@app.get(
+    "/export/grants", dependencies=[Depends(require_ready), Depends(require_writer)]
+)
+async def export_grants(revoked_only: bool = False):
+    """
+    Streams the grants of every user that ever had a grant transition as an
+    Arrow IPC stream, one boolean column per feature.
+    """
+    exporter = app.state.exporter
+    try:
+        schema = exporter.grant_schema()
+    except ExportUnavailable as e:
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail=str(e))
+    return StreamingResponse(
+        exporter.arrow_stream(schema, exporter.grant_batches(revoked_only)),
+        media_type=ARROW_STREAM_MEDIA_TYPE,
+    )
+
+
+def build_feature_access_handler(
+    feature: PlatformFeature, user_feature_service: UserFeatureService
+):
+    async def can_access_feature(
+        x_user_id: str = Header(...),
+        if_none_match: Optional[str] = Header(None),
+        fresh_as_of: Optional[datetime] = None,
+        max_wait_ms: int = Query(
+            DEFAULT_FRESHNESS_WAIT_MS, ge=0, le=MAX_FRESHNESS_WAIT_MS
+        ),
+    ):
+        headers = {"Vary": "X-User-Id"}
+        if fresh_as_of is not None:
+            # wait until every event up to fresh_as_of has been applied, or
+            # answer with what is there after max_wait_ms
+            headers["X-Fresh"] = await wait_until_fresh(
+                app.state.freshness, fresh_as_of, max_wait_ms
+            )
+        has_grant, etag = await user_feature_service.has_grant_with_etag(
+            x_user_id, feature
+        )
+        headers["ETag"] = etag
+        if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return JSONResponse(
+            {"user_id": x_user_id, "feature": feature.name, "has_grant": has_grant},
+            headers=headers,
+        )
+
+    return can_access_feature
+
+
+async def wait_until_fresh(
+    freshness: Optional[FreshnessTracker], fresh_as_of: datetime, max_wait_ms: int
+) -> str:
+    if freshness is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="fresh_as_of needs an instance that processes events",
+        )
+    fresh = await freshness.wait_for(fresh_as_of.timestamp(), max_wait_ms / 1e3)
+    return "true" if fresh else "false"
+
+
+def register_feature_routes(
+    app: FastAPI,
+    feature_registry: PlatformFeaturesRegistry,
+    user_feature_service: UserFeatureService,
+):
+    """
+    Adds an explicit GET /can<feature> route per registered feature with the
+    feature bound into its handler, ahead of the unknown feature fallback.
+    """
+    paths = {f"/can{feature.name}" for feature in feature_registry.list_features()}
+    # drop routes of a previous startup, they are bound to stale objects
+    app.router.routes[:] = [
+        route
+        for route in app.router.routes
+        if getattr(route, "path", None) not in paths
+    ]
+    for feature in feature_registry.list_features():
+        app.add_api_route(
+            f"/can{feature.name}",
+            build_feature_access_handler(feature, user_feature_service),
+            methods=["GET"],
+            name=f"can_access_{feature.name}",
+        )
+    fallback = next(
+        route
+        for route in app.router.routes
+        if getattr(route, "endpoint", None) is unknown_feature
+    )
+    app.router.routes.remove(fallback)
+    app.router.routes.append(fallback)
+    app.openapi_schema = None
+
+
 @app.get("/{feature_flag}")
-async def can_access_feature(feature_flag: str, x_user_id: str = Header(...)):
-    # check if format is of the name "can<feature_name>" where featurename is lowercase ascii
-    # for simplicity
-    if not re.match(r"^can[a-z]{1,16}+$", feature_flag):
+async def unknown_feature(
+    feature_flag: str,
+    x_user_id: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    fresh_as_of: Optional[datetime] = None,
+    max_wait_ms: int = Query(DEFAULT_FRESHNESS_WAIT_MS, ge=0, le=MAX_FRESHNESS_WAIT_MS),
+):
+    # every known feature has its own route once the app is ready. Requests
+    # for one that arrived while loading end up here and are answered once
+    # the registry is there, anything else is unknown.
+    await require_ready()
+    # check if format is of the name "can<feature_name>" where featurename is
+    # lowercase ascii for simplicity
+    if not re.match(r"^can[a-z]{1,16}$", feature_flag):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid feature flag"
         )
-    feature_name = feature_flag[3:]
-    feature = None
     try:
-        feature = await app.state.feature_registry.get_feature_by_name(feature_name)
+        feature = await app.state.feature_registry.get_feature_by_name(
+            feature_flag[3:]
+        )
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
-
-    has_grant = await app.state.user_feature_service.has_grant(x_user_id, feature)
-    return {"user_id": x_user_id, "feature": feature.name, "has_grant": has_grant}
+    if x_user_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Missing x-user-id header",
+        )
+    handler = build_feature_access_handler(feature, app.state.user_feature_service)
+    return await handler(
+        x_user_id=x_user_id,
+        if_none_match=if_none_match,
+        fresh_as_of=fresh_as_of,
+        max_wait_ms=max_wait_ms,
+    )
@@ -2,15 +2,23 @@
 
 import asyncio
 import logging
+import os
+import time
 from contextlib import asynccontextmanager
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional
 
 from config import (
     DEFAULT_AGGREGATE_CONFIG_DICT,
+    DEFAULT_CIRCUIT_BREAKER_CONFIG_DICT,
+    DEFAULT_DEDUPE_CONFIG_DICT,
+    DEFAULT_EVENT_LANES_CONFIG_DICT,
     DEFAULT_FEATURES_CONFIG_DICT,
     DEFAULT_RULE_CONFIG_DICT,
+    DEFAULT_SHADOW_RULE_CONFIG_DICT,
     ConfigError,
     get_aggregate_configs,
+    get_circuit_breaker_configs,
+    get_event_lanes,
     get_event_properties_map,
 )
 from models.aggregate import (
@@ -19,6 +27,7 @@ from models.aggregate import (
     EventAggregateConfig,
     EventAggregateStore,
 )
+from models.cold_store import DEFAULT_HOT_USERS, SqliteColdStore
 from models.rules import (
     PlatformFeature,
     Rule,
@@ -26,14 +35,124 @@ from models.rules import (
     RuleOperation,
     RulesStore,
 )
+from models.striping import DEFAULT_NUM_STRIPES
+from services.consumer_pool import AutoscaleConfig, ConsumerPool
+from services.dedupe import EventDeduplicator
+from services.event_dispatcher import KeyedEventDispatcher
 from services.event_processer import EventConsumer, EventProcessor
 from services.event_registry import EventSchemaRegistry, EventTypeNotRegistered
+from services.export import ColumnarExporter
 from services.feature_registry import PlatformFeaturesRegistry
+from services.freshness import DEFAULT_FRESHNESS_TARGET_MS, FreshnessTracker
+from services.grant_table import (
+    DEFAULT_GRANT_TABLE_CAPACITY,
+    DEFAULT_GRANT_TABLE_NAME,
+    DEFAULT_MAX_STALENESS,
+    AccessAttemptCollector,
+    AccessAttemptLog,
+    FollowingGrantTable,
+    GrantTableReader,
+    SharedGrantTable,
+    attach_when_created,
+    run_attempt_collector,
+    run_heartbeat,
+)
+from services.ingest import EventIngestor, IngestServer
+from services.memory_diagnostics import MemoryDiagnostics
+from services.notification_transport import NotificationDeliveryEngine
+from services.replication import (
+    DEFAULT_MAX_LAG,
+    DEFAULT_REPLICATION_ADDRESS,
+    DEFAULT_SNAPSHOT_INTERVAL,
+    ReplicaGrantTable,
+    ReplicationClient,
+    ReplicationServer,
+)
 from services.notifications import NotificationsService
+from services.shadow_rules import (
+    DEFAULT_SHADOW_CPU_BUDGET,
+    ShadowEvaluator,
+    ShadowRule,
+)
+from services.startup import Readiness, StartupProfiler
 from services.user_feature import UserFeatureService
 
-NUM_CONSUMERS = 3
-event_queue = asyncio.Queue()
+# events are queued per user and each user is processed by one consumer at a
+# time, so the consumer count can be raised without reordering a user's
+# events.
+NUM_CONSUMERS = int(os.environ.get("NUM_CONSUMERS", 3))
+# the pool starts with NUM_CONSUMERS consumers and is resized between
+# MIN_CONSUMERS and MAX_CONSUMERS with the load, set both to NUM_CONSUMERS
+# for a fixed pool.
+MIN_CONSUMERS = int(os.environ.get("MIN_CONSUMERS", 1))
+MAX_CONSUMERS = int(os.environ.get("MAX_CONSUMERS", max(NUM_CONSUMERS, 16)))
+CONSUMER_SCALE_INTERVAL = float(os.environ.get("CONSUMER_SCALE_INTERVAL", 1))
+event_queue = KeyedEventDispatcher(
+    lanes=get_event_lanes(DEFAULT_EVENT_LANES_CONFIG_DICT),
+)
+# per user grant state is split into this many independently locked stripes
+NUM_LOCK_STRIPES = int(os.environ.get("NUM_LOCK_STRIPES", DEFAULT_NUM_STRIPES))
+# comma separated subscriber urls, when set grant state changes are delivered
+# over http to them instead of being printed
+NOTIFICATION_SUBSCRIBER_URLS = os.environ.get("NOTIFICATION_SUBSCRIBER_URLS")
+# shadow rule evaluation may use at most this fraction of the live rule
+# processing time
+SHADOW_CPU_BUDGET = float(
+    os.environ.get("SHADOW_CPU_BUDGET", DEFAULT_SHADOW_CPU_BUDGET)
+)
+# when set, only this many users per aggregate are kept in memory and the
+# rest spill to a local sqlite file (AGGREGATE_SPILL_PATH, a temp file when
+# unset)
+AGGREGATE_HOT_USERS = int(os.environ.get("AGGREGATE_HOT_USERS", 0))
+AGGREGATE_SPILL_PATH = os.environ.get("AGGREGATE_SPILL_PATH")
+# "writer" publishes grants to a shared memory table that "reader" processes
+# answer access checks from. Readers don't process events, so run one writer
+# and any number of readers, e.g. under `uvicorn --workers`.
+GRANT_TABLE_ROLE = os.environ.get("GRANT_TABLE_ROLE", "")
+GRANT_TABLE_NAME = os.environ.get("GRANT_TABLE_NAME", DEFAULT_GRANT_TABLE_NAME)
+GRANT_TABLE_CAPACITY = int(
+    os.environ.get("GRANT_TABLE_CAPACITY", DEFAULT_GRANT_TABLE_CAPACITY)
+)
+# readers fail access checks once the writer stopped stamping the table for
+# longer than this many seconds
+GRANT_TABLE_MAX_STALENESS = float(
+    os.environ.get("GRANT_TABLE_MAX_STALENESS", DEFAULT_MAX_STALENESS)
+)
+if GRANT_TABLE_ROLE not in ("", "writer", "reader"):
+    raise ConfigError(f"Unknown GRANT_TABLE_ROLE {GRANT_TABLE_ROLE}.")
+# a "primary" streams grant transitions and snapshots to "replica" nodes on
+# REPLICATION_ADDRESS (a unix socket path or host:port). Replicas only answer
+# access checks, and fail them once they are more than REPLICATION_MAX_LAG
+# seconds behind.
+REPLICATION_ROLE = os.environ.get("REPLICATION_ROLE", "")
+REPLICATION_ADDRESS = os.environ.get(
+    "REPLICATION_ADDRESS", DEFAULT_REPLICATION_ADDRESS
+)
+REPLICATION_SNAPSHOT_INTERVAL = float(
+    os.environ.get("REPLICATION_SNAPSHOT_INTERVAL", DEFAULT_SNAPSHOT_INTERVAL)
+)
+REPLICATION_MAX_LAG = float(os.environ.get("REPLICATION_MAX_LAG", DEFAULT_MAX_LAG))
+if REPLICATION_ROLE not in ("", "primary", "replica"):
+    raise ConfigError(f"Unknown REPLICATION_ROLE {REPLICATION_ROLE}.")
+if REPLICATION_ROLE == "replica" and GRANT_TABLE_ROLE:
+    raise ConfigError("Replicas can't share a grant table.")
+if REPLICATION_ROLE == "primary" and GRANT_TABLE_ROLE == "reader":
+    # a reader has no grant state of its own to stream
+    raise ConfigError("A grant table reader can't be a replication primary.")
+# nodes that don't process events
+READ_ONLY = GRANT_TABLE_ROLE == "reader" or REPLICATION_ROLE == "replica"
+# when set, events are also accepted as length prefixed msgpack frames over a
+# persistent connection on this unix socket path or host:port
+INGEST_ADDRESS = os.environ.get("INGEST_ADDRESS")
+# events whose grants take longer than this from their timestamp to be
+# visible count against the freshness target
+FRESHNESS_TARGET_MS = float(
+    os.environ.get("FRESHNESS_TARGET_MS", DEFAULT_FRESHNESS_TARGET_MS)
+)
+# log the time spent in each startup phase
+STARTUP_PROFILE = os.environ.get("STARTUP_PROFILE", "") not in ("", "0")
+# how long requests that need loaded state wait for it during startup
+READINESS_TIMEOUT = float(os.environ.get("READINESS_TIMEOUT", 2))
 
 
 def configure_logger():
@@ -48,6 +167,18 @@ def configure_logger():
     return logger
 
 
+def build_notifications_service(subscriber_urls: str, logger: logging.Logger):
+    if not subscriber_urls:
+        return NotificationsService(), None
+    urls = [url.strip() for url in subscriber_urls.split(",") if url.strip()]
+    delivery_engine = NotificationDeliveryEngine(logger=logger)
+    notifications_service = NotificationsService(
+        event_subscribers={"access_granted": urls, "access_revoked": urls},
+        delivery_engine=delivery_engine,
+    )
+    return notifications_service, delivery_engine
+
+
 def initialize_schema_registry():
     event_schema_registry = EventSchemaRegistry()
     event_properties_map = get_event_properties_map()
@@ -59,7 +190,9 @@ def initialize_schema_registry():
 
 
 async def build_aggregates(
-    aggregate_configs: List[EventAggregateConfig], schema_registry: EventSchemaRegistry
+    aggregate_configs: List[EventAggregateConfig],
+    schema_registry: EventSchemaRegistry,
+    cold_store: Optional[SqliteColdStore] = None,
 ) -> List[EventAggregate]:
     aggregates = []
     for config in aggregate_configs:
@@ -74,6 +207,9 @@ async def build_aggregates(
                 event_name=config.event_name,
                 type=AggregateType(config.type),
                 field=config.field,
+                cold_store=cold_store,
+                hot_size=AGGREGATE_HOT_USERS or DEFAULT_HOT_USERS,
+                quantile=config.quantile,
             )
             aggregates.append(agg)
         except EventTypeNotRegistered as e:
@@ -82,9 +218,11 @@ async def build_aggregates(
 
 
 async def build_aggregate_store(
-    aggregate_configs: List[EventAggregateConfig], schema_registry: EventSchemaRegistry
+    aggregate_configs: List[EventAggregateConfig],
+    schema_registry: EventSchemaRegistry,
+    cold_store: Optional[SqliteColdStore] = None,
 ) -> EventAggregateStore:
-    aggregates = await build_aggregates(aggregate_configs, schema_registry)
+    aggregates = await build_aggregates(aggregate_configs, schema_registry, cold_store)
     aggregate_store = EventAggregateStore()
     for agg in aggregates:
         aggregate_store.add_aggregate(agg)
@@ -96,27 +234,54 @@ async def build_rule_store(
 ) -> RulesStore:
     rules_store = RulesStore()
     for config in rules_config:
-        aggregate1 = await aggregate_store.get_aggregate_by_name(config["aggregate1"])
-        aggregate2 = (
-            None
-            if not config.get("aggregate2")
-            else await aggregate_store.get_aggregate_by_name(config["aggregate2"])
-        )
-        condition = RuleCondition(config["condition"])
-        operation = RuleOperation(config["operation"])
-        rule = Rule(
-            name=config["name"],
-            operation=operation,
-            aggregate1=aggregate1,
-            aggregate2=aggregate2,
-            value=config["value"],
-            condition=condition,
-            denom_min=config.get("denom_min"),
-        )
+        rule = await build_rule(config, aggregate_store)
         rules_store.add_rule(rule)
     return rules_store
 
 
+async def build_rule(config: Dict[str, str], aggregate_store: EventAggregateStore):
+    aggregate1 = await aggregate_store.get_aggregate_by_name(config["aggregate1"])
+    aggregate2 = (
+        None
+        if not config.get("aggregate2")
+        else await aggregate_store.get_aggregate_by_name(config["aggregate2"])
+    )
+    condition = RuleCondition(config["condition"])
+    operation = RuleOperation(config["operation"])
+    return Rule(
+        name=config["name"],
+        operation=operation,
+        aggregate1=aggregate1,
+        aggregate2=aggregate2,
+        value=config["value"],
+        condition=condition,
+        denom_min=config.get("denom_min"),
+    )
+
+
+async def build_shadow_evaluator(
+    shadow_rules_config: List[Dict[str, str]],
+    aggregate_store: EventAggregateStore,
+    rules_store: RulesStore,
+    feature_registry: PlatformFeaturesRegistry,
+    logger: logging.Logger,
+) -> Optional[ShadowEvaluator]:
+    if not shadow_rules_config:
+        return None
+    shadow_rules = []
+    for config in shadow_rules_config:
+        try:
+            replaces = await rules_store.get_rule_by_name(config["replaces"])
+        except ValueError as e:
+            raise ConfigError(f"Shadow rule {config['name']}: {e}")
+        rule = await build_rule(config, aggregate_store)
+        features = await feature_registry.get_features_by_rule(replaces.name)
+        shadow_rules.append(ShadowRule(rule, replaces, list(features)))
+    return ShadowEvaluator(
+        shadow_rules, rules_store, cpu_budget=SHADOW_CPU_BUDGET, logger=logger
+    )
+
+
 async def build_platform_feature_registry(
     feature_config: List[Dict[str, List[str]]], rules_store: RulesStore
 ) -> PlatformFeaturesRegistry:
@@ -131,57 +296,322 @@ async def build_platform_feature_registry(
     return feature_registry
 
 
-@asynccontextmanager
-async def lifespan(app):
-    logger = configure_logger()
-    # Initialize schema registry
-    schema_registry = initialize_schema_registry()
+def register_memory_sources(
+    diagnostics: MemoryDiagnostics,
+    aggregate_store: EventAggregateStore,
+    rules_store: RulesStore,
+    feature_registry: PlatformFeaturesRegistry,
+    user_feature_service: Optional[UserFeatureService],
+):
+    diagnostics.register("aggregates", aggregate_store.memory_usage)
+    diagnostics.register("rules", rules_store.memory_usage)
+    diagnostics.register(
+        "feature_flags",
+        lambda: {
+            feature.name: feature.memory_usage()
+            for feature in feature_registry.list_features()
+        },
+    )
+    if user_feature_service is None:
+        return
+    diagnostics.register("user_features", user_feature_service.memory_usage)
+    diagnostics.register("grant_feed", user_feature_service.change_feed.memory_usage)
 
-    # Load configurations
-    aggregate_configs = get_aggregate_configs(DEFAULT_AGGREGATE_CONFIG_DICT)
-    rules_config_dict = DEFAULT_RULE_CONFIG_DICT
 
-    # Build components
-    aggregate_store = await build_aggregate_store(aggregate_configs, schema_registry)
-    rules_store = await build_rule_store(rules_config_dict, aggregate_store)
-    feature_registry = await build_platform_feature_registry(
-        DEFAULT_FEATURES_CONFIG_DICT, rules_store
-    )
-    notifications_service = NotificationsService()
-    user_feature_service = UserFeatureService(
-        feature_registry=feature_registry,
-        notifications_service=notifications_service,
-        logger=logger,
-    )
-    event_processor = EventProcessor(
-        aggregate_store=aggregate_store,
-        rule_store=rules_store,
-        feature_registry=feature_registry,
-        user_feature_service=user_feature_service,
-        logger=logger,
-    )
+class BackgroundTasks:
+    def __init__(self):
+        self.consumers: Optional[ConsumerPool] = None
+        self.delivery: Optional[asyncio.Task] = None
+        self.delivery_engine: Optional[NotificationDeliveryEngine] = None
+        self.cold_store: Optional[SqliteColdStore] = None
+        self.grant_table: Optional[SharedGrantTable] = None
+        self.grant_table_heartbeat: Optional[asyncio.Task] = None
+        self.attempt_collector: Optional[asyncio.Task] = None
+        self.attempt_log: Optional[AccessAttemptLog] = None
+        self.replication_server: Optional[ReplicationServer] = None
+        self.replication_client: Optional[asyncio.Task] = None
+        self.ingest_server: Optional[IngestServer] = None
+
+
+async def load_state(
+    app,
+    schema_registry: EventSchemaRegistry,
+    logger: logging.Logger,
+    profiler: StartupProfiler,
+    background: BackgroundTasks,
+    on_state_loaded: Optional[Callable] = None,
+):
+    """
+    Builds everything access checks and event processing depend on, then
+    starts the consumers and marks the app ready. Runs after the app already
+    accepts requests; events posted meanwhile wait in the queue.
+    """
+    with profiler.phase("build_aggregate_store"):
+        aggregate_configs = get_aggregate_configs(DEFAULT_AGGREGATE_CONFIG_DICT)
+        if AGGREGATE_HOT_USERS:
+            background.cold_store = SqliteColdStore(AGGREGATE_SPILL_PATH)
+        aggregate_store = await build_aggregate_store(
+            aggregate_configs, schema_registry, background.cold_store
+        )
+    with profiler.phase("build_rule_store"):
+        rules_store = await build_rule_store(DEFAULT_RULE_CONFIG_DICT, aggregate_store)
+    with profiler.phase("build_platform_feature_registry"):
+        feature_registry = await build_platform_feature_registry(
+            DEFAULT_FEATURES_CONFIG_DICT, rules_store
+        )
+    with profiler.phase("build_shadow_rules"):
+        shadow_evaluator = await build_shadow_evaluator(
+            DEFAULT_SHADOW_RULE_CONFIG_DICT,
+            aggregate_store,
+            rules_store,
+            feature_registry,
+            logger,
+        )
+    with profiler.phase("build_services"):
+        notifications_service, delivery_engine = build_notifications_service(
+            NOTIFICATION_SUBSCRIBER_URLS, logger
+        )
+        circuit_configs = get_circuit_breaker_configs(
+            DEFAULT_CIRCUIT_BREAKER_CONFIG_DICT
+        )
+        feature_names = [feature.name for feature in feature_registry.list_features()]
+        if GRANT_TABLE_ROLE == "writer":
+            background.grant_table = SharedGrantTable.create(
+                feature_names, GRANT_TABLE_NAME, GRANT_TABLE_CAPACITY
+            )
+            background.grant_table_heartbeat = asyncio.create_task(
+                run_heartbeat(background.grant_table)
+            )
+        user_feature_service = UserFeatureService(
+            feature_registry=feature_registry,
+            notifications_service=notifications_service,
+            logger=logger,
+            circuit_configs=circuit_configs,
+            num_stripes=NUM_LOCK_STRIPES,
+            grant_table=background.grant_table,
+        )
+        if GRANT_TABLE_ROLE == "writer":
+            # circuits are evaluated here on the access checks of every reader
+            collector = AccessAttemptCollector(
+                background.grant_table, user_feature_service.circuit_breakers()
+            )
+            background.attempt_collector = asyncio.create_task(
+                run_attempt_collector(collector)
+            )
+        event_processor = EventProcessor(
+            aggregate_store=aggregate_store,
+            rule_store=rules_store,
+            feature_registry=feature_registry,
+            user_feature_service=user_feature_service,
+            logger=logger,
+            shadow_evaluator=shadow_evaluator,
+        )
+
+    if GRANT_TABLE_ROLE == "reader":
+        with profiler.phase("attach_grant_table"):
+            background.grant_table = FollowingGrantTable(
+                await attach_when_created(feature_names, GRANT_TABLE_NAME),
+                max_staleness=GRANT_TABLE_MAX_STALENESS,
+            )
+            background.attempt_log = AccessAttemptLog.create(
+                feature_names, GRANT_TABLE_NAME
+            )
+        access_service = GrantTableReader(
+            background.grant_table,
+            feature_registry,
+            logger,
+            circuit_configs,
+            attempt_log=background.attempt_log,
+        )
+    elif REPLICATION_ROLE == "replica":
+        replication = ReplicationClient(
+            ReplicaGrantTable(max_lag=REPLICATION_MAX_LAG), REPLICATION_ADDRESS, logger
+        )
+        background.replication_client = asyncio.create_task(replication.run())
+        with profiler.phase("initial_snapshot"):
+            # without a snapshot access checks fail with ReplicationLagError
+            # until one arrives, the app is ready either way
+            if not await replication.table.wait_synced(REPLICATION_MAX_LAG):
+                logger.warning(
+                    f"no snapshot from {REPLICATION_ADDRESS} after "
+                    f"{REPLICATION_MAX_LAG}s, access checks fail until one arrives"
+                )
+        access_service = GrantTableReader(
+            replication.table, feature_registry, logger, circuit_configs
+        )
+    else:
+        access_service = user_feature_service
+    if REPLICATION_ROLE == "primary":
+        replication = ReplicationServer(
+            user_feature_service,
+            REPLICATION_ADDRESS,
+            logger,
+            snapshot_interval=REPLICATION_SNAPSHOT_INTERVAL,
+        )
+        await replication.start()
+        background.replication_server = replication
 
     # Attach components to app state
-    app.state.user_feature_service = user_feature_service
+    app.state.aggregate_store = aggregate_store
+    app.state.rules_store = rules_store
+    app.state.user_feature_service = access_service
+    app.state.grant_table = background.grant_table
+    app.state.replication = replication if REPLICATION_ROLE else None
     app.state.feature_registry = feature_registry
-    app.state.event_queue = event_queue
-    app.state.schema_registry = schema_registry
-    app.state.logger = logger
-
-    consumer = EventConsumer(
-        queue=event_queue, event_processor=event_processor, logger=logger
-    )
-    consumer_tasks = [
-        asyncio.create_task(consumer.consume()) for _ in range(NUM_CONSUMERS)
-    ]
-    circuit_breaker_task = asyncio.create_task(
-        user_feature_service.evaluate_circuit_breakers()
+    app.state.delivery_engine = delivery_engine
+    app.state.shadow_evaluator = shadow_evaluator
+    app.state.exporter = ColumnarExporter(aggregate_store, user_feature_service)
+    register_memory_sources(
+        app.state.memory_diagnostics,
+        aggregate_store,
+        rules_store,
+        feature_registry,
+        None if READ_ONLY else user_feature_service,
     )
+    if on_state_loaded:
+        on_state_loaded(app)
+
+    if not READ_ONLY:
+        with profiler.phase("consumer_spin_up"):
+            consumer = EventConsumer(
+                queue=event_queue,
+                event_processor=event_processor,
+                logger=logger,
+                freshness=app.state.freshness,
+                deduplicator=app.state.event_deduplicator,
+            )
+            background.consumers = ConsumerPool(
+                consumer,
+                logger,
+                AutoscaleConfig(
+                    min_consumers=MIN_CONSUMERS,
+                    max_consumers=MAX_CONSUMERS,
+                    interval=CONSUMER_SCALE_INTERVAL,
+                ),
+                initial_consumers=NUM_CONSUMERS,
+            )
+            background.consumers.start()
+            app.state.consumer_pool = background.consumers
+            if delivery_engine:
+                background.delivery_engine = delivery_engine
+                background.delivery = asyncio.create_task(delivery_engine.run())
+
+    app.state.readiness.set_ready()
+    profiler.finish()
+    if STARTUP_PROFILE:
+        logger.info(f"startup profile: {profiler.report()}")
+
+
+async def shutdown(background: BackgroundTasks):
+    if background.ingest_server:
+        await background.ingest_server.close()
+    if background.consumers:
+        await event_queue.join()
+        await background.consumers.close()
+    if background.delivery_engine:
+        background.delivery.cancel()
+        await background.delivery_engine.close(timeout=5)
+    if background.cold_store:
+        background.cold_store.close()
+    if background.grant_table_heartbeat:
+        background.grant_table_heartbeat.cancel()
+        await asyncio.gather(background.grant_table_heartbeat, return_exceptions=True)
+    if background.attempt_collector:
+        background.attempt_collector.cancel()
+        await asyncio.gather(background.attempt_collector, return_exceptions=True)
+    if background.grant_table:
+        background.grant_table.close()
+    if background.attempt_log:
+        background.attempt_log.close()
+    if background.replication_server:
+        await background.replication_server.close()
+    if background.replication_client:
+        background.replication_client.cancel()
+        await asyncio.gather(background.replication_client, return_exceptions=True)
+
+
+def build_lifespan(on_state_loaded: Optional[Callable] = None):
+    """
+    on_state_loaded(app) is called once the feature registry and services are
+    on app.state, before the app is marked ready.
+    """
+
+    @asynccontextmanager
+    async def lifespan(app):
+        profiler = StartupProfiler()
+        # cpu time spent before startup, dominated by interpreter start and
+        # imports. `python -X importtime -c "import app"` breaks it down.
+        profiler.record("imports", time.process_time())
+        logger = configure_logger()
+
+        with profiler.phase("schema_registry"):
+            schema_registry = initialize_schema_registry()
+            event_deduplicator = EventDeduplicator(**DEFAULT_DEDUPE_CONFIG_DICT)
+
+        # enough to accept events right away, they are queued until the
+        # consumers start
+        app.state.event_queue = event_queue
+        app.state.schema_registry = schema_registry
+        app.state.event_deduplicator = event_deduplicator
+        # only nodes that process events know how fresh their grants are
+        app.state.freshness = (
+            None if READ_ONLY else FreshnessTracker(FRESHNESS_TARGET_MS)
+        )
+        app.state.event_ingestor = EventIngestor(
+            schema_registry, event_deduplicator, event_queue, app.state.freshness
+        )
+        app.state.memory_diagnostics = MemoryDiagnostics()
+        app.state.memory_diagnostics.register("event_queue", event_queue.memory_usage)
+        app.state.memory_diagnostics.register(
+            "dedupe", event_deduplicator.memory_usage
+        )
+        app.state.logger = logger
+        # readers and replicas only answer access checks, events go to the
+        # writer or primary
+        app.state.read_only = READ_ONLY
+        app.state.readiness = Readiness()
+        app.state.startup_profiler = profiler
+        app.state.consumer_pool = None
+
+        background = BackgroundTasks()
+        if INGEST_ADDRESS and not READ_ONLY:
+            background.ingest_server = IngestServer(
+                app.state.event_ingestor, INGEST_ADDRESS, logger
+            )
+            await background.ingest_server.start()
+        app.state.ingest_server = background.ingest_server
+        loader = asyncio.create_task(
+            load_state(
+                app, schema_registry, logger, profiler, background, on_state_loaded
+            )
+        )
+        loader.add_done_callback(
+            lambda task: _report_load_failure(
+                task, app.state.readiness, background, logger
+            )
+        )
+
+        yield
+
+        if not loader.done():
+            loader.cancel()
+        await asyncio.gather(loader, return_exceptions=True)
+        await shutdown(background)
+
+    return lifespan
+
+
+def _report_load_failure(
+    task: asyncio.Task, readiness: Readiness, background: BackgroundTasks, logger
+):
+    if task.cancelled() or task.exception() is None:
+        return
+    readiness.set_failed(task.exception())
+    logger.error(f"failed to load state: {task.exception()}")
+    # nothing will consume events, stop taking them. POST /event checks
+    # readiness itself.
+    if background.ingest_server:
+        asyncio.ensure_future(background.ingest_server.close())
 
-    yield
 
-    await event_queue.join()
-    circuit_breaker_task.cancel()
-    for task in consumer_tasks:
-        task.cancel()
-    await asyncio.gather(*consumer_tasks, return_exceptions=True)
+lifespan = build_lifespan()
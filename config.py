@@ -5,6 +5,8 @@ from models.event import (
     PurchaseEventProperties,
     ScamFlagEventProperties,
 )
+from services.circuit_breaker import CircuitBreakerConfig
+from services.event_dispatcher import EventLane
 from services.event_registry import EventSchemaRegistry
 
 DEFAULT_AGGREGATE_CONFIG_DICT = {
@@ -30,7 +32,15 @@ DEFAULT_AGGREGATE_CONFIG_DICT = {
     "chargeback": [
         {"type": "sum", "name": "total_chargeback_amount", "field": "amount"}
     ],
-    "purchase": [{"type": "sum", "name": "total_purchase_amount", "field": "amount"}],
+    "purchase": [
+        {"type": "sum", "name": "total_purchase_amount", "field": "amount"},
+        # every aggregate is kept for every user, only add ones a rule uses.
+        # A percentile sketch is ~2KB per user, e.g.
+        # {"type": "percentile", "name": "purchase_amount_p95",
+        #  "field": "amount", "quantile": 0.95}
+        # used as {"operation": "VALUE", "aggregate1": "purchase_amount_p95",
+        #  "condition": "<", "value": 1000}
+    ],
 }
 
 
@@ -71,6 +81,21 @@ DEFAULT_RULE_CONFIG_DICT = [
 ]
 
 
+# Candidate rules evaluated next to the live ones without affecting grants,
+# same format as DEFAULT_RULE_CONFIG_DICT plus the live rule they would
+# replace, e.g.
+# {
+#     "name": "chargeback_to_purchase_ratio_strict",
+#     "replaces": "chargeback_to_purchase_ratio",
+#     "operation": "DIVIDE",
+#     "aggregate1": "total_chargeback_amount",
+#     "aggregate2": "total_purchase_amount",
+#     "condition": "<",
+#     "value": 0.05,
+# }
+DEFAULT_SHADOW_RULE_CONFIG_DICT = []
+
+
 def get_rule_configs(config_dict: list):
     return config_dict
 
@@ -87,6 +112,69 @@ DEFAULT_FEATURES_CONFIG_DICT = [
 ]
 
 
+# Ingest dedupe: exact uuids for num_buckets * bucket_seconds, then rotating
+# Bloom filters with the given capacity and false positive rate.
+DEFAULT_DEDUPE_CONFIG_DICT = {
+    "bucket_seconds": 60,
+    "num_buckets": 10,
+    "bloom_capacity": 1_000_000,
+    "bloom_error_rate": 0.001,
+    "bloom_generations": 2,
+}
+
+
+# Circuit breakers, per feature with "default" for the rest. A circuit opens
+# when more than `threshold` of the users that hit the feature in the last
+# `window_seconds` were denied. Optionally `min_users` (default 1) keeps it
+# closed until that many users were seen, and users are hashed into
+# `segments` (default 1) so a burst of denials only opens the circuit for
+# part of them, e.g.
+# "purchase": {
+#     "threshold": 0.05,
+#     "window_seconds": 300,
+#     "min_users": 20,
+#     "segments": 8,
+# },
+DEFAULT_CIRCUIT_BREAKER_CONFIG_DICT = {
+    "default": {
+        "threshold": 0.05,
+        "window_seconds": 600,
+    },
+}
+
+
+def get_circuit_breaker_configs(config_dict: dict):
+    return {
+        name: CircuitBreakerConfig(**config) for name, config in config_dict.items()
+    }
+
+
+# Events are queued in lanes, while several lanes have events each gets a
+# share of the consumers proportional to its weight. Events not listed in any
+# lane go to "default".
+DEFAULT_EVENT_LANES_CONFIG_DICT = {
+    # events that can revoke access shouldn't wait behind a purchase spike
+    "revocations": {
+        "weight": 8,
+        "events": ["chargeback", "scam_flag"],
+        "wait_target_ms": 100,
+    },
+    "default": {"weight": 1},
+}
+
+
+def get_event_lanes(config_dict: dict):
+    return [
+        EventLane(
+            name=name,
+            weight=config.get("weight", 1),
+            event_names=config.get("events", []),
+            wait_target_ms=config.get("wait_target_ms"),
+        )
+        for name, config in config_dict.items()
+    ]
+
+
 class ConfigError(Exception):
     pass
 
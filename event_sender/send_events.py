@@ -1,12 +1,20 @@
+import argparse
 import datetime
+import itertools
 import os
+import socket
+import struct
 import time
 import uuid
 
+import msgpack
 import requests
 
 # URL of the user access service
 url = os.environ.get("EVENT_URL", "http://localhost:5000/event")
+# unix socket path or host:port of the service's msgpack ingest listener
+ingest_address = os.environ.get("INGEST_ADDRESS", "localhost:5100")
+FRAME_HEADER = struct.Struct(">I")
 
 # Simulate sending various events
 events = [
@@ -43,6 +51,87 @@ def send_events():
             time.sleep(3)  # Wait a bit before sending the next event
 
 
+def bench_events(count):
+    """events for the benchmarks, spread over 1000 users"""
+    for i in range(count):
+        event = dict(events[i % len(events)])
+        event["event_properties"] = dict(
+            event["event_properties"], user_id=f"user{i % 1000}"
+        )
+        yield event
+
+
+def bench_http(count):
+    session = requests.Session()
+    for event in bench_events(count):
+        refresh_fields(event)
+        session.post(url, json=event).raise_for_status()
+
+
+def connect(address):
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit() and not address.startswith("/"):
+        return socket.create_connection((host, int(port)))
+    sock = socket.socket(socket.AF_UNIX)
+    sock.connect(address)
+    return sock
+
+
+def read_frame(f):
+    (length,) = FRAME_HEADER.unpack(f.read(FRAME_HEADER.size))
+    return msgpack.unpackb(f.read(length))
+
+
+def bench_msgpack(count, window):
+    """keeps up to `window` unacknowledged events in flight"""
+    sock = connect(ingest_address)
+    acks = sock.makefile("rb")
+    sent = acked = errors = 0
+    pending = bench_events(count)
+    while acked < count:
+        frames = []
+        for event in itertools.islice(pending, window - (sent - acked)):
+            event["uuid"] = uuid.uuid4().bytes
+            event["timestamp"] = time.time()
+            payload = msgpack.packb(event)
+            frames.append(FRAME_HEADER.pack(len(payload)) + payload)
+        if frames:
+            sock.sendall(b"".join(frames))
+            sent += len(frames)
+        ack = read_frame(acks)
+        if "error" in ack:
+            raise RuntimeError(ack["error"])
+        acked = ack["through"]
+        errors += len(ack["errors"])
+    sock.close()
+    if errors:
+        print(f"{errors} events were rejected")
+
+
+def bench(mode, count, window):
+    started_at = time.perf_counter()
+    if mode == "http":
+        bench_http(count)
+    else:
+        bench_msgpack(count, window)
+    elapsed = time.perf_counter() - started_at
+    print(f"{mode}: {count} events in {elapsed:.2f}s, {count / elapsed:.0f} events/s")
+
+
 if __name__ == "__main__":
-    print("RUNNING")
-    send_events()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--bench",
+        choices=["http", "msgpack"],
+        help="send --count events as fast as possible and report events/s",
+    )
+    parser.add_argument("--count", type=int, default=10_000)
+    parser.add_argument(
+        "--window", type=int, default=1000, help="unacknowledged msgpack events"
+    )
+    args = parser.parse_args()
+    if args.bench:
+        bench(args.bench, args.count, args.window)
+    else:
+        print("RUNNING")
+        send_events()
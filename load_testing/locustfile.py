@@ -1,34 +1,25 @@
-import datetime
 import random
-import string
-import uuid
 
 from locust import FastHttpUser, between, task
 
+from workload import WorkloadConfig, WorkloadGenerator
 
-class User(FastHttpUser):
-    wait_time = between(0.8, 1.2)
+# zipf distributed users and the default event mix, see workload.py
+generator = WorkloadGenerator(WorkloadConfig(seed=random.randrange(2**32)))
 
-    def on_start(self):
-        self.user_id = self._get_random_user_id()
 
-    def _get_random_user_id(self):
-        random_digits = "".join(random.choices(string.digits, k=10))
-        return f"user{random_digits}"
+class User(FastHttpUser):
+    wait_time = between(0.8, 1.2)
 
     @task(1)
     def send_event(self):
-        payload = {
-            "uuid": str(uuid.uuid4()),
-            "name": "scam_flag",
-            "timestamp": datetime.datetime.now().isoformat(),
-            "event_properties": {
-                "user_id": self.user_id,
-            },
-        }
-        self.client.post("/event", json=payload)
+        self.client.post("/event", json=generator.event())
 
     @task(1)
     def get_permission(self):
-        user_id = self.user_id if random.random() < 0.25 else self._get_random_user_id()
-        self.client.get("/canpurchase", headers={"x-user-id": user_id})
+        access = generator.access()
+        self.client.get(
+            f"/can{access['feature']}",
+            headers={"x-user-id": access["user_id"]},
+            name="/can[feature]",
+        )
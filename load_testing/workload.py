@@ -0,0 +1,326 @@
+"""
+Workload generator and in-process replay for comparing changes between
+commits without a running server.
+
+    python -m load_testing.workload generate --users 10000 --operations 50000 \
+        --output workload.jsonl
+    python -m load_testing.workload replay workload.jsonl --report report.json
+
+A workload is a JSONL file with one operation per line, either an event post
+or an access check. Users are drawn from a Zipf distribution so a few heavy
+users carry most of the traffic, and the first `history` operations are only
+events, replayed untimed to give aggregates some depth before measuring.
+"""
+
+import argparse
+import asyncio
+import bisect
+import contextlib
+import datetime
+import hashlib
+import itertools
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from collections import Counter, defaultdict
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional
+
+DEFAULT_EVENT_MIX = {
+    "purchase": 0.6,
+    "add_credit_card": 0.2,
+    "chargeback": 0.1,
+    "scam_flag": 0.1,
+}
+DEFAULT_FEATURES = ["purchase", "message"]
+BASE_TIMESTAMP = datetime.datetime(2024, 1, 1)
+
+
+@dataclass
+class WorkloadConfig:
+    users: int = 10_000
+    operations: int = 50_000
+    # untimed events replayed before the measured operations
+    history: int = 20_000
+    # fraction of measured operations that are access checks
+    access_ratio: float = 0.5
+    zipf_exponent: float = 1.1
+    event_mix: Dict[str, float] = field(default_factory=lambda: dict(DEFAULT_EVENT_MIX))
+    features: List[str] = field(default_factory=lambda: list(DEFAULT_FEATURES))
+    # distinct zip codes per user, more means more DIVIDE rule violations
+    zipcodes_per_user: int = 3
+    seed: int = 0
+
+
+class ZipfSampler:
+    """
+    Draws ranks 0..n-1 with probability proportional to 1 / (rank + 1) ** s.
+    """
+
+    def __init__(self, n: int, exponent: float, rng: random.Random):
+        self.rng = rng
+        self._cumulative = list(
+            itertools.accumulate(1 / (rank**exponent) for rank in range(1, n + 1))
+        )
+
+    def sample(self) -> int:
+        point = self.rng.random() * self._cumulative[-1]
+        return bisect.bisect_left(self._cumulative, point)
+
+
+class WorkloadGenerator:
+    def __init__(self, config: WorkloadConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.users = ZipfSampler(config.users, config.zipf_exponent, self.rng)
+        self._event_names = list(config.event_mix)
+        self._event_weights = list(
+            itertools.accumulate(config.event_mix[name] for name in self._event_names)
+        )
+        self._sequence = itertools.count()
+
+    def generate(self) -> Iterator[dict]:
+        for _ in range(self.config.history):
+            yield {"op": "event", "history": True, "body": self.event()}
+        for _ in range(self.config.operations):
+            if self.rng.random() < self.config.access_ratio:
+                yield self.access()
+            else:
+                yield {"op": "event", "body": self.event()}
+
+    def _user_id(self) -> str:
+        return f"user{self.users.sample()}"
+
+    def event(self) -> dict:
+        name = self._event_names[
+            bisect.bisect_left(
+                self._event_weights, self.rng.random() * self._event_weights[-1]
+            )
+        ]
+        user_id = self._user_id()
+        properties = {"user_id": user_id}
+        if name == "add_credit_card":
+            zipcode = self.rng.randrange(self.config.zipcodes_per_user)
+            properties["zipcode"] = f"{user_id}-{zipcode}"
+        elif name == "purchase":
+            properties["amount"] = round(self.rng.uniform(5, 200), 2)
+        elif name == "chargeback":
+            properties["amount"] = round(self.rng.uniform(5, 50), 2)
+        timestamp = BASE_TIMESTAMP + datetime.timedelta(seconds=next(self._sequence))
+        return {
+            "uuid": str(uuid.UUID(int=self.rng.getrandbits(128), version=4)),
+            "name": name,
+            "timestamp": timestamp.isoformat(),
+            "event_properties": properties,
+        }
+
+    def access(self) -> dict:
+        return {
+            "op": "access",
+            "feature": self.rng.choice(self.config.features),
+            "user_id": self._user_id(),
+        }
+
+
+def write_workload(path: str, config: WorkloadConfig, operations: Iterable[dict]):
+    with open(path, "w") as f:
+        f.write(json.dumps({"config": asdict(config)}) + "\n")
+        for operation in operations:
+            f.write(json.dumps(operation) + "\n")
+
+
+def read_workload(path: str) -> List[dict]:
+    with open(path) as f:
+        lines = f.readlines()
+    return [json.loads(line) for line in lines[1:]]
+
+
+def workload_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+async def asgi_request(
+    app,
+    method: str,
+    path: str,
+    body: Optional[dict] = None,
+    headers: Optional[Dict[str, str]] = None,
+) -> int:
+    """
+    Calls the ASGI app directly, returns the response status.
+    """
+    payload = json.dumps(body).encode() if body is not None else b""
+    raw_headers = [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+    if body is not None:
+        raw_headers.append((b"content-type", b"application/json"))
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": raw_headers,
+        "server": ("workload", 80),
+        "client": ("workload", 0),
+        "app": app,
+    }
+    received = False
+    response = {"status": None}
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": payload, "more_body": False}
+        # only reached by streaming endpoints, which are not replayed
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+
+    await app(scope, receive, send)
+    return response["status"]
+
+
+def percentiles(latencies: List[float]) -> Dict[str, float]:
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+
+    def at(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1e3
+
+    return {
+        "count": len(latencies),
+        "p50_ms": at(0.5),
+        "p90_ms": at(0.9),
+        "p99_ms": at(0.99),
+        "max_ms": latencies[-1] * 1e3,
+    }
+
+
+async def replay(app, operations: List[dict], concurrency: int = 32) -> dict:
+    """
+    Replays the operations against the app in process. History events are
+    sent and processed before the clock starts; measured operations are sent
+    by `concurrency` workers and the run ends once every event is processed.
+    """
+    history = [op for op in operations if op.get("history")]
+    measured = [op for op in operations if not op.get("history")]
+    latencies = defaultdict(list)
+    statuses = Counter()
+
+    async with app.router.lifespan_context(app):
+        await app.state.readiness.wait(timeout=None)
+        queue = app.state.event_queue
+        for operation in history:
+            await asgi_request(app, "POST", "/event", operation["body"])
+        await queue.join()
+
+        pending = iter(measured)
+
+        async def worker():
+            for operation in pending:
+                if operation["op"] == "event":
+                    args = ("POST", "/event", operation["body"])
+                    kwargs = {}
+                else:
+                    args = ("GET", f"/can{operation['feature']}")
+                    kwargs = {"headers": {"x-user-id": operation["user_id"]}}
+                started_at = time.perf_counter()
+                status = await asgi_request(app, *args, **kwargs)
+                latencies[operation["op"]].append(time.perf_counter() - started_at)
+                statuses[f"{operation['op']}_{status}"] += 1
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        sent_at = time.perf_counter()
+        await queue.join()
+        drained_at = time.perf_counter()
+
+    events = len(latencies["event"])
+    return {
+        "operations": len(measured),
+        "history_events": len(history),
+        "concurrency": concurrency,
+        "request_seconds": sent_at - started_at,
+        "requests_per_second": len(measured) / (sent_at - started_at),
+        # events are only done once the consumers processed them
+        "events_per_second": events / (drained_at - started_at) if events else 0.0,
+        "queue_drain_seconds": drained_at - sent_at,
+        "latency": {op: percentiles(values) for op, values in latencies.items()},
+        "statuses": dict(statuses),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate")
+    defaults = WorkloadConfig()
+    generate_parser.add_argument("--users", type=int, default=defaults.users)
+    generate_parser.add_argument("--operations", type=int, default=defaults.operations)
+    generate_parser.add_argument("--history", type=int, default=defaults.history)
+    generate_parser.add_argument(
+        "--access-ratio", type=float, default=defaults.access_ratio
+    )
+    generate_parser.add_argument(
+        "--zipf-exponent", type=float, default=defaults.zipf_exponent
+    )
+    generate_parser.add_argument(
+        "--event-mix",
+        type=json.loads,
+        default=defaults.event_mix,
+        help='json object of event name to weight, e.g. \'{"purchase": 1}\'',
+    )
+    generate_parser.add_argument("--seed", type=int, default=defaults.seed)
+    generate_parser.add_argument("--output", default="workload.jsonl")
+
+    replay_parser = subparsers.add_parser("replay")
+    replay_parser.add_argument("workload")
+    replay_parser.add_argument("--concurrency", type=int, default=32)
+    replay_parser.add_argument("--report", help="also write the report to this file")
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        config = WorkloadConfig(
+            users=args.users,
+            operations=args.operations,
+            history=args.history,
+            access_ratio=args.access_ratio,
+            zipf_exponent=args.zipf_exponent,
+            event_mix=args.event_mix,
+            seed=args.seed,
+        )
+        write_workload(args.output, config, WorkloadGenerator(config).generate())
+        print(f"wrote {config.history + config.operations} operations to {args.output}")
+        return
+
+    from app import app
+
+    # per event rule logs and printed notifications would dominate the run
+    logging.disable(logging.INFO)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        report = asyncio.run(
+            replay(app, read_workload(args.workload), concurrency=args.concurrency)
+        )
+    report["workload"] = workload_digest(args.workload)
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
+
+MAX_BATCH_USERS = 1000
+
+
+class AccessBatchRequest(BaseModel):
+    user_ids: List[str] = Field(..., min_length=1, max_length=MAX_BATCH_USERS)
+    # every registered feature when omitted
+    features: Optional[List[str]] = None
@@ -2,11 +2,19 @@ import asyncio
 import enum
 from collections import defaultdict
 from dataclasses import dataclass
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional, Union
 
 from pydantic import BaseModel
 
-from models.event import Event
+from models.cache import LRUCache
+from models.cold_store import DEFAULT_HOT_USERS, SqliteColdStore, TieredUserStore
+from models.event import CompactEvent, Event
+from models.memory import estimate_size
+from models.sketches import RunningStats, TDigest
+
+DEFAULT_VALUE_CACHE_SIZE = 100_000
+
+_MISSING = object()
 
 
 class AggregationError(Exception):
@@ -17,6 +25,23 @@ class AggregateType(enum.Enum):
     COUNT = "count"
     DISTINCT_COUNT = "distinct_count"
     SUM = "sum"
+    MIN = "min"
+    MAX = "max"
+    AVG = "avg"
+    VARIANCE = "variance"
+    PERCENTILE = "percentile"
+
+
+# aggregates that never decrease and grow by at most one per update. SUM is
+# not one of them, nothing stops amounts from being negative.
+MONOTONIC_AGGREGATE_TYPES = (AggregateType.COUNT, AggregateType.DISTINCT_COUNT)
+# aggregates over a field kept as constant size running statistics
+STATS_AGGREGATE_TYPES = (
+    AggregateType.MIN,
+    AggregateType.MAX,
+    AggregateType.AVG,
+    AggregateType.VARIANCE,
+)
 
 
 @dataclass
@@ -25,8 +50,11 @@ class EventAggregateConfig:
     name: str
     event_name: str
     field: str = None
+    # only for PERCENTILE, e.g. 0.95
+    quantile: float = None
 
     def __post_init__(self):
+        self.type = AggregateType(self.type)
         if self.type == AggregateType.COUNT and self.field:
             raise ValueError("Field is not required for COUNT aggregate type.")
         elif (
@@ -36,41 +64,171 @@ class EventAggregateConfig:
             raise ValueError(
                 "Field is required for SUM or DISTINCT_COUNT aggregate type."
             )
+        elif self.type != AggregateType.COUNT and not self.field:
+            raise ValueError(f"Field is required for {self.type.name} aggregate type.")
+        if self.type == AggregateType.PERCENTILE:
+            if self.quantile is None or not 0 <= self.quantile <= 1:
+                raise ValueError("PERCENTILE needs a quantile between 0 and 1.")
+        elif self.quantile is not None:
+            raise ValueError("Quantile is only allowed for PERCENTILE aggregates.")
 
 
 class EventAggregate:
     def __init__(
-        self, name: str, event_name: str, type: AggregateType, field: str = None
+        self,
+        name: str,
+        event_name: str,
+        type: AggregateType,
+        field: str = None,
+        value_cache_size: int = DEFAULT_VALUE_CACHE_SIZE,
+        cold_store: Optional[SqliteColdStore] = None,
+        hot_size: int = DEFAULT_HOT_USERS,
+        quantile: Optional[float] = None,
     ):
         self.name = name
         self.event_name = event_name
         self.type = type
         self.field = field
+        self.quantile = quantile
         self.value = 0
-        self._store = defaultdict(self._initial_value)
+        if cold_store is None:
+            self._store = defaultdict(self._initial_value)
+        else:
+            # only the hot_size most recently used users stay in memory
+            self._store = TieredUserStore(
+                name, cold_store, self._initial_value, hot_size=hot_size
+            )
+        # materialized per user values, dropped whenever an update changes them
+        self._values = LRUCache(value_cache_size)
 
-    def update(self, user_id: str, event: Event):
+    def update(self, user_id: str, event: Union[CompactEvent, Event]) -> bool:
+        """
+        Apply the event to the user's aggregate. Returns True if the aggregate
+        value changed, so callers only need to re-evaluate dependent rules then.
+        Duplicate events are dropped at ingest, so every event counts here.
+        """
         if self.type == AggregateType.COUNT:
-            self._store[user_id].add(event.uuid) # this is a set so dedupes
+            self._store[user_id] += 1
+            changed = True
         elif self.type == AggregateType.SUM:
-            val = self._get_event_field_value(event)
-            if event.uuid not in [x[0] for x in self._store[user_id]]:
-                self._store[user_id].append((event.uuid, val))
+            self._store[user_id] += self._get_event_field_value(event)
+            changed = True
+        elif self.type == AggregateType.DISTINCT_COUNT:
+            state = self._store[user_id]
+            size = len(state)
+            state.add(self._get_event_field_value(event))
+            changed = len(state) != size
+        else:
+            # sketches are updated in place, the tiered store has to see the
+            # state as used again all the same
+            state = self._store[user_id]
+            value = self._get_event_field_value(event)
+            if self.type == AggregateType.MIN:
+                changed = value < state.min
+            elif self.type == AggregateType.MAX:
+                changed = value > state.max
+            else:
+                changed = True
+            state.add(value)
+
+        if changed:
+            self._values.pop(user_id)
+        return changed
+
+    def merge(self, user_id: str, state):
+        """
+        Merges a partial state of the user, e.g. built by another shard or
+        from a batch of events, into the user's aggregate. Only the aggregate
+        itself is updated, EventProcessor.merge_state also refreshes the
+        verdicts and grants that depend on it.
+        """
+        if self.type in (AggregateType.COUNT, AggregateType.SUM):
+            self._store[user_id] += state
         elif self.type == AggregateType.DISTINCT_COUNT:
-            self._store[user_id].add(self._get_event_field_value(event))
+            self._store[user_id].update(state)
+        else:
+            self._store[user_id].merge(state)
+        self._values.pop(user_id)
+
+    def new_state(self):
+        """
+        Empty state of one user, for building partial states to merge.
+        """
+        return self._initial_value()
 
     def get_user_aggregate(self, user_id: str):
-        if self.type == AggregateType.COUNT:
-            return len(self._store.get(user_id, set()))
+        value = self._values.get(user_id, _MISSING)
+        if value is _MISSING:
+            value = self._compute_user_aggregate(user_id)
+            self._values.set(user_id, value)
+        return value
+
+    def user_id_chunks(self, chunk_size: int) -> Iterator[List[str]]:
+        """
+        Users that have state, in memory or spilled to the cold store, in
+        chunks of up to chunk_size.
+        """
+        if isinstance(self._store, TieredUserStore):
+            yield from self._store.user_id_chunks(chunk_size)
+            return
+        user_ids = list(self._store)
+        for start in range(0, len(user_ids), chunk_size):
+            yield user_ids[start : start + chunk_size]
+
+    def peek_user_aggregates(self, user_ids: List[str]) -> List:
+        """
+        Values of the users like get_user_aggregate, for bulk reads. Neither
+        fills the value cache nor promotes cold users.
+        """
+        if isinstance(self._store, TieredUserStore):
+            states = self._store.peek_many(user_ids)
+        else:
+            states = self._store
+        return [self._value_of(states.get(user_id)) for user_id in user_ids]
+
+    def memory_usage(self) -> Dict:
+        if isinstance(self._store, TieredUserStore):
+            state = self._store.memory_usage()
+        else:
+            state = {"users": len(self._store), "bytes": estimate_size(self._store)}
+        return {"state": state, "value_cache": self._values.memory_usage()}
+
+    def tier_stats(self) -> Dict:
+        if isinstance(self._store, TieredUserStore):
+            return self._store.stats()
+        return {"hot_users": len(self._store), "cold_users": 0}
+
+    def _compute_user_aggregate(self, user_id: str):
+        return self._value_of(self._store.get(user_id))
+
+    def _value_of(self, state):
+        if state is None:
+            # users without events read 0
+            return 0
+        if self.type in (AggregateType.COUNT, AggregateType.SUM):
+            return state
         elif self.type == AggregateType.DISTINCT_COUNT:
-            return len(self._store.get(user_id, set()))
-        elif self.type == AggregateType.SUM:
-            return sum([x[1] for x in self._store.get(user_id, [])])
+            return len(state)
+        if not state.count:
+            return 0
+        if self.type == AggregateType.MIN:
+            return state.min
+        elif self.type == AggregateType.MAX:
+            return state.max
+        elif self.type == AggregateType.AVG:
+            return state.mean
+        elif self.type == AggregateType.VARIANCE:
+            return state.variance
+        elif self.type == AggregateType.PERCENTILE:
+            return state.quantile(self.quantile)
         else:
             raise ValueError("Invalid aggregate type.")
 
     def _get_event_field_value(self, event):
-        val = getattr(event.event_properties, self.field, None)
+        if isinstance(event, CompactEvent):
+            val = event.get(self.field)
+        else:
+            val = getattr(event.event_properties, self.field, None)
         if not val:
             raise AggregationError(
                 f"Field '{self.field}' not found in event properties."
@@ -78,10 +236,13 @@ class EventAggregate:
         return val
 
     def _initial_value(self):
-        if self.type in (AggregateType.DISTINCT_COUNT, AggregateType.COUNT):
+        if self.type == AggregateType.DISTINCT_COUNT:
             return set()
-        return []
-
+        elif self.type in STATS_AGGREGATE_TYPES:
+            return RunningStats()
+        elif self.type == AggregateType.PERCENTILE:
+            return TDigest()
+        return 0
 
 
 class EventAggregateStore:
@@ -108,6 +269,17 @@ class EventAggregateStore:
                 raise ValueError(f"Aggregate {name} not found.")
             return self._store[name]
 
+    def list_aggregates(self) -> List[EventAggregate]:
+        return list(self._store.values())
+
+    def memory_usage(self) -> Dict[str, Dict]:
+        return {
+            name: aggregate.memory_usage() for name, aggregate in self._store.items()
+        }
+
+    def tier_stats(self) -> Dict[str, Dict]:
+        return {name: aggregate.tier_stats() for name, aggregate in self._store.items()}
+
     def _index_on_event_name(self, aggregate: EventAggregate):
         if aggregate.event_name not in self._event_lookup:
             self._event_lookup[aggregate.event_name] = []
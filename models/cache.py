@@ -0,0 +1,59 @@
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+
+from models.memory import estimate_size
+
+
+class LRUCache:
+    """
+    Small bounded mapping that evicts the least recently used entry once
+    max_size is reached. Not thread safe, callers are expected to use it
+    from the event loop only.
+    """
+
+    def __init__(self, max_size: int):
+        if max_size <= 0:
+            raise ValueError("max_size must be a positive integer.")
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        return self._data.pop(key, default)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def memory_usage(self) -> Dict:
+        return {"entries": len(self._data), "bytes": estimate_size(self._data)}
@@ -0,0 +1,295 @@
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from models.memory import estimate_size
+from models.sketches import SKETCH_TYPES
+
+DEFAULT_HOT_USERS = 100_000
+# recent cold reads kept for the latency percentiles
+COLD_LATENCY_SAMPLES = 1024
+# stays well under sqlite's limit on query parameters
+PEEK_BATCH = 500
+
+_MISSING = object()
+
+
+class SqliteColdStore:
+    """
+    Local sqlite file holding the aggregate state of users that were demoted
+    from memory. It is a spill area for the in memory state, not a durable
+    copy of it: the file is recreated on every start.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="aggregates-", suffix=".sqlite")
+            os.close(fd)
+            self._owns_file = True
+        else:
+            self._owns_file = False
+        self.path = path
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        # losing the file on a crash is fine, the memory tier is lost as well
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute("DROP TABLE IF EXISTS aggregate_state")
+        self._conn.execute(
+            "CREATE TABLE aggregate_state ("
+            " aggregate TEXT NOT NULL,"
+            " user_id TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " PRIMARY KEY (aggregate, user_id)"
+            ") WITHOUT ROWID"
+        )
+
+    def load(self, aggregate: str, user_id: str):
+        """
+        Removes and returns the user's state, or _MISSING. The caller owns the
+        state from then on and stores it again when demoting.
+        """
+        row = self._conn.execute(
+            "DELETE FROM aggregate_state WHERE aggregate = ? AND user_id = ?"
+            " RETURNING state",
+            (aggregate, user_id),
+        ).fetchone()
+        if row is None:
+            return _MISSING
+        return self._decode(row[0])
+
+    def store(self, aggregate: str, user_id: str, state):
+        self._conn.execute(
+            "INSERT INTO aggregate_state (aggregate, user_id, state)"
+            " VALUES (?, ?, ?)"
+            " ON CONFLICT (aggregate, user_id) DO UPDATE SET state = excluded.state",
+            (aggregate, user_id, self._encode(state)),
+        )
+
+    def peek_many(self, aggregate: str, user_ids: Iterable[str]) -> Dict:
+        """
+        States of those of the users that are in the cold store, left in place.
+        """
+        user_ids = list(user_ids)
+        states = {}
+        for start in range(0, len(user_ids), PEEK_BATCH):
+            batch = user_ids[start : start + PEEK_BATCH]
+            rows = self._conn.execute(
+                "SELECT user_id, state FROM aggregate_state WHERE aggregate = ?"
+                f" AND user_id IN ({', '.join('?' * len(batch))})",
+                (aggregate, *batch),
+            )
+            for user_id, raw in rows:
+                states[user_id] = self._decode(raw)
+        return states
+
+    def user_ids(self, aggregate: str, after: str = "", limit: int = -1) -> List[str]:
+        """
+        Up to limit user ids greater than after, in order. Pages through the
+        primary key, so each page costs the same however far in it is.
+        """
+        return [
+            user_id
+            for (user_id,) in self._conn.execute(
+                "SELECT user_id FROM aggregate_state"
+                " WHERE aggregate = ? AND user_id > ? ORDER BY user_id LIMIT ?",
+                (aggregate, after, limit),
+            )
+        ]
+
+    def count(self, aggregate: str) -> int:
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM aggregate_state WHERE aggregate = ?", (aggregate,)
+        ).fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+        if self._owns_file:
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(self.path + suffix)
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def _encode(state) -> str:
+        # distinct count state is a set, sketches are tagged with their type
+        # and everything else is a number
+        if isinstance(state, set):
+            return json.dumps(list(state))
+        for name, sketch_type in SKETCH_TYPES.items():
+            if isinstance(state, sketch_type):
+                return json.dumps({"sketch": name, "state": state.to_json()})
+        return json.dumps(state)
+
+    @staticmethod
+    def _decode(raw: str):
+        state = json.loads(raw)
+        if isinstance(state, list):
+            return set(state)
+        if isinstance(state, dict):
+            return SKETCH_TYPES[state["sketch"]].from_json(state["state"])
+        return state
+
+
+class TieredUserStore:
+    """
+    Per user aggregate state with the hot_size most recently used users in
+    memory and the rest in the cold store. Used in place of the aggregate's
+    defaultdict: reading a cold user promotes it, and going over hot_size
+    demotes the least recently used one.
+    """
+
+    def __init__(
+        self,
+        aggregate_name: str,
+        cold_store: SqliteColdStore,
+        default_factory: Callable,
+        hot_size: int = DEFAULT_HOT_USERS,
+    ):
+        if hot_size < 1:
+            raise ValueError("hot_size must be at least 1.")
+        self.aggregate_name = aggregate_name
+        self.cold_store = cold_store
+        self.default_factory = default_factory
+        self.hot_size = hot_size
+        self._hot = OrderedDict()
+        # cursors of the user_id_chunks iterations in progress
+        self._scans: List["_ColdScan"] = []
+        self.promotions = 0
+        self.demotions = 0
+        self.cold_misses = 0
+        self._cold_latencies = deque(maxlen=COLD_LATENCY_SAMPLES)
+
+    def __getitem__(self, user_id: str):
+        state = self.get(user_id, _MISSING)
+        if state is _MISSING:
+            state = self.default_factory()
+            self[user_id] = state
+        return state
+
+    def __setitem__(self, user_id: str, state):
+        self._hot[user_id] = state
+        self._hot.move_to_end(user_id)
+        while len(self._hot) > self.hot_size:
+            old_user_id, old_state = self._hot.popitem(last=False)
+            self.cold_store.store(self.aggregate_name, old_user_id, old_state)
+            self.demotions += 1
+
+    def get(self, user_id: str, default=None):
+        state = self._hot.get(user_id, _MISSING)
+        if state is not _MISSING:
+            self._hot.move_to_end(user_id)
+            return state
+
+        started_at = time.perf_counter()
+        state = self.cold_store.load(self.aggregate_name, user_id)
+        self._cold_latencies.append(time.perf_counter() - started_at)
+        if state is _MISSING:
+            self.cold_misses += 1
+            return default
+        self.promotions += 1
+        for scan in self._scans:
+            scan.promoted(user_id)
+        self[user_id] = state
+        return state
+
+    def __len__(self):
+        return len(self._hot) + self.cold_store.count(self.aggregate_name)
+
+    def user_id_chunks(self, chunk_size: int) -> Iterator[List[str]]:
+        """
+        Users in chunks of up to chunk_size, the hot ones as of the call and
+        then the cold ones a page at a time. Users demoted meanwhile are not
+        repeated, cold users promoted before their page was read come last.
+        """
+        hot = list(self._hot)
+        scan = _ColdScan(set(hot))
+        self._scans.append(scan)
+        try:
+            for start in range(0, len(hot), chunk_size):
+                yield hot[start : start + chunk_size]
+            while True:
+                page = self.cold_store.user_ids(
+                    self.aggregate_name, scan.after, chunk_size
+                )
+                if not page:
+                    break
+                scan.after = page[-1]
+                chunk = [user_id for user_id in page if scan.take(user_id)]
+                if chunk:
+                    yield chunk
+            promoted = sorted(scan.pending)
+            for start in range(0, len(promoted), chunk_size):
+                yield promoted[start : start + chunk_size]
+        finally:
+            self._scans.remove(scan)
+
+    def peek_many(self, user_ids: Iterable[str]) -> Dict:
+        """
+        States of the users that have one, without promoting cold users or
+        changing the recency order, for reads that scan all users.
+        """
+        states = {}
+        cold_user_ids = []
+        for user_id in user_ids:
+            state = self._hot.get(user_id, _MISSING)
+            if state is _MISSING:
+                cold_user_ids.append(user_id)
+            else:
+                states[user_id] = state
+        if cold_user_ids:
+            states.update(
+                self.cold_store.peek_many(self.aggregate_name, cold_user_ids)
+            )
+        return states
+
+    def memory_usage(self) -> Dict:
+        return {"users": len(self._hot), "bytes": estimate_size(self._hot)}
+
+    def stats(self) -> Dict:
+        latencies = sorted(self._cold_latencies)
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1e3
+
+        return {
+            "hot_users": len(self._hot),
+            "cold_users": self.cold_store.count(self.aggregate_name),
+            "hot_size": self.hot_size,
+            "promotions": self.promotions,
+            "demotions": self.demotions,
+            "cold_misses": self.cold_misses,
+            "cold_read_ms": {
+                "p50": percentile(0.5),
+                "p99": percentile(0.99),
+                "max": latencies[-1] * 1e3 if latencies else 0.0,
+            },
+        }
+
+
+class _ColdScan:
+    """
+    Progress of one user_id_chunks iteration over the cold store. Promoting
+    a user deletes its row, so users promoted before the scan reached them
+    are kept in pending and yielded at the end.
+    """
+
+    def __init__(self, hot: set):
+        self.hot = hot
+        self.after = ""
+        self.pending = set()
+
+    def promoted(self, user_id: str):
+        if user_id not in self.hot and user_id > self.after:
+            self.pending.add(user_id)
+
+    def take(self, user_id: str) -> bool:
+        # a promoted user may be demoted again before its page is read
+        self.pending.discard(user_id)
+        return user_id not in self.hot
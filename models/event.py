@@ -1,6 +1,7 @@
+import sys
 import uuid
 from datetime import datetime
-from typing import Any
+from typing import Any, Dict, Optional
 
 from pydantic import BaseModel
 
@@ -30,3 +31,66 @@ class Event(BaseModel):
     name: str
     timestamp: datetime
     event_properties: Any
+
+
+class CompactEvent:
+    """
+    Internal representation of an accepted event while it waits in the queue
+    and is processed. Plain slotted values instead of nested pydantic models:
+    the uuid is kept as an int, the timestamp as epoch seconds and the event
+    name and user id are interned. Properties other than user_id are kept in
+    a dict, or None when the event has none. received_at is the epoch time
+    the event was accepted, set when freshness is tracked.
+    """
+
+    __slots__ = ("uuid", "name", "timestamp", "user_id", "properties", "received_at")
+
+    def __init__(
+        self,
+        uuid: int,
+        name: str,
+        timestamp: float,
+        user_id: str,
+        properties: Optional[Dict[str, Any]] = None,
+    ):
+        self.uuid = uuid
+        self.name = name
+        self.timestamp = timestamp
+        self.user_id = user_id
+        self.properties = properties
+        self.received_at: Optional[float] = None
+
+    @classmethod
+    def from_event(cls, event: Event) -> "CompactEvent":
+        return cls.from_parts(
+            event.uuid, event.name, event.timestamp.timestamp(), event.event_properties
+        )
+
+    @classmethod
+    def from_parts(
+        cls, event_id: uuid.UUID, name: str, timestamp: float, properties: Any
+    ) -> "CompactEvent":
+        if isinstance(properties, BaseModel):
+            properties = properties.model_dump()
+        else:
+            properties = dict(properties)
+        user_id = properties.pop("user_id")
+        return cls(
+            uuid=event_id.int,
+            name=sys.intern(name),
+            timestamp=timestamp,
+            user_id=sys.intern(user_id),
+            properties=properties or None,
+        )
+
+    def get(self, field: str, default: Any = None) -> Any:
+        if self.properties is None:
+            return default
+        return self.properties.get(field, default)
+
+    def __repr__(self):
+        return (
+            f"CompactEvent(uuid={self.uuid!r}, name={self.name!r}, "
+            f"timestamp={self.timestamp!r}, user_id={self.user_id!r}, "
+            f"properties={self.properties!r})"
+        )
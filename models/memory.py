@@ -0,0 +1,49 @@
+import itertools
+import sys
+from collections import deque
+
+DEFAULT_SAMPLE_SIZE = 200
+
+_ATOMIC = (str, bytes, bytearray, int, float, bool, type(None))
+_SEQUENCES = (list, tuple, set, frozenset, deque)
+
+
+def estimate_size(obj, sample_size: int = DEFAULT_SAMPLE_SIZE) -> int:
+    """
+    Approximate deep size of obj in bytes. Builtin containers and slotted
+    objects are followed, anything else counts with its shallow size so we
+    never walk from a user's state into shared objects like features or
+    rules. Containers with more than sample_size items are extrapolated from
+    their first sample_size items.
+    """
+    return _sizeof(obj, sample_size, set())
+
+
+def _sizeof(obj, sample_size: int, seen: set) -> int:
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, _ATOMIC):
+        return size
+
+    if isinstance(obj, dict):
+        items = itertools.chain.from_iterable(obj.items())
+        count = 2 * len(obj)
+    elif isinstance(obj, _SEQUENCES):
+        items = iter(obj)
+        count = len(obj)
+    elif hasattr(type(obj), "__slots__") and not hasattr(obj, "__dict__"):
+        items = (getattr(obj, slot, None) for slot in type(obj).__slots__)
+        count = len(type(obj).__slots__)
+    else:
+        return size
+
+    sampled = 0
+    sampled_size = 0
+    for item in itertools.islice(items, sample_size):
+        sampled += 1
+        sampled_size += _sizeof(item, sample_size, seen)
+    if sampled and count > sampled:
+        sampled_size = sampled_size * count // sampled
+    return size + sampled_size
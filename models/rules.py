@@ -1,11 +1,23 @@
 import asyncio
 import enum
 import logging
+import math
 import re
+import time
 from collections import defaultdict
-from typing import Union
+from typing import List, Tuple, Union
 
-from models.aggregate import EventAggregate
+from models.aggregate import MONOTONIC_AGGREGATE_TYPES, EventAggregate
+from models.cache import LRUCache
+from models.memory import estimate_size
+
+DEFAULT_VERDICT_CACHE_SIZE = 100_000
+# features re-sort their rules after this many walks
+DEFAULT_REORDER_INTERVAL = 1000
+# weight of the newest sample in the rule cost and failure rate averages
+RULE_STATS_DECAY = 0.05
+# keeps rules that never failed so far sortable
+MIN_FAILURE_RATE = 0.001
 
 
 class PlatformFeatureNotFoundError(Exception):
@@ -48,6 +60,13 @@ class Rule:
             raise ValueError(f"Aggregate2 is not required for {operation} operation.")
         elif operation == RuleOperation.VALUE and denom_min is not None:
             raise ValueError(f"Denom_min is not allowed for {operation} operation.")
+        # a VALUE rule over an aggregate that only grows by at most one per
+        # update can only flip one way, and not before the value reaches the
+        # threshold. DIVIDE rules can go either way.
+        self.monotonic = (
+            operation == RuleOperation.VALUE
+            and getattr(aggregate1, "type", None) in MONOTONIC_AGGREGATE_TYPES
+        )
 
     def _evaluate(self, user_id: str):
         self.logger.info(f"Evaluating rule {self.name} for user {user_id}")
@@ -59,27 +78,112 @@ class Rule:
                 override = True
             if denom == 0:
                 value = 0
-            value = self.aggregate1.get_user_aggregate(user_id) / denom
+            else:
+                value = self.aggregate1.get_user_aggregate(user_id) / denom
         elif self.operation == RuleOperation.VALUE:
             value = self.aggregate1.get_user_aggregate(user_id)
 
         return value, override
 
     def abides(self, user_id: str):
+        return self.abides_with_headroom(user_id)[0]
+
+    def abides_with_headroom(self, user_id: str) -> Tuple[bool, float]:
+        """
+        Returns the verdict and how many more updates of the aggregate are
+        guaranteed not to change it: math.inf once the verdict is final, 0
+        when nothing is known.
+        """
         value, override = self._evaluate(user_id)
         if override:
-            return True
+            return True, 0
         if self.condition == RuleCondition.GREATER_THAN:
-            return value > self.value
+            verdict = value > self.value
         elif self.condition == RuleCondition.LESS_THAN:
-            return value < self.value
+            verdict = value < self.value
+        return verdict, self._headroom(value, verdict)
 
+    def _headroom(self, value, verdict: bool) -> float:
+        if not self.monotonic:
+            return 0
+        if self.condition == RuleCondition.LESS_THAN:
+            if not verdict:
+                return math.inf
+            # fails once value + k >= threshold
+            return math.ceil(self.value - value) - 1
+        if verdict:
+            return math.inf
+        # abides once value + k > threshold
+        return math.floor(self.value - value)
+
+
+class RuleStats:
+    """
+    Exponentially weighted cost (seconds per evaluation, verdict cache hits
+    don't count) and failure rate (per feature walk the rule was part of) of
+    a rule.
+    """
 
-class RulesStore:
     def __init__(self):
+        self.evaluations = 0
+        self.walks = 0
+        self.cost = 0.0
+        self.failure_rate = 0.0
+
+    def record_cost(self, seconds: float):
+        self.evaluations += 1
+        if self.evaluations == 1:
+            self.cost = seconds
+            return
+        self.cost += RULE_STATS_DECAY * (seconds - self.cost)
+
+    def record_verdict(self, verdict: bool):
+        self.walks += 1
+        failed = 0.0 if verdict else 1.0
+        if self.walks == 1:
+            self.failure_rate = failed
+            return
+        self.failure_rate += RULE_STATS_DECAY * (failed - self.failure_rate)
+
+    def rank(self) -> float:
+        # for a chain of ANDed rules, running them by increasing
+        # cost / P(fail) minimizes the expected cost of the walk
+        if not self.walks:
+            return 0.0
+        return self.cost / max(self.failure_rate, MIN_FAILURE_RATE)
+
+    def stats(self) -> dict:
+        return {
+            "evaluations": self.evaluations,
+            "walks": self.walks,
+            "cost_us": self.cost * 1e6,
+            "failure_rate": self.failure_rate,
+            "rank": self.rank(),
+        }
+
+
+class RulesStore:
+    def __init__(
+        self,
+        verdict_cache_size: int = DEFAULT_VERDICT_CACHE_SIZE,
+        reorder_interval: int = DEFAULT_REORDER_INTERVAL,
+    ):
         self.rules = {}
         self._rules_by_aggregate = defaultdict(list)
         self._lock = asyncio.Lock()
+        # (user_id, rule name) -> last verdict. Entries are dropped through the
+        # aggregate index whenever one of the rule's aggregates changes.
+        self._verdicts = LRUCache(verdict_cache_size)
+        # (user_id, rule name) -> updates that can't change the verdict of a
+        # monotonic rule, math.inf when it is final
+        self._headroom = LRUCache(verdict_cache_size)
+        self.evaluations = 0
+        self.skipped_final = 0
+        self.skipped_headroom = 0
+        self.reorder_interval = reorder_interval
+        self._rule_stats = defaultdict(RuleStats)
+        self._feature_orders = {}
+        self._feature_walks = defaultdict(int)
 
     def add_rule(self, rule: Rule):
         if rule.name in self.rules:
@@ -99,6 +203,111 @@ class RulesStore:
         async with self._lock:
             return self._rules_by_aggregate[name]
 
+    def abides(self, rule: Rule, user_id: str, record_stats: bool = True) -> bool:
+        """
+        The user's verdict, from the cache when possible. Lookups that aren't
+        part of live processing, like shadow rules, pass record_stats=False.
+        """
+        key = (user_id, rule.name)
+        verdict = self._verdicts.get(key)
+        if verdict is None:
+            started_at = time.perf_counter()
+            verdict, headroom = rule.abides_with_headroom(user_id)
+            self._verdicts.set(key, verdict)
+            if headroom > 0:
+                self._headroom.set(key, headroom)
+            if record_stats:
+                self.evaluations += 1
+                self._rule_stats[rule.name].record_cost(
+                    time.perf_counter() - started_at
+                )
+        return verdict
+
+    def walk_feature(self, feature: "PlatformFeature", user_id: str) -> bool:
+        """
+        Whether the user abides by every rule of the feature, stopping at the
+        first one that fails. Every rule looked up counts once towards its
+        failure rate.
+        """
+        for rule in self.ordered_rules(feature):
+            verdict = self.abides(rule, user_id)
+            self._rule_stats[rule.name].record_verdict(verdict)
+            if not verdict:
+                return False
+        return True
+
+    def ordered_rules(self, feature: "PlatformFeature") -> List[Rule]:
+        """
+        The feature's rules, cheapest and most likely to fail first. A feature
+        is the AND of its rules so the order never changes the verdict, only
+        how early a walk can stop.
+        """
+        walks = self._feature_walks[feature.name]
+        self._feature_walks[feature.name] = walks + 1
+        order = self._feature_orders.get(feature.name)
+        if order is None or walks % self.reorder_interval == 0:
+            order = sorted(
+                feature.rules, key=lambda rule: self._rule_stats[rule.name].rank()
+            )
+            self._feature_orders[feature.name] = order
+        return order
+
+    def ordering_stats(self) -> dict:
+        return {
+            "rules": {name: stats.stats() for name, stats in self._rule_stats.items()},
+            "features": {
+                name: [rule.name for rule in order]
+                for name, order in self._feature_orders.items()
+            },
+        }
+
+    def memory_usage(self) -> dict:
+        return {"verdict_cache": self._verdicts.memory_usage()}
+
+    def invalidate(
+        self, user_id: str, aggregate_name: str, merged: bool = False
+    ) -> List[Rule]:
+        """
+        Called after the user's aggregate changed. Returns the rules whose
+        verdict may have changed, their cached verdicts are dropped. Rules
+        that are decided for good or still have headroom keep their verdict.
+        A merged state may count as any number of updates, so merged=True
+        drops the headroom too and returns every dependent rule.
+        """
+        stale = []
+        for rule in self._rules_by_aggregate.get(aggregate_name, ()):
+            key = (user_id, rule.name)
+            if merged:
+                self._headroom.pop(key)
+                self._verdicts.pop(key)
+                stale.append(rule)
+                continue
+            headroom = self._headroom.get(key, 0)
+            if headroom == math.inf:
+                self.skipped_final += 1
+                continue
+            if headroom > 1:
+                self._headroom.set(key, headroom - 1)
+                self.skipped_headroom += 1
+                continue
+            if headroom:
+                self._headroom.pop(key)
+                self.skipped_headroom += 1
+                continue
+            self._verdicts.pop(key)
+            stale.append(rule)
+        return stale
+
+    def pruning_stats(self) -> dict:
+        return {
+            "evaluations": self.evaluations,
+            "skipped_final": self.skipped_final,
+            "skipped_headroom": self.skipped_headroom,
+            "monotonic_rules": sorted(
+                name for name, rule in self.rules.items() if rule.monotonic
+            ),
+        }
+
 
 class PlatformFeature:
     def __init__(self, name, rules):
@@ -119,3 +328,9 @@ class PlatformFeature:
     async def can_access(self, user_id):
         async with self._lock:
             return self._user_flags[user_id]
+
+    def memory_usage(self) -> dict:
+        return {
+            "users": len(self._user_flags),
+            "bytes": estimate_size(self._user_flags),
+        }
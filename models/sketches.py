@@ -0,0 +1,206 @@
+import math
+from array import array
+from typing import Dict, List
+
+DEFAULT_COMPRESSION = 100
+
+
+class RunningStats:
+    """
+    Count, min, max, mean and variance of a stream of numbers in constant
+    memory. Welford's update for single values, Chan's formula to merge two
+    partial states, e.g. of different shards or batches.
+    """
+
+    __slots__ = ("count", "mean", "min", "max", "_m2")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._m2 = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "RunningStats"):
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self._m2 += other._m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def variance(self) -> float:
+        # population variance, 0 until there are two values
+        return self._m2 / self.count if self.count else 0.0
+
+    def to_json(self) -> Dict:
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "m2": self._m2,
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict) -> "RunningStats":
+        stats = cls()
+        stats.count = data["count"]
+        stats.mean = data["mean"]
+        stats._m2 = data["m2"]
+        if stats.count:
+            stats.min = data["min"]
+            stats.max = data["max"]
+        return stats
+
+
+class TDigest:
+    """
+    Merging t-digest (Dunning & Ertl): a quantile sketch of at most about
+    `compression` weighted centroids, small near the tails so extreme
+    quantiles stay accurate. New values are buffered and folded in together.
+    Two digests merge by folding one's centroids into the other.
+    """
+
+    __slots__ = (
+        "compression",
+        "count",
+        "min",
+        "max",
+        "_means",
+        "_weights",
+        "_buffer",
+    )
+
+    def __init__(self, compression: float = DEFAULT_COMPRESSION):
+        self.compression = compression
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self._means = array("d")
+        self._weights = array("d")
+        self._buffer: List[float] = []
+
+    def add(self, value: float):
+        self.count += 1
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self._buffer.append(value)
+        if len(self._buffer) >= self.compression:
+            self._compress()
+
+    def merge(self, other: "TDigest"):
+        if not other.count:
+            return
+        other._compress()
+        self._compress(list(zip(other._means, other._weights)))
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        if not 0 <= q <= 1:
+            raise ValueError("Quantile must be between 0 and 1.")
+        if not self.count:
+            return 0.0
+        self._compress()
+        means, weights = self._means, self._weights
+        if len(means) == 1:
+            return means[0]
+
+        target = q * self.count
+        # centroid i covers the ranks around its center at
+        # sum(weights[:i]) + weights[i] / 2, interpolate between centers
+        first_center = weights[0] / 2
+        if target <= first_center:
+            return self.min + (means[0] - self.min) * target / first_center
+        cumulative = 0.0
+        for i in range(len(means) - 1):
+            center = cumulative + weights[i] / 2
+            next_center = cumulative + weights[i] + weights[i + 1] / 2
+            if target <= next_center:
+                fraction = (target - center) / (next_center - center)
+                return means[i] + (means[i + 1] - means[i]) * fraction
+            cumulative += weights[i]
+        last_center = self.count - weights[-1] / 2
+        fraction = (target - last_center) / (self.count - last_center)
+        return means[-1] + (self.max - means[-1]) * fraction
+
+    def centroids(self) -> int:
+        self._compress()
+        return len(self._means)
+
+    def to_json(self) -> Dict:
+        self._compress()
+        return {
+            "compression": self.compression,
+            "count": self.count,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "means": list(self._means),
+            "weights": list(self._weights),
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict) -> "TDigest":
+        digest = cls(data["compression"])
+        digest.count = data["count"]
+        if digest.count:
+            digest.min = data["min"]
+            digest.max = data["max"]
+        digest._means = array("d", data["means"])
+        digest._weights = array("d", data["weights"])
+        return digest
+
+    def _compress(self, extra=()):
+        if not self._buffer and not extra:
+            return
+        items = list(zip(self._means, self._weights))
+        items.extend((value, 1.0) for value in self._buffer)
+        items.extend(extra)
+        items.sort()
+        self._buffer = []
+
+        total = sum(weight for _, weight in items)
+        means = array("d")
+        weights = array("d")
+        mean, weight = items[0]
+        so_far = 0.0
+        limit = total * self._q_limit(0.0)
+        for next_mean, next_weight in items[1:]:
+            if so_far + weight + next_weight <= limit:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                so_far += weight
+                limit = total * self._q_limit(so_far / total)
+                mean, weight = next_mean, next_weight
+        means.append(mean)
+        weights.append(weight)
+        self._means, self._weights = means, weights
+
+    def _q_limit(self, q: float) -> float:
+        # k1 scale function, k(q) = compression / 2pi * asin(2q - 1). A
+        # centroid starting at q may grow until k has gone up by one.
+        q = min(q, 1.0)
+        k = self.compression / (2 * math.pi) * math.asin(2 * q - 1) + 1
+        if k >= self.compression / 4:
+            return 1.0
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+
+SKETCH_TYPES = {"running_stats": RunningStats, "tdigest": TDigest}
@@ -0,0 +1,74 @@
+import asyncio
+import time
+import zlib
+from typing import Dict
+
+DEFAULT_NUM_STRIPES = 64
+
+
+class LockStripe:
+    """
+    asyncio.Lock that counts how often it was already taken when acquired
+    and how long those acquisitions waited.
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_seconds = 0.0
+
+    async def __aenter__(self):
+        self.acquisitions += 1
+        if not self._lock.locked():
+            await self._lock.acquire()
+            return self
+        self.contended += 1
+        started_at = time.perf_counter()
+        await self._lock.acquire()
+        self.wait_seconds += time.perf_counter() - started_at
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._lock.release()
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def stats(self) -> Dict:
+        return {
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "wait_seconds": self.wait_seconds,
+        }
+
+
+class StripedLocks:
+    """
+    Fixed set of locks keyed by user id hash, callers keep the state guarded
+    by stripe i in their own i-th shard.
+    """
+
+    def __init__(self, num_stripes: int = DEFAULT_NUM_STRIPES):
+        if num_stripes < 1:
+            raise ValueError("num_stripes must be at least 1.")
+        self.stripes = [LockStripe() for _ in range(num_stripes)]
+
+    def __len__(self):
+        return len(self.stripes)
+
+    def index_for(self, key: str) -> int:
+        return zlib.crc32(key.encode()) % len(self.stripes)
+
+    def stripe_for(self, key: str) -> LockStripe:
+        return self.stripes[self.index_for(key)]
+
+    def stats(self) -> Dict:
+        per_stripe = [stripe.stats() for stripe in self.stripes]
+        return {
+            "stripes": len(self.stripes),
+            "acquisitions": sum(s["acquisitions"] for s in per_stripe),
+            "contended": sum(s["contended"] for s in per_stripe),
+            "wait_seconds": sum(s["wait_seconds"] for s in per_stripe),
+            "per_stripe": per_stripe,
+        }
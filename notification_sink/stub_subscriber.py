@@ -0,0 +1,187 @@
+"""
+Local stand-in for a notification subscriber, used to benchmark the
+notification delivery engine without any network dependency.
+
+    python -m notification_sink.stub_subscriber serve --port 8081
+    python -m notification_sink.stub_subscriber bench --notifications 100000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from services.notification_transport import NotificationDeliveryEngine
+
+
+class StubSubscriberServer:
+    """
+    Minimal keep-alive HTTP/1.1 server that accepts POSTed json batches and
+    counts them. Every fail_every-th request is answered with a 503 so retry
+    paths can be exercised. With keep_notifications the accepted ones are
+    kept in received, in the order they arrived.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        fail_every: int = 0,
+        keep_notifications: bool = False,
+    ):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.fail_every = fail_every
+        self.keep_notifications = keep_notifications
+        self.received = []
+        self.requests = 0
+        self.notifications = 0
+        self.connections = 0
+        self._server = None
+        self._handlers = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self._server.close()
+        for task in self._handlers:
+            task.cancel()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        await self._server.wait_closed()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/event"
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                content_length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    if name.strip().lower() == "content-length":
+                        content_length = int(value)
+                body = await reader.readexactly(content_length)
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+
+                self.requests += 1
+                if self.fail_every and self.requests % self.fail_every == 0:
+                    status = b"503 Service Unavailable"
+                else:
+                    status = b"200 OK"
+                    payload = json.loads(body) if body else []
+                    if not isinstance(payload, list):
+                        payload = [payload]
+                    self.notifications += len(payload)
+                    if self.keep_notifications:
+                        self.received.extend(payload)
+                writer.write(
+                    b"HTTP/1.1 " + status + b"\r\nContent-Length: 0\r\n\r\n"
+                )
+                await writer.drain()
+        except (
+            asyncio.IncompleteReadError,
+            ConnectionError,
+            asyncio.CancelledError,
+        ):
+            pass
+        finally:
+            self._handlers.discard(task)
+            writer.close()
+
+
+async def serve(args):
+    server = StubSubscriberServer(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        fail_every=args.fail_every,
+    )
+    await server.start()
+    print(f"stub subscriber listening on {server.url}")
+    last = 0
+    while True:
+        await asyncio.sleep(1)
+        print(
+            f"{server.notifications - last} notifications/s "
+            f"({server.requests} requests, {server.connections} connections)"
+        )
+        last = server.notifications
+
+
+async def bench(args):
+    server = StubSubscriberServer(latency=args.latency, fail_every=args.fail_every)
+    await server.start()
+    engine = NotificationDeliveryEngine(
+        max_connections_per_subscriber=args.connections,
+        batch_size=args.batch_size,
+        backoff_base=0.01,
+    )
+    runner = asyncio.create_task(engine.run())
+
+    start = time.perf_counter()
+    for i in range(args.notifications):
+        engine.enqueue(
+            server.url,
+            {
+                "name": "access_revoked",
+                "uuid": str(uuid.uuid4()),
+                "event_properties": {"user_id": f"user{i}", "feature": "purchase"},
+            },
+        )
+        if i % 1000 == 0:
+            # let the delivery task run like it would between events
+            await asyncio.sleep(0)
+    await engine.flush()
+    elapsed = time.perf_counter() - start
+
+    runner.cancel()
+    await asyncio.gather(runner, return_exceptions=True)
+    await engine.close()
+    await server.close()
+    print(
+        f"delivered {server.notifications} notifications in {elapsed:.2f}s "
+        f"({server.notifications / elapsed:.0f}/s) over {server.requests} requests "
+        f"and {server.connections} connections"
+    )
+    print(engine.stats())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8081)
+
+    bench_parser = subparsers.add_parser("bench")
+    bench_parser.add_argument("--notifications", type=int, default=100_000)
+    bench_parser.add_argument("--batch-size", type=int, default=100)
+    bench_parser.add_argument("--connections", type=int, default=8)
+
+    for p in (serve_parser, bench_parser):
+        p.add_argument("--latency", type=float, default=0.0)
+        p.add_argument("--fail-every", type=int, default=0)
+
+    args = parser.parse_args()
+    asyncio.run(serve(args) if args.command == "serve" else bench(args))
+
+
+if __name__ == "__main__":
+    main()
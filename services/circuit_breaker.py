@@ -0,0 +1,180 @@
+import logging
+import time
+import zlib
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from models.memory import estimate_size
+
+
+@dataclass
+class CircuitBreakerConfig:
+    # open the circuit when more than this fraction of the users seen in the
+    # window were denied
+    threshold: float = 0.05
+    window_seconds: float = 600
+    # don't judge a segment on fewer distinct users than this
+    min_users: int = 1
+    # users are hashed into this many independently broken segments
+    segments: int = 1
+
+    def __post_init__(self):
+        if not 0 <= self.threshold <= 1:
+            raise ValueError("threshold must be between 0 and 1.")
+        if self.window_seconds <= 0:
+            raise ValueError("window_seconds must be positive.")
+        if self.segments < 1:
+            raise ValueError("segments must be at least 1.")
+
+
+def segment_index(user_id: str, segments: int) -> int:
+    if segments <= 1:
+        return 0
+    return zlib.crc32(user_id.encode()) % segments
+
+
+class SegmentCircuit:
+    """
+    Sliding window of access attempts of one segment of users. Distinct user
+    counts are kept as per user attempt counters so expiring an old attempt
+    doesn't forget a user that was seen again since.
+    """
+
+    def __init__(self):
+        self.closed = True
+        self._window = deque()  # (timestamp, user_id, success)
+        self._attempts = Counter()
+        self._denials = Counter()
+
+    def record(self, user_id: str, success: bool, now: float, cutoff: float):
+        self._window.append((now, user_id, success))
+        self._attempts[user_id] += 1
+        if not success:
+            self._denials[user_id] += 1
+        self.expire(cutoff)
+
+    def expire(self, cutoff: float) -> int:
+        expired = 0
+        while self._window and self._window[0][0] < cutoff:
+            expired += 1
+            _, old_user_id, old_success = self._window.popleft()
+            self._decrement(self._attempts, old_user_id)
+            if not old_success:
+                self._decrement(self._denials, old_user_id)
+        return expired
+
+    @property
+    def total_users(self) -> int:
+        return len(self._attempts)
+
+    @property
+    def denied_users(self) -> int:
+        return len(self._denials)
+
+    def denial_rate(self) -> float:
+        total = len(self._attempts)
+        return len(self._denials) / total if total else 0.0
+
+    @staticmethod
+    def _decrement(counter: Counter, user_id: str):
+        counter[user_id] -= 1
+        if counter[user_id] <= 0:
+            del counter[user_id]
+
+
+class FeatureCircuitBreaker:
+    """
+    Circuit breaker of a single feature. The state of a segment is
+    re-evaluated on every access attempt recorded for it and whenever it is
+    checked, so a circuit opens or closes as soon as the denial rate crosses
+    the threshold, or the denials leave the window. A segment with fewer than
+    min_users users in its window is closed.
+    """
+
+    def __init__(
+        self,
+        feature_name: str,
+        config: CircuitBreakerConfig,
+        logger: logging.Logger = logging.getLogger(__name__),
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.feature_name = feature_name
+        self.config = config
+        self.logger = logger
+        self.clock = clock
+        self.segments = [SegmentCircuit() for _ in range(config.segments)]
+        self.transitions = 0
+
+    def segment_for(self, user_id: str) -> SegmentCircuit:
+        return self.segments[segment_index(user_id, len(self.segments))]
+
+    def is_closed(self, user_id: str, now: Optional[float] = None) -> bool:
+        now = self.clock() if now is None else now
+        segment = self.segment_for(user_id)
+        # attempts may have left the window since the last one was recorded
+        if segment.expire(now - self.config.window_seconds):
+            self._evaluate(segment)
+        return segment.closed
+
+    def expire(self, now: Optional[float] = None):
+        """
+        Re-evaluates every segment whose attempts left the window, for
+        publishing the state of all of them at once.
+        """
+        now = self.clock() if now is None else now
+        for segment in self.segments:
+            if segment.expire(now - self.config.window_seconds):
+                self._evaluate(segment)
+
+    def record(self, user_id: str, success: bool, now: Optional[float] = None) -> bool:
+        """
+        Records an access attempt, returns whether the circuit of the user's
+        segment opened or closed because of it.
+        """
+        now = self.clock() if now is None else now
+        segment = self.segment_for(user_id)
+        segment.record(user_id, success, now, now - self.config.window_seconds)
+        return self._evaluate(segment)
+
+    def _evaluate(self, segment: SegmentCircuit) -> bool:
+        closed = (
+            segment.total_users < self.config.min_users
+            or segment.denial_rate() <= self.config.threshold
+        )
+        if closed == segment.closed:
+            return False
+        segment.closed = closed
+        self.transitions += 1
+        self.logger.info(
+            f"{'Closing' if closed else 'Breaking'} circuit for {self.feature_name}"
+            f" segment {self.segments.index(segment)},"
+            f" denial rate {segment.denial_rate():.3f}"
+        )
+        return True
+
+    def memory_usage(self) -> Dict:
+        windows = [
+            (segment._window, segment._attempts, segment._denials)
+            for segment in self.segments
+        ]
+        return {
+            "entries": sum(len(segment._window) for segment in self.segments),
+            "bytes": estimate_size(windows),
+        }
+
+    def stats(self) -> Dict:
+        return {
+            "threshold": self.config.threshold,
+            "window_seconds": self.config.window_seconds,
+            "transitions": self.transitions,
+            "open_segments": sum(not segment.closed for segment in self.segments),
+            "segments": [
+                {
+                    "closed": segment.closed,
+                    "total_users": segment.total_users,
+                    "denied_users": segment.denied_users,
+                }
+                for segment in self.segments
+            ],
+        }
@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from services.event_processer import EventConsumer
+
+# decisions kept for GET /consumer-pool
+DECISION_HISTORY = 50
+# a scale up has to raise throughput by this much to count as helping
+MIN_SCALE_UP_GAIN = 1.1
+# weight of the latest interval in the service time average
+SERVICE_TIME_SMOOTHING = 0.3
+
+
+@dataclass
+class AutoscaleConfig:
+    min_consumers: int = 1
+    max_consumers: int = 16
+    # seconds between decisions
+    interval: float = 1.0
+    # fraction of the time consumers should be busy at the current arrival
+    # rate, leaves headroom for bursts
+    target_utilization: float = 0.7
+    # a backlog should be worked off within this many seconds
+    drain_seconds: float = 2.0
+    # consumers are only retired once fewer were needed for this long
+    scale_down_after: float = 30.0
+
+    def __post_init__(self):
+        if self.min_consumers < 1:
+            raise ValueError("min_consumers must be at least 1.")
+        if self.max_consumers < self.min_consumers:
+            raise ValueError("max_consumers can't be less than min_consumers.")
+        if not 0 < self.target_utilization <= 1:
+            raise ValueError("target_utilization must be between 0 and 1.")
+        if self.interval <= 0 or self.drain_seconds <= 0:
+            raise ValueError("interval and drain_seconds must be positive.")
+
+
+class _Worker:
+    __slots__ = ("task", "idle", "retiring")
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.idle = True
+        self.retiring = False
+
+
+class ConsumerPool:
+    """
+    Runs the consumer tasks and resizes the pool every interval. By Little's
+    law arrival rate * service time consumers are busy on average, the pool
+    is sized for that at target_utilization plus enough to work off the
+    current backlog within drain_seconds.
+
+    All consumers share one event loop, so extra consumers only help while
+    events wait on locks or I/O. When a scale up doesn't raise throughput
+    the pool goes back to the previous size and holds there until the
+    backlog is gone.
+    """
+
+    def __init__(
+        self,
+        consumer: EventConsumer,
+        logger: logging.Logger,
+        config: Optional[AutoscaleConfig] = None,
+        initial_consumers: Optional[int] = None,
+        clock=time.monotonic,
+    ):
+        self.consumer = consumer
+        self.queue = consumer.queue
+        self.logger = logger
+        self.config = config or AutoscaleConfig()
+        self.initial_consumers = initial_consumers or self.config.min_consumers
+        self.clock = clock
+        self._workers: List[_Worker] = []
+        self._controller: Optional[asyncio.Task] = None
+        self.processed = 0
+        self.busy_seconds = 0.0
+        self.decisions = deque(maxlen=DECISION_HISTORY)
+        self.saturated = False
+        self.service_time: Optional[float] = None
+        self.arrival_rate = 0.0
+        self.completion_rate = 0.0
+        self._last_tick: Optional[tuple] = None
+        self._last_scale_up: Optional[Dict] = None
+        self._lower_since: Optional[float] = None
+        self._lower_peak = 0
+
+    @property
+    def size(self) -> int:
+        return sum(not worker.retiring for worker in self._workers)
+
+    def start(self):
+        self.resize(self._clamp(self.initial_consumers))
+        self._last_tick = self._measure()
+        self._controller = asyncio.create_task(self._control())
+
+    async def close(self):
+        tasks = [worker.task for worker in self._workers]
+        if self._controller:
+            tasks.append(self._controller)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def resize(self, size: int):
+        active = [worker for worker in self._workers if not worker.retiring]
+        for _ in range(size - len(active)):
+            worker = _Worker()
+            worker.task = asyncio.create_task(self._work(worker))
+            self._workers.append(worker)
+        # idle consumers are waiting in get() and can be cancelled right away,
+        # busy ones finish their event first
+        active.sort(key=lambda worker: not worker.idle)
+        for worker in active[: max(0, len(active) - size)]:
+            worker.retiring = True
+            if worker.idle:
+                worker.task.cancel()
+
+    def evaluate(self) -> int:
+        """
+        Takes the measurements since the last call and resizes the pool.
+        Returns the new size.
+        """
+        now, enqueued, processed, busy_seconds = tick = self._measure()
+        last_at, last_enqueued, last_processed, last_busy = self._last_tick
+        self._last_tick = tick
+        elapsed = now - last_at
+        if elapsed <= 0:
+            return self.size
+        self.arrival_rate = (enqueued - last_enqueued) / elapsed
+        self.completion_rate = (processed - last_processed) / elapsed
+        if processed > last_processed:
+            latest = (busy_seconds - last_busy) / (processed - last_processed)
+            if self.service_time is None:
+                self.service_time = latest
+            else:
+                self.service_time += SERVICE_TIME_SMOOTHING * (
+                    latest - self.service_time
+                )
+
+        depth = self.queue.qsize()
+        if not depth:
+            self.saturated = False
+        desired = self._clamp(self._desired(depth))
+        size = self.size
+        scale_up = self._last_scale_up
+        self._last_scale_up = None
+
+        if scale_up and depth and (
+            self.completion_rate < scale_up["completion_rate"] * MIN_SCALE_UP_GAIN
+        ):
+            self.saturated = True
+            return self._decide(now, scale_up["from"], "saturated", desired, depth)
+        if desired > size:
+            self._lower_since = None
+            if self.saturated:
+                return size
+            # at most double per interval so a useless scale up is noticed
+            # before it goes all the way to max_consumers
+            target = min(desired, max(size * 2, size + 1))
+            self._last_scale_up = {
+                "from": size,
+                "completion_rate": self.completion_rate,
+            }
+            return self._decide(now, target, "scale_up", desired, depth)
+        if desired < size:
+            if self._lower_since is None:
+                self._lower_since = now
+                self._lower_peak = desired
+            self._lower_peak = max(self._lower_peak, desired)
+            if now - self._lower_since >= self.config.scale_down_after:
+                self._lower_since = None
+                return self._decide(
+                    now, self._lower_peak, "scale_down", desired, depth
+                )
+            return size
+        self._lower_since = None
+        return size
+
+    def stats(self) -> Dict:
+        return {
+            "consumers": self.size,
+            "min_consumers": self.config.min_consumers,
+            "max_consumers": self.config.max_consumers,
+            "busy": sum(not worker.idle for worker in self._workers),
+            "queue_depth": self.queue.qsize(),
+            "arrival_rate": self.arrival_rate,
+            "completion_rate": self.completion_rate,
+            "service_time_ms": (
+                None if self.service_time is None else self.service_time * 1e3
+            ),
+            "saturated": self.saturated,
+            "processed": self.processed,
+            "decisions": list(self.decisions),
+        }
+
+    def _desired(self, depth: int) -> int:
+        if self.service_time is None:
+            return self.size if depth else self.config.min_consumers
+        config = self.config
+        steady = self.arrival_rate * self.service_time / config.target_utilization
+        backlog = depth * self.service_time / config.drain_seconds
+        return math.ceil(steady + backlog)
+
+    def _clamp(self, size: int) -> int:
+        return max(self.config.min_consumers, min(self.config.max_consumers, size))
+
+    def _decide(self, now, size: int, reason: str, desired: int, depth: int) -> int:
+        self.decisions.append(
+            {
+                "at": now,
+                "from": self.size,
+                "to": size,
+                "reason": reason,
+                "desired": desired,
+                "queue_depth": depth,
+                "arrival_rate": round(self.arrival_rate, 1),
+                "completion_rate": round(self.completion_rate, 1),
+            }
+        )
+        self.logger.info(f"consumer pool {self.size} -> {size}: {reason}")
+        self.resize(size)
+        return size
+
+    def _measure(self) -> tuple:
+        return (self.clock(), self.queue.enqueued, self.processed, self.busy_seconds)
+
+    async def _control(self):
+        while True:
+            await asyncio.sleep(self.config.interval)
+            try:
+                self.evaluate()
+            except Exception as e:
+                self.logger.error(f"consumer pool controller error: {e}")
+
+    async def _work(self, worker: _Worker):
+        try:
+            while not worker.retiring:
+                worker.idle = True
+                user_id, item = await self.queue.get()
+                worker.idle = False
+                started_at = time.perf_counter()
+                await self.consumer.handle(user_id, item)
+                self.busy_seconds += time.perf_counter() - started_at
+                self.processed += 1
+        finally:
+            worker.idle = True
+            self._workers.remove(worker)
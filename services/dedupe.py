@@ -0,0 +1,173 @@
+import hashlib
+import math
+import time
+import uuid
+from collections import deque
+from typing import Callable
+
+from models.memory import estimate_size
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        if capacity <= 0:
+            raise ValueError("Bloom filter capacity must be positive.")
+        if not 0 < error_rate < 1:
+            raise ValueError("Bloom filter error rate must be between 0 and 1.")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def add(self, key: bytes):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def is_full(self) -> bool:
+        return self.count >= self.capacity
+
+    def _positions(self, key: bytes):
+        # double hashing, two 64 bit halves of a single digest
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(
+            self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key)
+        )
+
+
+class EventDeduplicator:
+    """
+    Drops events whose uuid was already seen at ingest.
+
+    Recent uuids are kept exactly in time partitioned sets, and every uuid
+    also goes into a Bloom filter as it is recorded, so a partition falling
+    out of the window is just dropped. Filters rotate once they reach capacity
+    and only the last `bloom_generations` are kept, so memory is bounded by
+    the window plus the filters. Hits on the filters can be false positives at
+    roughly `bloom_error_rate` per filter.
+
+    Ingest only reserves a uuid, it is recorded once the event was processed.
+    A reserved uuid counts as seen, so a retry can't be applied twice while
+    the first copy is queued, and releasing it after a failed event lets a
+    retry through.
+    """
+
+    def __init__(
+        self,
+        bucket_seconds: float = 60,
+        num_buckets: int = 10,
+        bloom_capacity: int = 1_000_000,
+        bloom_error_rate: float = 0.001,
+        bloom_generations: int = 2,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if bucket_seconds <= 0 or num_buckets <= 0 or bloom_generations <= 0:
+            raise ValueError(
+                "bucket_seconds, num_buckets and bloom_generations must be positive."
+            )
+        self.bucket_seconds = bucket_seconds
+        self.num_buckets = num_buckets
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self.bloom_generations = bloom_generations
+        self._clock = clock
+        self._buckets = deque()  # (bucket id, set of uuid bytes)
+        self._blooms = deque([self._new_bloom()])
+        # uuids of events accepted but not processed yet
+        self._reserved = set()
+        self.exact_duplicates = 0
+        self.probable_duplicates = 0
+
+    def check_and_add(self, event_id: uuid.UUID) -> bool:
+        """
+        Returns True if the event was seen before, otherwise records it.
+        """
+        if self.check_and_reserve(event_id):
+            return True
+        self.commit(event_id)
+        return False
+
+    def check_and_reserve(self, event_id: uuid.UUID) -> bool:
+        """
+        Returns True if the event was seen before or is reserved, otherwise
+        reserves it until commit or release.
+        """
+        self._rotate(self._clock())
+        key = event_id.bytes
+        if key in self._reserved:
+            self.exact_duplicates += 1
+            return True
+        for _, seen in self._buckets:
+            if key in seen:
+                self.exact_duplicates += 1
+                return True
+        for bloom in self._blooms:
+            if key in bloom:
+                self.probable_duplicates += 1
+                return True
+        self._reserved.add(key)
+        return False
+
+    def commit(self, event_id: uuid.UUID):
+        """
+        Records a reserved event as seen, once it was processed.
+        """
+        self._rotate(self._clock())
+        key = event_id.bytes
+        self._reserved.discard(key)
+        self._buckets[-1][1].add(key)
+        self._add_to_bloom(key)
+
+    def release(self, event_id: uuid.UUID):
+        """
+        Forgets a reserved event that failed, so a retry is accepted.
+        """
+        self._reserved.discard(event_id.bytes)
+
+    def stats(self) -> dict:
+        return {
+            "recent_ids": sum(len(seen) for _, seen in self._buckets),
+            "recent_buckets": len(self._buckets),
+            "reserved_ids": len(self._reserved),
+            "bloom_filters": len(self._blooms),
+            "bloom_ids": sum(bloom.count for bloom in self._blooms),
+            "bloom_bytes": sum(len(bloom._bits) for bloom in self._blooms),
+            "exact_duplicates": self.exact_duplicates,
+            "probable_duplicates": self.probable_duplicates,
+        }
+
+    def memory_usage(self) -> dict:
+        return {
+            "recent_ids": sum(len(seen) for _, seen in self._buckets),
+            "recent_bytes": estimate_size(self._buckets),
+            "reserved_bytes": estimate_size(self._reserved),
+            "bloom_bytes": sum(len(bloom._bits) for bloom in self._blooms),
+        }
+
+    def _rotate(self, now: float):
+        bucket_id = int(now // self.bucket_seconds)
+        if not self._buckets or self._buckets[-1][0] != bucket_id:
+            self._buckets.append((bucket_id, set()))
+        # the expired uuids are in the filters already
+        while self._buckets[0][0] <= bucket_id - self.num_buckets:
+            self._buckets.popleft()
+
+    def _add_to_bloom(self, key: bytes):
+        bloom = self._blooms[-1]
+        if bloom.is_full():
+            bloom = self._new_bloom()
+            self._blooms.append(bloom)
+            if len(self._blooms) > self.bloom_generations:
+                self._blooms.popleft()
+        bloom.add(key)
+
+    def _new_bloom(self) -> BloomFilter:
+        return BloomFilter(self.bloom_capacity, self.bloom_error_rate)
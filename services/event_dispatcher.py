@@ -0,0 +1,199 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from models.event import CompactEvent
+from models.memory import estimate_size
+
+DEFAULT_LANE = "default"
+# recent queue waits kept per lane for the percentiles
+WAIT_SAMPLES = 1024
+
+
+@dataclass
+class EventLane:
+    name: str
+    # share of dequeues the lane gets while other lanes have events too
+    weight: float = 1
+    event_names: List[str] = field(default_factory=list)
+    # queue wait the lane should stay under, only reported against
+    wait_target_ms: Optional[float] = None
+
+    def __post_init__(self):
+        if self.weight <= 0:
+            raise ValueError("Lane weight must be positive.")
+
+
+class LaneStats:
+    def __init__(self, lane: EventLane):
+        self.lane = lane
+        self.depth = 0
+        self.enqueued = 0
+        self.dequeued = 0
+        self.over_target = 0
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+
+    def record_wait(self, seconds: float):
+        self.dequeued += 1
+        self._waits.append(seconds)
+        target = self.lane.wait_target_ms
+        if target is not None and seconds * 1e3 > target:
+            self.over_target += 1
+
+    def stats(self) -> Dict:
+        waits = sorted(self._waits)
+
+        def percentile(p):
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(p * len(waits)))] * 1e3
+
+        return {
+            "weight": self.lane.weight,
+            "depth": self.depth,
+            "enqueued": self.enqueued,
+            "dequeued": self.dequeued,
+            "wait_ms": {
+                "p50": percentile(0.5),
+                "p99": percentile(0.99),
+                "max": waits[-1] * 1e3 if waits else 0.0,
+            },
+            "wait_target_ms": self.lane.wait_target_ms,
+            "over_target": self.over_target,
+        }
+
+
+class KeyedEventDispatcher:
+    """
+    Queue that keeps a FIFO of events per user. A user is handed to at most
+    one consumer at a time and only becomes available again once that
+    consumer calls task_done, so each user's events are processed in order
+    while any number of consumers work on other users in parallel.
+
+    Events are further assigned to lanes by event name, and a user is waiting
+    in the lane of the event at the head of their queue. Lanes are served
+    weighted fair: while several lanes have users waiting, each gets dequeues
+    in proportion to its weight. A user's queue stays FIFO, so a higher weight
+    lane gets its users served sooner but never reorders a user's events.
+    """
+
+    def __init__(
+        self,
+        lanes: Optional[List[EventLane]] = None,
+        clock=time.monotonic,
+    ):
+        lanes = list(lanes or [])
+        if not any(lane.name == DEFAULT_LANE for lane in lanes):
+            lanes.append(EventLane(DEFAULT_LANE))
+        self.clock = clock
+        self.lanes = lanes
+        self._lane_index = {lane.name: i for i, lane in enumerate(lanes)}
+        self._default_lane = self._lane_index[DEFAULT_LANE]
+        self._lane_for_event = {
+            event_name: i
+            for i, lane in enumerate(lanes)
+            for event_name in lane.event_names
+        }
+        # user id -> (enqueued at, lane, event), users without events are
+        # removed on task_done
+        self._users: Dict[str, deque] = {}
+        # users handed to a consumer and not yet task_done
+        self._busy = set()
+        # per lane, idle users whose head event is in that lane. Every idle
+        # user with events is listed exactly once.
+        self._ready = [deque() for _ in lanes]
+        self._available = asyncio.Semaphore(0)  # one per listed user
+        # stride scheduling: the lane with the lowest pass is served next and
+        # its pass advances by 1 / weight
+        self._passes = [0.0] * len(lanes)
+        self._virtual_time = 0.0
+        self._lane_stats = [LaneStats(lane) for lane in lanes]
+        self._size = 0
+        self._unfinished = 0
+        self.enqueued = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+    def lane_for(self, event_name: str) -> str:
+        lane = self._lane_for_event.get(event_name, self._default_lane)
+        return self.lanes[lane].name
+
+    async def put(self, event: CompactEvent):
+        self.put_nowait(event)
+
+    def put_nowait(self, event: CompactEvent):
+        user_id = event.user_id
+        lane = self._lane_for_event.get(event.name, self._default_lane)
+        events = self._users.get(user_id)
+        if events is None:
+            events = self._users[user_id] = deque()
+        events.append((self.clock(), lane, event))
+        self._lane_stats[lane].depth += 1
+        self._lane_stats[lane].enqueued += 1
+        self._size += 1
+        self.enqueued += 1
+        self._unfinished += 1
+        self._finished.clear()
+        if len(events) == 1 and user_id not in self._busy:
+            self._list(user_id, lane)
+
+    async def get(self) -> Tuple[str, CompactEvent]:
+        await self._available.acquire()
+        lane = self._next_lane()
+        user_id = self._ready[lane].popleft()
+        self._busy.add(user_id)
+        events = self._users[user_id]
+        enqueued_at, _, event = events.popleft()
+        stats = self._lane_stats[lane]
+        stats.depth -= 1
+        stats.record_wait(self.clock() - enqueued_at)
+        self._size -= 1
+        return user_id, event
+
+    def task_done(self, user_id: str):
+        self._busy.discard(user_id)
+        events = self._users[user_id]
+        if events:
+            self._list(user_id, events[0][1])
+        else:
+            del self._users[user_id]
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            self._finished.set()
+
+    async def join(self):
+        await self._finished.wait()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def lane_stats(self) -> Dict[str, Dict]:
+        return {
+            lane.name: stats.stats()
+            for lane, stats in zip(self.lanes, self._lane_stats)
+        }
+
+    def memory_usage(self) -> dict:
+        return {
+            "events": self._size,
+            "users": len(self._users),
+            "bytes": estimate_size(self._users),
+        }
+
+    def _list(self, user_id: str, lane: int):
+        if not self._ready[lane]:
+            # a lane that was idle doesn't get to spend credit it saved up
+            self._passes[lane] = max(self._passes[lane], self._virtual_time)
+        self._ready[lane].append(user_id)
+        self._available.release()
+
+    def _next_lane(self) -> int:
+        lane = min(
+            (i for i, ready in enumerate(self._ready) if ready),
+            key=self._passes.__getitem__,
+        )
+        self._virtual_time = self._passes[lane]
+        self._passes[lane] += 1 / self.lanes[lane].weight
+        return lane
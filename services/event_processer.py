@@ -1,10 +1,16 @@
-import asyncio
 import logging
+import time
+import uuid
+from typing import Optional
 
 from models.aggregate import EventAggregateStore
-from models.event import Event
+from models.event import CompactEvent
 from models.rules import RulesStore
+from services.dedupe import EventDeduplicator
+from services.event_dispatcher import KeyedEventDispatcher
 from services.feature_registry import PlatformFeaturesRegistry
+from services.freshness import FreshnessTracker
+from services.shadow_rules import ShadowEvaluator
 from services.user_feature import UserFeatureService
 
 
@@ -16,75 +22,115 @@ class EventProcessor:
         feature_registry: PlatformFeaturesRegistry,
         user_feature_service: UserFeatureService,
         logger: logging.Logger,
+        shadow_evaluator: Optional[ShadowEvaluator] = None,
     ):
         self.agg_store = aggregate_store
         self.rule_store = rule_store
         self.feature_registry = feature_registry
         self.user_feature_service = user_feature_service
+        self.logger = logger
+        self.shadow_evaluator = shadow_evaluator
 
-    async def process_event(self, event: Event):
+    async def process_event(self, event: CompactEvent) -> bool:
+        """
+        Returns whether the event was applied, failed events are logged and
+        dropped.
+        """
+        user_id = event.user_id
+        started_at = time.perf_counter()
+        changed_aggregates = []
         try:
-            # Assume for the purposes of this exercise that
-            # we never get duplicate events.
-            # In a real case we need to ensure that we update aggregates
-            # exactly once per distinct event (i.e. with a store of uuids)
+            # Duplicate events are dropped at ingest by the EventDeduplicator
+            # so aggregates are updated once per distinct event.
             aggregates = await self.agg_store.get_aggregates_by_event_name(event.name)
             # keep track of any Rules associated with the aggregates
+            # whose value actually changed. Cached verdicts of those rules
+            # are dropped, everything else is served from the verdict cache.
+            # Monotonic rules that are decided for good, or can't flip yet,
+            # are not returned by invalidate and need no work at all.
             all_rules = set()
             for agg in aggregates:
-                agg.update(event.event_properties.user_id, event)
-                r = await self.rule_store.get_rules_by_aggregate(agg.name)
-                for rule in r:
-                    all_rules.add(rule)
+                if not agg.update(user_id, event):
+                    continue
+                changed_aggregates.append(agg.name)
+                all_rules.update(self.rule_store.invalidate(user_id, agg.name))
 
-            failed_rules = set()
-            for rule in all_rules:
-                if not rule.abides(event.event_properties.user_id):
-                    failed_rules.add(rule)
-
-            impacted_features = set()
-            for rule in failed_rules:
-                features = await self.feature_registry.get_features_by_rule(rule.name)
-                impacted_features.update(features)
-
-            for feature in impacted_features:
-                failed_rules = False
-                for rule in feature.rules:
-                    if not rule.abides(event.event_properties.user_id):
-                        failed_rules = True
-                        break
-                if failed_rules:
-                    await self.user_feature_service.revoke(
-                        event.event_properties.user_id, feature
-                    )
-                else:
-                    await self.user_feature_service.grant(
-                        event.event_properties.user_id, feature
-                    )
+            await self._apply_rules(user_id, all_rules)
         except Exception as e:
             # obviously in real life probably bad to just be dropping events.
             self.logger.error(f"error processing event: {e}")
+            return False
+
+        if self.shadow_evaluator and changed_aggregates:
+            self.shadow_evaluator.evaluate(
+                user_id, changed_aggregates, time.perf_counter() - started_at
+            )
+        return True
+
+    async def merge_state(self, user_id: str, aggregate_name: str, state):
+        """
+        Merges a partial state into the user's aggregate like
+        EventAggregate.merge, then re-evaluates the dependent rules and
+        updates the user's grants the way an event does.
+        """
+        started_at = time.perf_counter()
+        aggregate = await self.agg_store.get_aggregate_by_name(aggregate_name)
+        aggregate.merge(user_id, state)
+        rules = self.rule_store.invalidate(user_id, aggregate_name, merged=True)
+        await self._apply_rules(user_id, rules)
+
+        if self.shadow_evaluator:
+            self.shadow_evaluator.evaluate(
+                user_id, [aggregate_name], time.perf_counter() - started_at
+            )
+
+    async def _apply_rules(self, user_id: str, rules):
+        failed_rules = set()
+        for rule in rules:
+            if not self.rule_store.abides(rule, user_id):
+                failed_rules.add(rule)
+
+        impacted_features = set()
+        for rule in failed_rules:
+            features = await self.feature_registry.get_features_by_rule(rule.name)
+            impacted_features.update(features)
+
+        for feature in impacted_features:
+            if not self.rule_store.walk_feature(feature, user_id):
+                await self.user_feature_service.revoke(user_id, feature)
+            else:
+                await self.user_feature_service.grant(user_id, feature)
 
 
 class EventConsumer:
     def __init__(
         self,
-        queue: asyncio.Queue,
+        queue: KeyedEventDispatcher,
         event_processor: EventProcessor,
         logger: logging.Logger,
+        freshness: Optional[FreshnessTracker] = None,
+        deduplicator: Optional[EventDeduplicator] = None,
     ):
         self.queue = queue
         self.event_processor = event_processor
+        self.freshness = freshness
+        # uuids reserved at ingest are recorded once processed, a failed
+        # event is forgotten so a retry of it is applied
+        self.deduplicator = deduplicator
 
-    async def consume(self):
+    async def handle(self, user_id: str, item: CompactEvent):
+        if self.freshness:
+            dequeued_at = self.freshness.dequeued(item)
+        processed = False
         try:
-            while True:
-                item = await self.queue.get()
-                await self.event_processor.process_event(item)
-                self.queue.task_done()
-        except asyncio.CancelledError:
-            logging.info("consumer cancelled.")
-            return
-        except Exception as e:
-            logging.error(f"consumer error: {e}")
-            raise
+            processed = await self.event_processor.process_event(item)
+        finally:
+            if self.deduplicator:
+                event_id = uuid.UUID(int=item.uuid)
+                if processed:
+                    self.deduplicator.commit(event_id)
+                else:
+                    self.deduplicator.release(event_id)
+            self.queue.task_done(user_id)
+            if self.freshness:
+                self.freshness.processed(item, dequeued_at)
@@ -0,0 +1,263 @@
+"""
+Bulk export of per user aggregate values and grant state as Arrow record
+batches. The service streams them at GET /export/aggregates and
+GET /export/grants, this module's CLI saves such a stream as a Parquet or
+Arrow file:
+
+    python -m services.export aggregates --out aggregates.parquet
+    python -m services.export grants --revoked-only --out revoked.parquet
+
+pyarrow is optional, only needed for exports: pip install pyarrow
+"""
+
+import argparse
+import asyncio
+import urllib.parse
+import urllib.request
+from array import array
+from typing import AsyncIterator, Dict, List, Optional
+
+from models.aggregate import EventAggregateStore
+from services.user_feature import UserFeatureService
+
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+# users per record batch, a batch is built in one go on the event loop
+DEFAULT_CHUNK_USERS = 16384
+
+
+class ExportUnavailable(Exception):
+    pass
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ExportUnavailable("Exports need pyarrow, pip install pyarrow")
+    return pyarrow
+
+
+class _StreamSink:
+    """
+    Write only file the Arrow stream writer writes to, its output is taken
+    after every batch and sent on.
+    """
+
+    def __init__(self):
+        self.closed = False
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def writable(self) -> bool:
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ColumnarExporter:
+    """
+    Reads aggregate values and grants chunk_size users at a time and yields
+    to the event loop between chunks, so events keep being processed and
+    access checks answered during an export. In memory users are taken when
+    the export of an aggregate starts, spilled ones are paged through; each
+    chunk reflects the state at the time it is read. Serializing a batch
+    happens on a worker thread.
+    """
+
+    def __init__(
+        self,
+        aggregate_store: EventAggregateStore,
+        user_feature_service: UserFeatureService,
+        chunk_size: int = DEFAULT_CHUNK_USERS,
+    ):
+        self.aggregate_store = aggregate_store
+        self.user_feature_service = user_feature_service
+        self.chunk_size = chunk_size
+
+    async def aggregate_chunks(self, names: Optional[List[str]] = None):
+        """
+        Yields (aggregate name, user ids, values) per chunk.
+        """
+        for aggregate in self.aggregates(names):
+            for chunk in aggregate.user_id_chunks(self.chunk_size):
+                values = array("d", aggregate.peek_user_aggregates(chunk))
+                yield aggregate.name, chunk, values
+                await asyncio.sleep(0)
+
+    async def grant_chunks(self, revoked_only: bool = False):
+        """
+        Yields (user ids, versions, grants per feature name) per chunk, of the
+        users that ever had a grant transition.
+        """
+        service = self.user_feature_service
+        for stripe in range(service.num_stripes):
+            user_ids = service.grant_user_ids(stripe)
+            for start in range(0, len(user_ids), self.chunk_size):
+                rows = service.grant_rows(
+                    stripe, user_ids[start : start + self.chunk_size]
+                )
+                if revoked_only:
+                    rows = [row for row in rows if not all(row[2].values())]
+                if rows:
+                    yield (
+                        [user_id for user_id, _, _ in rows],
+                        array("q", [version for _, version, _ in rows]),
+                        {
+                            feature.name: [grants[feature] for _, _, grants in rows]
+                            for feature in service.features
+                        },
+                    )
+                await asyncio.sleep(0)
+
+    def aggregate_schema(self):
+        pa = _pyarrow()
+        return pa.schema(
+            [
+                ("aggregate", pa.dictionary(pa.int32(), pa.string())),
+                ("user_id", pa.string()),
+                ("value", pa.float64()),
+            ]
+        )
+
+    def grant_schema(self):
+        pa = _pyarrow()
+        features = self.user_feature_service.features
+        return pa.schema(
+            [("user_id", pa.string()), ("version", pa.int64())]
+            + [(feature.name, pa.bool_()) for feature in features]
+        )
+
+    async def aggregate_batches(self, names: Optional[List[str]] = None):
+        pa = _pyarrow()
+        schema = self.aggregate_schema()
+        aggregate_names = [aggregate.name for aggregate in self.aggregates(names)]
+        dictionary = pa.array(aggregate_names, pa.string())
+        index_of = {name: i for i, name in enumerate(aggregate_names)}
+        async for name, user_ids, values in self.aggregate_chunks(names):
+            count = len(user_ids)
+            indices = array("i", [index_of[name]]) * count
+            yield pa.RecordBatch.from_arrays(
+                [
+                    pa.DictionaryArray.from_arrays(
+                        _from_array(pa, pa.int32(), indices), dictionary
+                    ),
+                    pa.array(user_ids, pa.string()),
+                    # the values are handed over without a copy
+                    _from_array(pa, pa.float64(), values),
+                ],
+                schema=schema,
+            )
+
+    async def grant_batches(self, revoked_only: bool = False):
+        pa = _pyarrow()
+        schema = self.grant_schema()
+        async for user_ids, versions, grants in self.grant_chunks(revoked_only):
+            yield pa.RecordBatch.from_arrays(
+                [pa.array(user_ids, pa.string()), _from_array(pa, pa.int64(), versions)]
+                + [pa.array(column, pa.bool_()) for column in grants.values()],
+                schema=schema,
+            )
+
+    async def arrow_stream(self, schema, batches) -> AsyncIterator[bytes]:
+        """
+        Encodes the batches as an Arrow IPC stream, one chunk of bytes per
+        batch.
+        """
+        pa = _pyarrow()
+        loop = asyncio.get_running_loop()
+        sink = _StreamSink()
+        writer = pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), schema)
+        async for batch in batches:
+            await loop.run_in_executor(None, writer.write_batch, batch)
+            yield sink.take()
+        writer.close()
+        yield sink.take()
+
+    def aggregates(self, names: Optional[List[str]] = None):
+        aggregates = self.aggregate_store.list_aggregates()
+        if names is None:
+            return aggregates
+        by_name = {aggregate.name: aggregate for aggregate in aggregates}
+        unknown = [name for name in names if name not in by_name]
+        if unknown:
+            raise ValueError(f"Aggregates {', '.join(unknown)} not found.")
+        return [by_name[name] for name in names]
+
+
+def _from_array(pa, type, values: array):
+    return pa.Array.from_buffers(type, len(values), [None, pa.py_buffer(values)])
+
+
+def save_export(url: str, path: str) -> Dict:
+    """
+    Streams an export from url into a Parquet file, or an Arrow IPC file
+    when path doesn't end in .parquet. Only one batch is held at a time.
+    """
+    pa = _pyarrow()
+    import pyarrow.parquet as pq
+
+    parquet = path.endswith(".parquet")
+    rows = 0
+    batches = 0
+    with urllib.request.urlopen(url) as response:
+        reader = pa.ipc.open_stream(response)
+        if parquet:
+            writer = pq.ParquetWriter(path, reader.schema)
+        else:
+            writer = pa.ipc.new_file(path, reader.schema)
+        with writer:
+            for batch in reader:
+                if parquet:
+                    writer.write_table(pa.Table.from_batches([batch]))
+                else:
+                    writer.write_batch(batch)
+                rows += batch.num_rows
+                batches += 1
+    return {"rows": rows, "batches": batches, "path": path}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("kind", choices=["aggregates", "grants"])
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--out", required=True, help=".parquet or .arrow file")
+    parser.add_argument(
+        "--aggregates", help="comma separated aggregate names, all by default"
+    )
+    parser.add_argument(
+        "--revoked-only",
+        action="store_true",
+        help="only users with at least one revoked feature",
+    )
+    args = parser.parse_args()
+
+    query = {}
+    if args.kind == "aggregates" and args.aggregates:
+        query["aggregates"] = args.aggregates
+    if args.kind == "grants" and args.revoked_only:
+        query["revoked_only"] = "true"
+    url = f"{args.url.rstrip('/')}/export/{args.kind}"
+    if query:
+        url = f"{url}?{urllib.parse.urlencode(query)}"
+    print(save_export(url, args.out))
+
+
+if __name__ == "__main__":
+    main()
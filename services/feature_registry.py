@@ -1,5 +1,6 @@
 import asyncio
 from collections import defaultdict
+from typing import List
 
 from models.rules import PlatformFeature
 
@@ -23,6 +24,13 @@ class PlatformFeaturesRegistry:
                 raise ValueError(f"Feature {name} not found.")
             return self.features[name]
 
+    async def get_features_by_names(self, names: List[str]) -> List[PlatformFeature]:
+        async with self._lock:
+            missing = [name for name in names if name not in self.features]
+            if missing:
+                raise ValueError(f"Feature {', '.join(missing)} not found.")
+            return [self.features[name] for name in names]
+
     async def get_features_by_rule(self, name: str):
         async with self._lock:
             return self._features_by_rule[name]
@@ -0,0 +1,175 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import Counter, deque
+from typing import Dict, Optional
+
+from models.event import CompactEvent
+
+DEFAULT_FRESHNESS_TARGET_MS = 1000
+# recent lags kept per hop for the percentiles
+LAG_SAMPLES = 4096
+HOPS = ("ingest", "queue", "process", "end_to_end")
+
+
+class LagStats:
+    def __init__(self, target_ms: Optional[float] = None):
+        self.target_ms = target_ms
+        self.count = 0
+        self.over_target = 0
+        self.max = 0.0
+        self._samples = deque(maxlen=LAG_SAMPLES)
+
+    def record(self, seconds: float):
+        # event timestamps come from the clients' clocks, which may be ahead
+        seconds = max(seconds, 0.0)
+        self.count += 1
+        self.max = max(self.max, seconds)
+        self._samples.append(seconds)
+        if self.target_ms is not None and seconds * 1e3 > self.target_ms:
+            self.over_target += 1
+
+    def stats(self) -> Dict:
+        samples = sorted(self._samples)
+
+        def percentile(p):
+            if not samples:
+                return 0.0
+            return samples[min(len(samples) - 1, int(p * len(samples)))] * 1e3
+
+        stats = {
+            "count": self.count,
+            "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99),
+            "max_ms": self.max * 1e3,
+        }
+        if self.target_ms is not None:
+            stats["target_ms"] = self.target_ms
+            stats["over_target"] = self.over_target
+        return stats
+
+
+class FreshnessTracker:
+    """
+    Measures how far grants trail the events they are computed from. Every
+    event's lag is recorded per hop: ingest (event timestamp to accepted),
+    queue (accepted to picked up by a consumer), process (until its grant
+    changes are visible) and end_to_end, which is checked against target_ms.
+
+    The watermark is the event time up to which every accepted event is
+    processed: the oldest timestamp still queued or being processed, or the
+    current time when nothing is. wait_for lets a read wait until the
+    watermark passes a given event time.
+    """
+
+    def __init__(
+        self, target_ms: float = DEFAULT_FRESHNESS_TARGET_MS, clock=time.time
+    ):
+        self.clock = clock
+        self.hops = {
+            hop: LagStats(target_ms if hop == "end_to_end" else None) for hop in HOPS
+        }
+        # timestamps of accepted, unprocessed events. Processed ones are
+        # counted in _done and dropped once they reach the top of the heap.
+        self._pending = []
+        self._done = Counter()
+        self._in_flight = 0
+        self._waiters = []  # (event time, seq, future)
+        self._waiter_seq = itertools.count()
+        # wakes waiters for event times ahead of the clock when nothing is
+        # pending, no processed event would
+        self._wake_handle: Optional[asyncio.TimerHandle] = None
+        self.waits = 0
+        self.wait_timeouts = 0
+
+    def accepted(self, event: CompactEvent):
+        now = self.clock()
+        event.received_at = now
+        self.hops["ingest"].record(now - event.timestamp)
+        heapq.heappush(self._pending, event.timestamp)
+        self._in_flight += 1
+
+    def dequeued(self, event: CompactEvent) -> float:
+        now = self.clock()
+        if event.received_at is not None:
+            self.hops["queue"].record(now - event.received_at)
+        return now
+
+    def processed(self, event: CompactEvent, dequeued_at: float):
+        now = self.clock()
+        self.hops["process"].record(now - dequeued_at)
+        self.hops["end_to_end"].record(now - event.timestamp)
+        if event.received_at is None:
+            # queued before tracking started
+            return
+        self._in_flight -= 1
+        self._done[event.timestamp] += 1
+        pending = self._pending
+        while pending and self._done[pending[0]]:
+            oldest = heapq.heappop(pending)
+            self._done[oldest] -= 1
+            if not self._done[oldest]:
+                del self._done[oldest]
+        self._wake_waiters()
+
+    def watermark(self) -> float:
+        return self._pending[0] if self._pending else self.clock()
+
+    async def wait_for(self, event_time: float, timeout: float) -> bool:
+        """
+        Waits up to timeout seconds for every accepted event up to event_time
+        to be processed. Returns whether they were.
+        """
+        if self._passed(event_time):
+            return True
+        self.waits += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (event_time, next(self._waiter_seq), future))
+        if not self._pending:
+            self._schedule_wake()
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.wait_timeouts += 1
+            # don't keep waiters for event times that are far ahead around
+            self._waiters = [
+                waiter for waiter in self._waiters if not waiter[2].done()
+            ]
+            heapq.heapify(self._waiters)
+            return False
+
+    def stats(self) -> Dict:
+        watermark = self.watermark()
+        return {
+            "watermark": watermark,
+            "watermark_lag_ms": max(self.clock() - watermark, 0.0) * 1e3,
+            "in_flight": self._in_flight,
+            "waits": self.waits,
+            "wait_timeouts": self.wait_timeouts,
+            "hops": {hop: stats.stats() for hop, stats in self.hops.items()},
+        }
+
+    def _wake_waiters(self):
+        if not self._waiters:
+            return
+        while self._waiters and self._passed(self._waiters[0][0]):
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(True)
+        if self._waiters and not self._pending:
+            self._schedule_wake()
+
+    def _schedule_wake(self):
+        if self._wake_handle is not None:
+            self._wake_handle.cancel()
+        delay = max(self._waiters[0][0] - self.clock(), 0.0)
+        self._wake_handle = asyncio.get_running_loop().call_later(
+            delay, self._wake_waiters
+        )
+
+    def _passed(self, event_time: float) -> bool:
+        if self._pending:
+            # events at the watermark itself are still pending
+            return self._pending[0] > event_time
+        return self.clock() >= event_time
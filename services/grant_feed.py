@@ -0,0 +1,97 @@
+import asyncio
+import os
+import time
+from collections import deque
+from itertools import islice
+from typing import List, Optional, Tuple
+
+from models.memory import estimate_size
+
+DEFAULT_FEED_SIZE = 10_000
+# grant versions, circuit epochs and feed sequence numbers restart with the
+# process, so ETags and cursors also carry an id of the process they were
+# counted in
+BOOT_ID = os.urandom(4).hex()
+
+
+def access_etag(version: int, circuit_epoch: int, boot_id: str = BOOT_ID) -> str:
+    return f'"{boot_id}-{version}-{circuit_epoch}"'
+
+
+class GrantChangeFeed:
+    """
+    Bounded in-memory log of grant transitions. Every transition gets a
+    sequence number so readers can resume from the last one they saw. Readers
+    that fall further behind than the log size get truncated=True back and
+    have to drop their local cache.
+
+    Sequence numbers restart with the process, so clients get cursors that
+    carry the boot id too. A cursor from another boot has to reset as well.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_FEED_SIZE, boot_id: str = BOOT_ID):
+        self.boot_id = boot_id
+        self._entries = deque(maxlen=max_entries)
+        self._seq = 0
+        self._new_entries = asyncio.Event()
+
+    @property
+    def last_seq(self) -> int:
+        return self._seq
+
+    def publish(self, user_id: str, feature: str, has_grant: bool, version: int):
+        self._seq += 1
+        self._entries.append(
+            {
+                "seq": self._seq,
+                "user_id": user_id,
+                "feature": feature,
+                "has_grant": has_grant,
+                "version": version,
+                "timestamp": time.time(),
+            }
+        )
+        # wake every waiter, later waiters wait on a fresh event
+        waiters, self._new_entries = self._new_entries, asyncio.Event()
+        waiters.set()
+
+    def cursor(self, seq: int) -> str:
+        return f"{self.boot_id}:{seq}"
+
+    def parse_cursor(self, cursor: str) -> Tuple[int, bool]:
+        """
+        Sequence number to resume after, and whether the client has to reset
+        first. Bare sequence numbers are taken as cursors of this boot.
+        """
+        boot_id, _, seq = cursor.rpartition(":")
+        try:
+            seq = int(seq)
+        except ValueError:
+            return 0, True
+        if (boot_id and boot_id != self.boot_id) or not 0 <= seq <= self._seq:
+            return 0, True
+        return seq, False
+
+    def memory_usage(self) -> dict:
+        return {"entries": len(self._entries), "bytes": estimate_size(self._entries)}
+
+    def since(self, seq: int) -> Tuple[List[dict], bool]:
+        if seq > self._seq:
+            # a sequence number handed out before a restart
+            return list(self._entries), True
+        if not self._entries or seq == self._seq:
+            return [], False
+        first_seq = self._entries[0]["seq"]
+        truncated = seq < first_seq - 1
+        start = max(0, seq - first_seq + 1)
+        return list(islice(self._entries, start, None)), truncated
+
+    async def wait_since(
+        self, seq: int, timeout: Optional[float] = None
+    ) -> Tuple[List[dict], bool]:
+        if seq == self._seq:
+            try:
+                await asyncio.wait_for(self._new_entries.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                return [], False
+        return self.since(seq)
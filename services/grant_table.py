@@ -0,0 +1,771 @@
+import asyncio
+import hashlib
+import logging
+import os
+import struct
+import time
+import zlib
+from multiprocessing import shared_memory
+from typing import Callable, Dict, List, Optional, Tuple
+
+from models.rules import PlatformFeature
+from services.circuit_breaker import (
+    CircuitBreakerConfig,
+    FeatureCircuitBreaker,
+    segment_index,
+)
+from services.feature_registry import PlatformFeaturesRegistry
+from services.grant_feed import BOOT_ID, access_etag
+
+DEFAULT_GRANT_TABLE_NAME = "feature_store_grants"
+DEFAULT_GRANT_TABLE_CAPACITY = 1 << 20
+MAX_FEATURES = 64
+# longer user ids are keyed by a digest, see _table_key
+MAX_USER_ID_BYTES = 75
+# a reader gives up on a slot the writer keeps changing after this many tries
+MAX_READ_RETRIES = 1000
+# new users are refused past this fraction of the capacity, so probing for a
+# user that isn't in the table stays short
+MAX_LOAD_FACTOR = 0.7
+# the writer stamps the header this often, readers fail access checks once
+# the stamp is older than DEFAULT_MAX_STALENESS seconds
+DEFAULT_HEARTBEAT_INTERVAL = 1.0
+DEFAULT_MAX_STALENESS = 5.0
+# circuit state published by the writer has room for this many segments
+MAX_SEGMENTS = 64
+# readers log the access checks they serve for the writer's circuit breakers,
+# one log per reader, collected this often
+MAX_READERS = 64
+DEFAULT_ATTEMPT_LOG_CAPACITY = 1 << 16
+DEFAULT_COLLECT_INTERVAL = 0.1
+
+_MAGIC = 0x4652454154475254
+# magic, capacity, feature digest, users, generation, writer heartbeat (ms)
+_HEADER = struct.Struct("<QQQQQQ")
+_USERS_OFFSET = 24
+_USERS = struct.Struct("<Q")
+_HEARTBEAT_OFFSET = 40
+_HEARTBEAT = struct.Struct("<Q")
+# set by the writer once the table misses a grant transition
+_DEGRADED_OFFSET = 48
+_DEGRADED = struct.Struct("<Q")
+_HEADER_SIZE = 64
+# seq, circuit epoch, then segments and open segment bits of every feature.
+# Guarded by a seqlock like the slots.
+_CIRCUITS_OFFSET = _HEADER_SIZE
+_CIRCUITS_HEADER = struct.Struct("<QQ")
+_CIRCUIT = struct.Struct("<QQ")
+_SLOTS_OFFSET = _CIRCUITS_OFFSET + _CIRCUITS_HEADER.size + MAX_FEATURES * _CIRCUIT.size
+# seq, grant bits, version, user id length, user id
+_SLOT = struct.Struct(f"<QQIB{MAX_USER_ID_BYTES}s")
+_SLOT_BODY = struct.Struct(f"<QIB{MAX_USER_ID_BYTES}s")
+_SEQ = struct.Struct("<Q")
+_SLOT_SIZE = 96
+# owner pid, capacity, head (attempts written), tail (attempts collected)
+_LOG_HEADER = struct.Struct("<QQQQ")
+_LOG_HEAD_OFFSET = 16
+_LOG_TAIL_OFFSET = 24
+_LOG_HEADER_SIZE = 64
+# feature index, success, user id length, user id
+_ATTEMPT = struct.Struct(f"<BBB{MAX_USER_ID_BYTES}s")
+_ATTEMPT_SIZE = 80
+
+
+class GrantTableError(Exception):
+    pass
+
+
+class GrantTableNotFound(GrantTableError):
+    pass
+
+
+class GrantTableFull(GrantTableError):
+    pass
+
+
+class GrantTableStale(GrantTableError):
+    pass
+
+
+class GrantTableDegraded(GrantTableError):
+    pass
+
+
+def feature_digest(feature_names: List[str]) -> int:
+    return zlib.crc32(",".join(feature_names).encode())
+
+
+class SharedGrantTable:
+    """
+    Open addressing hash table of user id -> (grant bits, version) in shared
+    memory. There is exactly one writer process; any number of processes can
+    read without locks. Every slot is guarded by a seqlock: the writer makes
+    the sequence odd, updates the slot and makes it even again, a reader
+    retries until it reads the same even sequence before and after the slot.
+
+    Users are never removed, users that are not in the table have the default
+    grants (every feature granted). Every create() gets a new random
+    generation and the writer stamps a heartbeat into the header, so readers
+    can tell a restarted writer and a dead one apart from a live table.
+    The writer also publishes which circuit segments are open, so every
+    reader answers with the same circuits.
+
+    A writer that fails to publish a transition marks the table degraded,
+    from then on access checks on it fail with GrantTableDegraded instead of
+    answering with grants the writer has moved on from. Only a new table, of
+    a restarted writer, clears it.
+    """
+
+    def __init__(
+        self,
+        shm: shared_memory.SharedMemory,
+        feature_names: List[str],
+        owner: bool,
+    ):
+        self._shm = shm
+        self._buf = shm.buf
+        self.owner = owner
+        self.feature_names = list(feature_names)
+        self._feature_index = {name: i for i, name in enumerate(feature_names)}
+        self._feature_bits = {name: 1 << i for name, i in self._feature_index.items()}
+        self._all_granted = (1 << len(feature_names)) - 1
+        magic, capacity, digest, _, generation, _ = _HEADER.unpack_from(self._buf, 0)
+        if magic != _MAGIC:
+            raise GrantTableError(f"{shm.name} is not a grant table.")
+        if digest != feature_digest(feature_names):
+            raise GrantTableError(
+                f"Grant table {shm.name} was created for different features."
+            )
+        self.capacity = capacity
+        self.generation = generation
+        self.max_users = int(capacity * MAX_LOAD_FACTOR)
+        self.read_retries = 0
+
+    @classmethod
+    def create(
+        cls,
+        feature_names: List[str],
+        name: str = DEFAULT_GRANT_TABLE_NAME,
+        capacity: int = DEFAULT_GRANT_TABLE_CAPACITY,
+    ) -> "SharedGrantTable":
+        if len(feature_names) > MAX_FEATURES:
+            raise GrantTableError(f"At most {MAX_FEATURES} features are supported.")
+        try:
+            # left over by a writer that didn't shut down cleanly
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        shm = shared_memory.SharedMemory(
+            name=name, create=True, size=_SLOTS_OFFSET + capacity * _SLOT_SIZE
+        )
+        digest = feature_digest(feature_names)
+        generation = int.from_bytes(os.urandom(8), "little")
+        _HEADER.pack_into(
+            shm.buf, 0, _MAGIC, capacity, digest, 0, generation, _now_ms()
+        )
+        return cls(shm, feature_names, owner=True)
+
+    @classmethod
+    def attach(
+        cls, feature_names: List[str], name: str = DEFAULT_GRANT_TABLE_NAME
+    ) -> "SharedGrantTable":
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            raise GrantTableNotFound(f"Grant table {name} does not exist.")
+        _unregister(shm)
+        return cls(shm, feature_names, owner=False)
+
+    @property
+    def users(self) -> int:
+        return _USERS.unpack_from(self._buf, _USERS_OFFSET)[0]
+
+    @property
+    def source_id(self) -> str:
+        # versions restart with the table
+        return f"{self.generation:016x}"
+
+    @property
+    def degraded(self) -> bool:
+        return bool(_DEGRADED.unpack_from(self._buf, _DEGRADED_OFFSET)[0])
+
+    def mark_degraded(self):
+        """
+        Stops readers from serving the table. Only the writer process may
+        call this.
+        """
+        _DEGRADED.pack_into(self._buf, _DEGRADED_OFFSET, 1)
+
+    def heartbeat(self):
+        _HEARTBEAT.pack_into(self._buf, _HEARTBEAT_OFFSET, _now_ms())
+
+    def heartbeat_age(self) -> float:
+        """
+        Seconds since the writer last stamped the header.
+        """
+        stamped = _HEARTBEAT.unpack_from(self._buf, _HEARTBEAT_OFFSET)[0]
+        return max(_now_ms() - stamped, 0) / 1e3
+
+    def set_grants(
+        self, user_id: str, grants: Dict[PlatformFeature, bool], version: int
+    ):
+        """
+        Publishes the user's grants. Only the writer process may call this.
+        """
+        # features missing from grants are granted, like in UserFeatureService
+        bits = self._all_granted
+        for feature, granted in grants.items():
+            if not granted:
+                bits &= ~self._feature_bits[feature.name]
+        key = _table_key(user_id)
+        offset, seq, is_new = self._find_slot(key, for_write=True)
+        if is_new and self.users >= self.max_users:
+            raise GrantTableFull(
+                f"Grant table {self._shm.name} is full ({self.users} users)."
+            )
+        _SEQ.pack_into(self._buf, offset, seq + 1)
+        _SLOT_BODY.pack_into(
+            self._buf, offset + _SEQ.size, bits, version, len(key), key
+        )
+        _SEQ.pack_into(self._buf, offset, seq + 2)
+        if is_new:
+            _USERS.pack_into(self._buf, _USERS_OFFSET, self.users + 1)
+
+    def get(self, user_id: str) -> Tuple[int, int]:
+        """
+        Returns (grant bits, version), the default grants and version 0 for
+        users that are not in the table.
+        """
+        key = _table_key(user_id)
+        offset, _, is_new = self._find_slot(key, for_write=False)
+        if is_new:
+            return self._all_granted, 0
+        for _ in range(MAX_READ_RETRIES):
+            seq, bits, version, _, _ = _SLOT.unpack_from(self._buf, offset)
+            if not seq & 1 and _SEQ.unpack_from(self._buf, offset)[0] == seq:
+                return bits, version
+            self.read_retries += 1
+        raise GrantTableError(f"Could not read a stable entry for {user_id}.")
+
+    def has_grant(self, user_id: str, feature_name: str) -> Tuple[bool, int]:
+        if self.degraded:
+            raise GrantTableDegraded(
+                f"Grant table {self._shm.name} missed grant transitions."
+            )
+        bits, version = self.get(user_id)
+        return bool(bits & self._feature_bits[feature_name]), version
+
+    def publish_circuits(self, circuits: List[FeatureCircuitBreaker]):
+        """
+        Publishes which circuit segments are open and the sum of their
+        transitions. Only the writer process may call this.
+        """
+        states = []
+        epoch = 0
+        for breaker in circuits:
+            if len(breaker.segments) > MAX_SEGMENTS:
+                raise GrantTableError(
+                    f"At most {MAX_SEGMENTS} circuit segments are supported."
+                )
+            open_bits = 0
+            for i, segment in enumerate(breaker.segments):
+                if not segment.closed:
+                    open_bits |= 1 << i
+            offset = _circuit_offset(self._feature_index[breaker.feature_name])
+            states.append((offset, len(breaker.segments), open_bits))
+            epoch += breaker.transitions
+        seq = _SEQ.unpack_from(self._buf, _CIRCUITS_OFFSET)[0]
+        _SEQ.pack_into(self._buf, _CIRCUITS_OFFSET, seq + 1)
+        for offset, segments, open_bits in states:
+            _CIRCUIT.pack_into(self._buf, offset, segments, open_bits)
+        _CIRCUITS_HEADER.pack_into(self._buf, _CIRCUITS_OFFSET, seq + 1, epoch)
+        _SEQ.pack_into(self._buf, _CIRCUITS_OFFSET, seq + 2)
+
+    def circuit_open(self, user_id: str, feature_name: str) -> bool:
+        """
+        Whether the writer last published the user's segment as open. Closed
+        until the writer published anything.
+        """
+        return self.circuit_state(user_id, feature_name)[0]
+
+    def circuit_state(self, user_id: str, feature_name: str) -> Tuple[bool, int]:
+        """
+        circuit_open and the circuit epoch, read from the same publication.
+        """
+        offset = _circuit_offset(self._feature_index[feature_name])
+        epoch, (segments, open_bits) = self._read_circuits(
+            lambda: _CIRCUIT.unpack_from(self._buf, offset)
+        )
+        return bool(open_bits >> segment_index(user_id, segments) & 1), epoch
+
+    @property
+    def circuit_epoch(self) -> int:
+        return self._read_circuits(lambda: None)[0]
+
+    def circuit_stats(self) -> Dict[str, Dict]:
+        stats = {}
+        for name, index in self._feature_index.items():
+            offset = _circuit_offset(index)
+            _, (segments, open_bits) = self._read_circuits(
+                lambda: _CIRCUIT.unpack_from(self._buf, offset)
+            )
+            stats[name] = {
+                "segments": segments,
+                "open_segments": bin(open_bits).count("1"),
+            }
+        return stats
+
+    def stats(self) -> Dict:
+        return {
+            "name": self._shm.name,
+            "owner": self.owner,
+            "capacity": self.capacity,
+            "max_users": self.max_users,
+            "users": self.users,
+            "generation": self.generation,
+            "degraded": self.degraded,
+            "heartbeat_age": self.heartbeat_age(),
+            "read_retries": self.read_retries,
+        }
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+        if self.owner:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                # already replaced by a restarted writer
+                pass
+
+    def _read_circuits(self, read: Callable):
+        for _ in range(MAX_READ_RETRIES):
+            seq, epoch = _CIRCUITS_HEADER.unpack_from(self._buf, _CIRCUITS_OFFSET)
+            value = read()
+            if not seq & 1 and _SEQ.unpack_from(self._buf, _CIRCUITS_OFFSET)[0] == seq:
+                return epoch, value
+            self.read_retries += 1
+        raise GrantTableError("Could not read a stable circuit state.")
+
+    def _find_slot(self, key: bytes, for_write: bool) -> Tuple[int, int, bool]:
+        index = zlib.crc32(key) % self.capacity
+        for _ in range(self.capacity):
+            offset = _SLOTS_OFFSET + index * _SLOT_SIZE
+            for _ in range(MAX_READ_RETRIES):
+                seq, _, _, key_len, slot_key = _SLOT.unpack_from(self._buf, offset)
+                if for_write or not seq & 1:
+                    break
+                self.read_retries += 1
+            if key_len == 0:
+                return offset, seq, True
+            if slot_key[:key_len] == key:
+                return offset, seq, False
+            index = (index + 1) % self.capacity
+        raise GrantTableFull("Grant table is full.")
+
+
+class AccessAttemptLog:
+    """
+    Ring of the access attempts one reader served, collected by the writer so
+    its circuit breakers see the attempts of every worker. Only the reader
+    moves the head and only the writer moves the tail. Attempts are dropped
+    while the ring is full, and for user ids longer than MAX_USER_ID_BYTES.
+
+    Readers take the first free one of MAX_READERS logs of the table. A log
+    is unlinked with its reader, also when the reader dies, since the
+    resource tracker of the reader cleans up after it.
+    """
+
+    def __init__(
+        self,
+        shm: shared_memory.SharedMemory,
+        feature_names: List[str],
+        owner: bool,
+    ):
+        self._shm = shm
+        self._buf = shm.buf
+        self.owner = owner
+        self.feature_names = list(feature_names)
+        self._feature_index = {name: i for i, name in enumerate(feature_names)}
+        self.pid, self.capacity, self._head, _ = _LOG_HEADER.unpack_from(self._buf, 0)
+        self.dropped = 0
+
+    @classmethod
+    def create(
+        cls,
+        feature_names: List[str],
+        name: str = DEFAULT_GRANT_TABLE_NAME,
+        capacity: int = DEFAULT_ATTEMPT_LOG_CAPACITY,
+    ) -> "AccessAttemptLog":
+        for index in range(MAX_READERS):
+            try:
+                shm = shared_memory.SharedMemory(
+                    name=_attempt_log_name(name, index),
+                    create=True,
+                    size=_LOG_HEADER_SIZE + capacity * _ATTEMPT_SIZE,
+                )
+            except FileExistsError:
+                continue
+            _LOG_HEADER.pack_into(shm.buf, 0, os.getpid(), capacity, 0, 0)
+            return cls(shm, feature_names, owner=True)
+        raise GrantTableError(f"All {MAX_READERS} attempt logs of {name} are taken.")
+
+    @classmethod
+    def attach(
+        cls, feature_names: List[str], name: str, index: int
+    ) -> "AccessAttemptLog":
+        try:
+            shm = shared_memory.SharedMemory(name=_attempt_log_name(name, index))
+        except FileNotFoundError:
+            raise GrantTableNotFound(f"Attempt log {index} of {name} does not exist.")
+        _unregister(shm)
+        log = cls(shm, feature_names, owner=False)
+        if not log.capacity:
+            # the reader hasn't written the header yet
+            log.close()
+            raise GrantTableNotFound(f"Attempt log {index} of {name} does not exist.")
+        return log
+
+    def log(self, user_id: str, feature_name: str, success: bool):
+        key = user_id.encode()
+        tail = _SEQ.unpack_from(self._buf, _LOG_TAIL_OFFSET)[0]
+        if self._head - tail >= self.capacity or len(key) > MAX_USER_ID_BYTES:
+            self.dropped += 1
+            return
+        offset = _LOG_HEADER_SIZE + self._head % self.capacity * _ATTEMPT_SIZE
+        _ATTEMPT.pack_into(
+            self._buf, offset, self._feature_index[feature_name], success, len(key), key
+        )
+        # the attempt is complete before the writer sees the new head
+        self._head += 1
+        _SEQ.pack_into(self._buf, _LOG_HEAD_OFFSET, self._head)
+
+    def drain(self) -> List[Tuple[str, str, bool]]:
+        """
+        Returns (user id, feature name, success) of the attempts logged since
+        the last drain. Only the writer process may call this.
+        """
+        head = _SEQ.unpack_from(self._buf, _LOG_HEAD_OFFSET)[0]
+        tail = _SEQ.unpack_from(self._buf, _LOG_TAIL_OFFSET)[0]
+        attempts = []
+        for position in range(tail, head):
+            offset = _LOG_HEADER_SIZE + position % self.capacity * _ATTEMPT_SIZE
+            feature, success, key_len, key = _ATTEMPT.unpack_from(self._buf, offset)
+            attempts.append(
+                (key[:key_len].decode(), self.feature_names[feature], bool(success))
+            )
+        _SEQ.pack_into(self._buf, _LOG_TAIL_OFFSET, head)
+        return attempts
+
+    def owner_alive(self) -> bool:
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def stats(self) -> Dict:
+        head = _SEQ.unpack_from(self._buf, _LOG_HEAD_OFFSET)[0]
+        tail = _SEQ.unpack_from(self._buf, _LOG_TAIL_OFFSET)[0]
+        return {
+            "name": self._shm.name,
+            "capacity": self.capacity,
+            "pending": head - tail,
+            "dropped": self.dropped,
+        }
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+        if self.owner:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class AccessAttemptCollector:
+    """
+    Writer side of the attempt logs. Feeds the attempts every reader logged
+    into the writer's circuit breakers and publishes the circuit state to the
+    table.
+    """
+
+    def __init__(self, table: SharedGrantTable, circuits: List[FeatureCircuitBreaker]):
+        self.table = table
+        self.circuits = {breaker.feature_name: breaker for breaker in circuits}
+        self.attempts = 0
+        self._logs: Dict[int, AccessAttemptLog] = {}
+        # fails right away on circuits that don't fit into the table
+        table.publish_circuits(circuits)
+
+    def collect(self, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        name = self.table._shm.name
+        for index in range(MAX_READERS):
+            if index in self._logs:
+                continue
+            try:
+                self._logs[index] = AccessAttemptLog.attach(
+                    self.table.feature_names, name, index
+                )
+            except GrantTableNotFound:
+                pass
+        for index, log in list(self._logs.items()):
+            for user_id, feature_name, success in log.drain():
+                self.circuits[feature_name].record(user_id, success, now=now)
+                self.attempts += 1
+            if not log.owner_alive():
+                # the reader's log is gone with it, a new reader may reuse the name
+                log.close()
+                del self._logs[index]
+        for breaker in self.circuits.values():
+            breaker.expire(now)
+        self.table.publish_circuits(list(self.circuits.values()))
+
+    def stats(self) -> Dict:
+        return {"readers": len(self._logs), "attempts": self.attempts}
+
+
+def _table_key(user_id: str) -> bytes:
+    key = user_id.encode()
+    if len(key) <= MAX_USER_ID_BYTES:
+        return key
+    # 0xff never occurs in utf-8, so a digest can't equal a short user id
+    return b"\xff" + hashlib.blake2b(key, digest_size=32).digest()
+
+
+def _circuit_offset(feature_index: int) -> int:
+    return _CIRCUITS_OFFSET + _CIRCUITS_HEADER.size + feature_index * _CIRCUIT.size
+
+
+def _attempt_log_name(name: str, index: int) -> str:
+    return f"{name}_attempts_{index}"
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1e3)
+
+
+def _unregister(shm: shared_memory.SharedMemory):
+    # readers must not unlink the segment when they exit, only the writer
+    # owns it. The resource tracker would do so for every attaching process.
+    try:
+        from multiprocessing import resource_tracker
+
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+
+
+class GrantTableReader:
+    """
+    Read only stand-in for UserFeatureService in HTTP workers that don't
+    process events. Grants are read from the table, a SharedGrantTable or
+    anything else with has_grant and stats.
+
+    With an attempt log, access checks are logged for the writer and the
+    circuits are the ones the writer published in the table. Otherwise
+    circuit breakers are local to the worker and fed by the access checks it
+    serves.
+    """
+
+    def __init__(
+        self,
+        table: SharedGrantTable,
+        feature_registry: PlatformFeaturesRegistry,
+        logger: logging.Logger,
+        circuit_configs: Optional[Dict[str, CircuitBreakerConfig]] = None,
+        attempt_log: Optional[AccessAttemptLog] = None,
+    ):
+        self.table = table
+        self.logger = logger
+        self.attempt_log = attempt_log
+        circuit_configs = circuit_configs or {}
+        default_config = circuit_configs.get("default", CircuitBreakerConfig())
+        self._circuits = {
+            feature: FeatureCircuitBreaker(
+                feature.name,
+                circuit_configs.get(feature.name, default_config),
+                logger=logger,
+            )
+            for feature in feature_registry.list_features()
+        }
+
+    async def has_grant(self, user_id: str, feature: PlatformFeature) -> bool:
+        return self._check_access(user_id, feature)[0]
+
+    async def has_grant_with_etag(
+        self, user_id: str, feature: PlatformFeature
+    ) -> Tuple[bool, str]:
+        has_access, version, circuit_epoch = self._check_access(user_id, feature)
+        if self.attempt_log is not None:
+            # versions and circuits are both counted by the table's writer
+            return has_access, access_etag(version, circuit_epoch, self.table.source_id)
+        # versions are counted by the table's writer, circuits by this worker
+        boot_id = f"{self.table.source_id}.{BOOT_ID}"
+        return has_access, access_etag(version, circuit_epoch, boot_id)
+
+    async def has_grants(
+        self, user_ids: List[str], features: List[PlatformFeature]
+    ) -> Dict[str, Dict[str, bool]]:
+        now = time.monotonic()
+        return {
+            user_id: {
+                feature.name: self._check_access(user_id, feature, now)[0]
+                for feature in features
+            }
+            for user_id in user_ids
+        }
+
+    @property
+    def _circuit_epoch(self) -> int:
+        # changes with every circuit transition, whether an access attempt or
+        # a check found it
+        return sum(breaker.transitions for breaker in self._circuits.values())
+
+    def circuit_breaker_stats(self) -> Dict[str, Dict]:
+        if self.attempt_log is not None:
+            return self.table.circuit_stats()
+        return {
+            feature.name: breaker.stats() for feature, breaker in self._circuits.items()
+        }
+
+    def grant_table_stats(self) -> Dict:
+        if self.attempt_log is not None:
+            return {**self.table.stats(), "attempt_log": self.attempt_log.stats()}
+        return self.table.stats()
+
+    def _check_access(
+        self, user_id: str, feature: PlatformFeature, now: Optional[float] = None
+    ) -> Tuple[bool, int, int]:
+        """
+        Returns the answer, the user's version and the circuit epoch the
+        answer was given at, before the attempt is recorded.
+        """
+        grant, version = self.table.has_grant(user_id, feature.name)
+        if self.attempt_log is not None:
+            circuit_open, circuit_epoch = self.table.circuit_state(
+                user_id, feature.name
+            )
+            self.attempt_log.log(user_id, feature.name, grant)
+            return grant or circuit_open, version, circuit_epoch
+        breaker = self._circuits[feature]
+        has_access = grant or not breaker.is_closed(user_id, now=now)
+        circuit_epoch = self._circuit_epoch
+        breaker.record(user_id, grant, now=now)
+        return has_access, version, circuit_epoch
+
+
+async def attach_when_created(
+    feature_names: List[str],
+    name: str = DEFAULT_GRANT_TABLE_NAME,
+    poll_interval: float = 0.1,
+) -> SharedGrantTable:
+    """
+    Waits for the writer to create the table, readers may start first.
+    """
+    while True:
+        try:
+            return SharedGrantTable.attach(feature_names, name)
+        except GrantTableNotFound:
+            await asyncio.sleep(poll_interval)
+
+
+async def run_heartbeat(
+    table: SharedGrantTable, interval: float = DEFAULT_HEARTBEAT_INTERVAL
+):
+    while True:
+        table.heartbeat()
+        await asyncio.sleep(interval)
+
+
+async def run_attempt_collector(
+    collector: AccessAttemptCollector, interval: float = DEFAULT_COLLECT_INTERVAL
+):
+    while True:
+        collector.collect()
+        await asyncio.sleep(interval)
+
+
+class FollowingGrantTable:
+    """
+    A reader's view of the table that survives writer restarts. A restarted
+    writer unlinks the segment and creates a new one, the old mapping stays
+    valid but is never written again. Once the heartbeat stops, the segment
+    is looked up by name again and followed if its generation changed.
+    Access checks fail with GrantTableStale while no live writer was found
+    for more than max_staleness seconds. The segment is looked up at most
+    once per heartbeat interval.
+    """
+
+    def __init__(
+        self,
+        table: SharedGrantTable,
+        max_staleness: float = DEFAULT_MAX_STALENESS,
+        heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL,
+    ):
+        self.table = table
+        self.max_staleness = max_staleness
+        self.heartbeat_interval = heartbeat_interval
+        self.reattaches = 0
+        self._last_lookup = 0.0
+
+    def has_grant(self, user_id: str, feature_name: str) -> Tuple[bool, int]:
+        age = self.table.heartbeat_age()
+        if age > 2 * self.heartbeat_interval:
+            now = time.monotonic()
+            if now - self._last_lookup >= self.heartbeat_interval:
+                self._last_lookup = now
+                self._reattach()
+                age = self.table.heartbeat_age()
+            if age > self.max_staleness:
+                raise GrantTableStale(
+                    f"Grant table writer last seen {age:.1f}s ago."
+                )
+        return self.table.has_grant(user_id, feature_name)
+
+    @property
+    def source_id(self) -> str:
+        return self.table.source_id
+
+    @property
+    def feature_names(self) -> List[str]:
+        return self.table.feature_names
+
+    def circuit_open(self, user_id: str, feature_name: str) -> bool:
+        return self.table.circuit_open(user_id, feature_name)
+
+    def circuit_state(self, user_id: str, feature_name: str) -> Tuple[bool, int]:
+        return self.table.circuit_state(user_id, feature_name)
+
+    @property
+    def circuit_epoch(self) -> int:
+        return self.table.circuit_epoch
+
+    def circuit_stats(self) -> Dict[str, Dict]:
+        return self.table.circuit_stats()
+
+    def stats(self) -> Dict:
+        return {**self.table.stats(), "reattaches": self.reattaches}
+
+    def close(self):
+        self.table.close()
+
+    def _reattach(self):
+        try:
+            table = SharedGrantTable.attach(
+                self.table.feature_names, self.table._shm.name
+            )
+        except GrantTableError:
+            return
+        if table.generation == self.table.generation:
+            table.close()
+            return
+        self.table.close()
+        self.table = table
+        self.reattaches += 1
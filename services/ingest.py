@@ -0,0 +1,216 @@
+import asyncio
+import datetime
+import logging
+import struct
+import uuid
+from typing import Dict, Optional, Set
+
+import msgpack
+from pydantic import ValidationError
+
+from models.event import CompactEvent, Event
+from services.dedupe import EventDeduplicator
+from services.event_dispatcher import KeyedEventDispatcher
+from services.event_registry import EventSchemaRegistry, EventTypeNotRegistered
+from services.freshness import FreshnessTracker
+from services.sockets import remove_socket_file, start_server
+
+DEFAULT_MAX_FRAME_BYTES = 1 << 20
+READ_CHUNK_BYTES = 1 << 16
+FRAME_HEADER = struct.Struct(">I")
+
+
+class InvalidEvent(Exception):
+    pass
+
+
+class EventIngestor:
+    """
+    Validates events against the properties schema registered for their name,
+    drops duplicates and queues the rest. Shared by POST /event and the binary
+    ingest listener so both accept exactly the same events.
+    """
+
+    def __init__(
+        self,
+        schema_registry: EventSchemaRegistry,
+        deduplicator: EventDeduplicator,
+        queue: KeyedEventDispatcher,
+        freshness: Optional[FreshnessTracker] = None,
+    ):
+        self.schema_registry = schema_registry
+        self.deduplicator = deduplicator
+        self.queue = queue
+        self.freshness = freshness
+
+    async def ingest(self, event: Event) -> bool:
+        """
+        Returns whether the event was a duplicate.
+        """
+        return await self._ingest(
+            event.uuid, event.name, event.timestamp.timestamp(), event.event_properties
+        )
+
+    async def ingest_frame(self, frame: Dict) -> bool:
+        """
+        Like ingest, for a decoded frame: uuid as 16 bytes or a string,
+        timestamp as epoch seconds or an ISO 8601 string.
+        """
+        try:
+            raw_id = frame["uuid"]
+            if isinstance(raw_id, bytes):
+                event_id = uuid.UUID(bytes=raw_id)
+            elif isinstance(raw_id, str):
+                event_id = uuid.UUID(raw_id)
+            else:
+                raise TypeError(f"uuid must be bytes or a string, not {raw_id!r}")
+            timestamp = frame["timestamp"]
+            if isinstance(timestamp, str):
+                timestamp = datetime.datetime.fromisoformat(timestamp).timestamp()
+            elif isinstance(timestamp, bool) or not isinstance(timestamp, (int, float)):
+                raise TypeError(
+                    f"timestamp must be a number or a string, not {timestamp!r}"
+                )
+            name = frame["name"]
+            if not isinstance(name, str):
+                raise TypeError(f"name must be a string, not {name!r}")
+            return await self._ingest(
+                event_id, name, float(timestamp), frame["event_properties"]
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise InvalidEvent(f"Malformed event: {e!r}")
+
+    async def _ingest(
+        self, event_id: uuid.UUID, name: str, timestamp: float, properties
+    ) -> bool:
+        schema = await self.schema_registry.get_schema_by_name(name)
+        if not isinstance(properties, dict):
+            raise InvalidEvent(f"Invalid event format for event type {name}")
+        try:
+            properties = schema(**properties)
+        except ValidationError as e:
+            raise InvalidEvent(f"Invalid properties for event type {name}: {e}")
+        event = CompactEvent.from_parts(event_id, name, timestamp, properties)
+
+        # recorded as seen by the consumer once the event was processed
+        if self.deduplicator.check_and_reserve(event_id):
+            return True
+        if self.freshness:
+            self.freshness.accepted(event)
+        await self.queue.put(event)
+        return False
+
+
+class IngestServer:
+    """
+    Persistent connection alternative to POST /event on a unix socket or tcp
+    address. Clients send events as msgpack maps with the POST /event fields,
+    each prefixed with its length as a 4 byte big endian integer. Every read
+    from the connection is acknowledged with one msgpack frame:
+    {"through": n, "duplicates": d, "errors": [[index, detail], ...]}, n being
+    the number of frames of the connection handled so far and index the
+    0-based position of a rejected frame on the connection.
+    """
+
+    def __init__(
+        self,
+        ingestor: EventIngestor,
+        address: str,
+        logger: logging.Logger,
+        max_frame_bytes: int = DEFAULT_MAX_FRAME_BYTES,
+    ):
+        self.ingestor = ingestor
+        self.address = address
+        self.logger = logger
+        self.max_frame_bytes = max_frame_bytes
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set[asyncio.Task] = set()
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.acks = 0
+
+    async def start(self):
+        self._server = await start_server(self.address, self._serve)
+        self.logger.info(f"Accepting msgpack events on {self.address}")
+
+    async def close(self):
+        if self._server is None:
+            return
+        self._server.close()
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+        remove_socket_file(self.address)
+
+    def stats(self) -> Dict:
+        return {
+            "address": self.address,
+            "connections": len(self._connections),
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "acks": self.acks,
+        }
+
+    async def _serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        buffer = bytearray()
+        handled = 0
+        try:
+            while chunk := await reader.read(READ_CHUNK_BYTES):
+                buffer += chunk
+                offset = 0
+                frames = 0
+                duplicates = 0
+                errors = []
+                while len(buffer) - offset >= FRAME_HEADER.size:
+                    (length,) = FRAME_HEADER.unpack_from(buffer, offset)
+                    if length > self.max_frame_bytes:
+                        # the stream can't be trusted to be in sync anymore
+                        error = f"Frame of {length} bytes is too large"
+                        writer.write(pack_frame({"error": error}))
+                        await writer.drain()
+                        return
+                    end = offset + FRAME_HEADER.size + length
+                    if len(buffer) < end:
+                        break
+                    payload = bytes(buffer[offset + FRAME_HEADER.size : end])
+                    offset = end
+                    try:
+                        if await self.ingestor.ingest_frame(msgpack.unpackb(payload)):
+                            duplicates += 1
+                    except (
+                        InvalidEvent,
+                        EventTypeNotRegistered,
+                        ValueError,
+                        msgpack.UnpackException,
+                    ) as e:
+                        errors.append([handled + frames, str(e)])
+                    frames += 1
+                if not frames:
+                    continue
+                del buffer[:offset]
+                handled += frames
+                self.accepted += frames - duplicates - len(errors)
+                self.duplicates += duplicates
+                self.rejected += len(errors)
+                self.acks += 1
+                ack = {"through": handled, "duplicates": duplicates, "errors": errors}
+                writer.write(pack_frame(ack))
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+
+def pack_frame(message: Dict) -> bytes:
+    payload = msgpack.packb(message)
+    return FRAME_HEADER.pack(len(payload)) + payload
@@ -0,0 +1,91 @@
+import os
+import sys
+import tracemalloc
+from typing import Callable, Dict, Optional
+
+DEFAULT_TRACEMALLOC_FRAMES = 1
+
+
+class TracingNotStartedError(Exception):
+    pass
+
+
+class MemoryDiagnostics:
+    """
+    Collects the memory_usage() of registered components into one report and
+    optionally diffs tracemalloc snapshots. Sizes are estimates (see
+    models.memory.estimate_size), meant to tell which structure grows.
+    """
+
+    def __init__(self):
+        self._sources: Dict[str, Callable[[], Dict]] = {}
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+
+    def register(self, name: str, source: Callable[[], Dict]):
+        self._sources[name] = source
+
+    def report(self) -> Dict:
+        return {
+            "rss_bytes": _rss_bytes(),
+            "tracemalloc": tracemalloc.is_tracing(),
+            "structures": {name: source() for name, source in self._sources.items()},
+        }
+
+    def start_tracing(self, frames: int = DEFAULT_TRACEMALLOC_FRAMES):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self._baseline = self._snapshot()
+
+    def stop_tracing(self):
+        tracemalloc.stop()
+        self._baseline = None
+
+    def snapshot_diff(self, limit: int = 20) -> Dict:
+        """
+        Top allocation sites by growth since the previous diff (or since
+        tracing started). The new snapshot becomes the next baseline.
+        """
+        if not tracemalloc.is_tracing() or self._baseline is None:
+            raise TracingNotStartedError("tracemalloc tracing is not started.")
+        snapshot = self._snapshot()
+        stats = snapshot.compare_to(self._baseline, "lineno")
+        self._baseline = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "traced_bytes": current,
+            "peak_traced_bytes": peak,
+            "top": [
+                {
+                    "location": str(stat.traceback[0]),
+                    "size_diff": stat.size_diff,
+                    "count_diff": stat.count_diff,
+                    "size": stat.size,
+                    "count": stat.count,
+                }
+                for stat in stats[:limit]
+            ],
+        }
+
+    def _snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            )
+        )
+
+
+def _rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # peak rather than current, in KiB on linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
@@ -0,0 +1,317 @@
+import asyncio
+import json
+import logging
+import random
+from collections import defaultdict, deque
+from typing import Optional, Tuple
+from urllib.parse import urlsplit
+
+
+class DeliveryError(Exception):
+    pass
+
+
+class SubscriberConnectionPool:
+    """
+    Keep-alive HTTP/1.1 connections to a single subscriber. At most
+    max_connections requests are in flight at once, idle connections are
+    reused by the next request.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        max_connections: int = 8,
+        request_timeout: float = 5.0,
+    ):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"Invalid subscriber url {url}")
+        self.url = url
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.ssl = parts.scheme == "https"
+        self.path = parts.path or "/"
+        if parts.query:
+            self.path = f"{self.path}?{parts.query}"
+        self.request_timeout = request_timeout
+        self._semaphore = asyncio.Semaphore(max_connections)
+        self._idle = deque()
+        self.connections_opened = 0
+
+    async def post(self, body: bytes) -> int:
+        async with self._semaphore:
+            reader, writer = self._idle.pop() if self._idle else await self._connect()
+            try:
+                status, keep_alive = await asyncio.wait_for(
+                    self._request(reader, writer, body), timeout=self.request_timeout
+                )
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive:
+                self._idle.append((reader, writer))
+            else:
+                writer.close()
+            return status
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def _connect(self):
+        self.connections_opened += 1
+        return await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl),
+            timeout=self.request_timeout,
+        )
+
+    async def _request(self, reader, writer, body: bytes) -> Tuple[int, bool]:
+        head = (
+            f"POST {self.path} HTTP/1.1\r\n"
+            f"Host: {self.host}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        )
+        writer.write(head.encode() + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise DeliveryError("connection closed by subscriber")
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            raise DeliveryError(f"malformed status line {status_line[:80]!r}")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip().lower()
+
+        if headers.get("transfer-encoding") == "chunked":
+            while True:
+                size_line = await reader.readline()
+                try:
+                    size = int(size_line.split(b";")[0], 16)
+                except ValueError:
+                    raise DeliveryError(f"malformed chunk size {size_line[:80]!r}")
+                await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            try:
+                length = int(headers.get("content-length", 0))
+            except ValueError:
+                raise DeliveryError("malformed content-length")
+            await reader.readexactly(length)
+
+        keep_alive = headers.get("connection") != "close"
+        return status, keep_alive
+
+
+class NotificationDeliveryEngine:
+    """
+    Non blocking delivery of notifications to subscriber urls.
+
+    enqueue() only appends to a per subscriber buffer, the run() task drains
+    the buffers in batches of up to batch_size notifications per request
+    (sent as a json array) and retries failed requests with full jitter
+    exponential backoff.
+
+    Each subscriber's buffer is split into max_connections_per_subscriber
+    lanes by the notification's key (the user id), and a lane has at most one
+    batch in flight, retries included. Notifications with the same key are
+    therefore delivered in the order they were enqueued.
+    """
+
+    def __init__(
+        self,
+        max_connections_per_subscriber: int = 8,
+        batch_size: int = 100,
+        flush_interval: float = 0.05,
+        max_retries: int = 5,
+        backoff_base: float = 0.1,
+        backoff_max: float = 5.0,
+        request_timeout: float = 5.0,
+        max_pending: int = 100_000,
+        logger: logging.Logger = logging.getLogger(__name__),
+    ):
+        self.max_connections_per_subscriber = max_connections_per_subscriber
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.request_timeout = request_timeout
+        self.max_pending = max_pending
+        self.logger = logger
+        self._pools = {}
+        # (subscriber, lane) -> notifications
+        self._pending = defaultdict(deque)
+        self._pending_count = 0
+        # lanes with a batch in flight
+        self._busy = set()
+        self._next_lane = 0
+        self._in_flight = set()
+        self._wakeup = asyncio.Event()
+        self._stats = defaultdict(int)
+
+    def enqueue(self, subscriber: str, notification: dict, key: Optional[str] = None):
+        """
+        Notifications with the same key keep their order, ones without a key
+        are spread over the lanes.
+        """
+        if key is None:
+            lane = self._next_lane
+            self._next_lane = (lane + 1) % self.max_connections_per_subscriber
+        else:
+            lane = hash(key) % self.max_connections_per_subscriber
+        pending = self._pending[(subscriber, lane)]
+        if self._pending_count >= self.max_pending:
+            # shed the oldest notification of this lane rather than growing
+            # without bound while a subscriber is down, of the longest lane
+            # when this one has none
+            shed = pending or max(self._pending.values(), key=len)
+            self._stats["dropped"] += 1
+            if not shed:
+                # nothing is buffered to make room for it
+                return
+            shed.popleft()
+            self._pending_count -= 1
+        pending.append(notification)
+        self._pending_count += 1
+        self._stats["enqueued"] += 1
+        if len(pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(
+                        self._wakeup.wait(), timeout=self.flush_interval
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                self._dispatch_pending()
+        except asyncio.CancelledError:
+            self.logger.info("notification delivery cancelled.")
+            raise
+
+    async def flush(self):
+        while self._pending_count or self._in_flight:
+            self._dispatch_pending()
+            if self._in_flight:
+                await asyncio.wait(
+                    self._in_flight, return_when=asyncio.FIRST_COMPLETED
+                )
+
+    async def close(self, timeout: Optional[float] = None):
+        try:
+            await asyncio.wait_for(self.flush(), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.logger.error(
+                f"dropping {self._pending_count} undelivered notifications on close"
+            )
+        in_flight = list(self._in_flight)
+        for task in in_flight:
+            task.cancel()
+        # the tasks may still be using a connection of the pools
+        await asyncio.gather(*in_flight, return_exceptions=True)
+        for pool in self._pools.values():
+            await pool.close()
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats["pending"] = self._pending_count
+        stats["in_flight_requests"] = len(self._in_flight)
+        stats["connections_opened"] = sum(
+            pool.connections_opened for pool in self._pools.values()
+        )
+        return stats
+
+    def _dispatch_pending(self):
+        for lane, pending in self._pending.items():
+            if not pending or lane in self._busy:
+                continue
+            batch = [
+                pending.popleft() for _ in range(min(self.batch_size, len(pending)))
+            ]
+            self._pending_count -= len(batch)
+            self._busy.add(lane)
+            task = asyncio.create_task(self._deliver_lane(lane, batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _deliver_lane(self, lane: Tuple[str, int], batch: list):
+        try:
+            await self._deliver(lane[0], batch)
+        finally:
+            self._busy.discard(lane)
+            if self._pending[lane]:
+                # the next batch of this lane was held back
+                self._wakeup.set()
+
+    async def _deliver(self, subscriber: str, batch: list):
+        body = json.dumps(batch).encode()
+        try:
+            pool = self._get_pool(subscriber)
+        except ValueError as e:
+            self._stats["failed"] += len(batch)
+            self.logger.error(str(e))
+            return
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._stats["retries"] += 1
+                await asyncio.sleep(self._backoff(attempt))
+            try:
+                status = await pool.post(body)
+            except (
+                OSError,
+                asyncio.TimeoutError,
+                asyncio.IncompleteReadError,
+                DeliveryError,
+            ) as e:
+                self.logger.warning(
+                    f"notification delivery to {subscriber} failed: {e}"
+                )
+                continue
+            self._stats["requests"] += 1
+            if 200 <= status < 300:
+                self._stats["delivered"] += len(batch)
+                return
+            if 400 <= status < 500 and status != 429:
+                # the subscriber rejected the payload, retrying won't help
+                break
+            self.logger.warning(
+                f"notification delivery to {subscriber} got status {status}"
+            )
+        self._stats["failed"] += len(batch)
+        self.logger.error(f"giving up on {len(batch)} notifications for {subscriber}")
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter: uniform between 0 and the capped exponential delay
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+        )
+
+    def _get_pool(self, subscriber: str) -> SubscriberConnectionPool:
+        pool = self._pools.get(subscriber)
+        if pool is None:
+            pool = SubscriberConnectionPool(
+                subscriber,
+                max_connections=self.max_connections_per_subscriber,
+                request_timeout=self.request_timeout,
+            )
+            self._pools[subscriber] = pool
+        return pool
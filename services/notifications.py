@@ -1,4 +1,7 @@
+from typing import Dict, List, Optional
+
 from models.event import Event
+from services.notification_transport import NotificationDeliveryEngine
 
 DEFAULT_EVENT_SUBSCRIBERS_MAP = {
     "access_granted": ["https:://api.example.com/event"],
@@ -6,20 +9,33 @@ DEFAULT_EVENT_SUBSCRIBERS_MAP = {
 }
 
 
-# Assume this is a resilent service to send notifications through
-# that handles deduplication, retries, and such for us.
+# Without a delivery engine notifications are only printed. With one they are
+# handed to it without blocking and delivered over http in the background.
 class NotificationsService:
-    def __init__(self):
+    def __init__(
+        self,
+        event_subscribers: Optional[Dict[str, List[str]]] = None,
+        delivery_engine: Optional[NotificationDeliveryEngine] = None,
+    ):
         # hardcodeing for demonstration purposes
-        self._event_subscribers = DEFAULT_EVENT_SUBSCRIBERS_MAP
+        self._event_subscribers = event_subscribers or DEFAULT_EVENT_SUBSCRIBERS_MAP
+        self._delivery_engine = delivery_engine
 
-    def send_notification(self, event: Event):
+    def send_notification(self, event: Event, key: Optional[str] = None):
+        """
+        Notifications with the same key, e.g. a user id, reach each
+        subscriber in the order they were sent.
+        """
         subscribers = self._event_subscribers.get(event.name)
         if not subscribers:
             return
         for subscriber in subscribers:
-            self._send_notification(subscriber, event)
+            self._send_notification(subscriber, event, key)
 
-    def _send_notification(self, subscriber: str, event: dict):
-        print(f"Sending notification to {subscriber} for event {event}")
-        return
+    def _send_notification(self, subscriber: str, event: Event, key: Optional[str]):
+        if self._delivery_engine is None:
+            print(f"Sending notification to {subscriber} for event {event}")
+            return
+        self._delivery_engine.enqueue(
+            subscriber, event.model_dump(mode="json"), key=key
+        )
@@ -0,0 +1,293 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from typing import Callable, Dict, Optional, Set, Tuple
+
+from services.grant_feed import BOOT_ID
+from services.sockets import open_connection, remove_socket_file, start_server
+from services.user_feature import UserFeatureService
+
+DEFAULT_REPLICATION_ADDRESS = "/tmp/feature-store-replication.sock"
+DEFAULT_SNAPSHOT_INTERVAL = 60
+DEFAULT_HEARTBEAT_INTERVAL = 1
+DEFAULT_MAX_LAG = 5
+DEFAULT_RECONNECT_INTERVAL = 1
+SNAPSHOT_CHUNK_USERS = 10_000
+# longest message line a replica accepts, snapshot chunks stay far below it
+MAX_MESSAGE_BYTES = 1 << 24
+
+
+class ReplicationLagError(Exception):
+    pass
+
+
+class ReplicationServer:
+    """
+    Runs on the primary. Every replica that connects gets a snapshot of the
+    current grants followed by the grant transitions from the change feed, as
+    one JSON message per line. A fresh snapshot is sent every
+    snapshot_interval seconds and whenever a replica fell behind the feed,
+    heartbeats carry the primary's sequence while there are no transitions.
+    """
+
+    def __init__(
+        self,
+        user_feature_service: UserFeatureService,
+        address: str,
+        logger: logging.Logger,
+        snapshot_interval: float = DEFAULT_SNAPSHOT_INTERVAL,
+        heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL,
+    ):
+        self.user_feature_service = user_feature_service
+        self.change_feed = user_feature_service.change_feed
+        self.address = address
+        self.logger = logger
+        self.snapshot_interval = snapshot_interval
+        self.heartbeat_interval = heartbeat_interval
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set[asyncio.Task] = set()
+        self._sent_seqs: Dict[str, int] = {}
+        self.snapshots_sent = 0
+        self.changes_sent = 0
+
+    async def start(self):
+        self._server = await start_server(self.address, self._serve)
+        self.logger.info(f"Serving grant replication on {self.address}")
+
+    async def close(self):
+        if self._server is None:
+            return
+        self._server.close()
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+        remove_socket_file(self.address)
+
+    def stats(self) -> Dict:
+        last_seq = self.change_feed.last_seq
+        return {
+            "role": "primary",
+            "address": self.address,
+            "last_seq": last_seq,
+            "snapshots_sent": self.snapshots_sent,
+            "changes_sent": self.changes_sent,
+            "replicas": {
+                peer: {"sent_seq": seq, "lag_entries": last_seq - seq}
+                for peer, seq in self._sent_seqs.items()
+            },
+        }
+
+    async def _serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        peer = f"replica-{id(writer):x}"
+        self.logger.info(f"Replica {peer} connected")
+        try:
+            seq = await self._send_snapshot(writer)
+            self._sent_seqs[peer] = seq
+            next_snapshot = time.monotonic() + self.snapshot_interval
+            while True:
+                timeout = min(
+                    self.heartbeat_interval, max(0, next_snapshot - time.monotonic())
+                )
+                changes, truncated = await self.change_feed.wait_since(
+                    seq, timeout=timeout
+                )
+                if truncated or time.monotonic() >= next_snapshot:
+                    # the snapshot covers whatever the replica missed
+                    seq = await self._send_snapshot(writer)
+                    next_snapshot = time.monotonic() + self.snapshot_interval
+                elif changes:
+                    for change in changes:
+                        self._send(writer, {"type": "change", **change})
+                    seq = changes[-1]["seq"]
+                    self.changes_sent += len(changes)
+                else:
+                    self._send(writer, {"type": "heartbeat"})
+                self._sent_seqs[peer] = seq
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            self._sent_seqs.pop(peer, None)
+            writer.close()
+            self.logger.info(f"Replica {peer} disconnected")
+
+    async def _send_snapshot(self, writer: asyncio.StreamWriter) -> int:
+        seq, users = self.user_feature_service.grant_snapshot()
+        self._send(writer, {"type": "snapshot_start", "seq": seq, "boot_id": BOOT_ID})
+        for start in range(0, len(users), SNAPSHOT_CHUNK_USERS):
+            chunk = users[start : start + SNAPSHOT_CHUNK_USERS]
+            self._send(writer, {"type": "snapshot_chunk", "users": chunk})
+            await writer.drain()
+        self._send(writer, {"type": "snapshot_end", "seq": seq})
+        self.snapshots_sent += 1
+        return seq
+
+    def _send(self, writer: asyncio.StreamWriter, message: Dict):
+        message["primary_seq"] = self.change_feed.last_seq
+        writer.write(json.dumps(message).encode() + b"\n")
+
+
+class ReplicaGrantTable:
+    """
+    Read only grants of a replica, applied from the primary's replication
+    messages. Used as the table of a GrantTableReader. Lag is the time since
+    the replica last knew it had applied everything the primary had, access
+    checks fail with ReplicationLagError once it is over max_lag seconds.
+    """
+
+    def __init__(
+        self,
+        max_lag: float = DEFAULT_MAX_LAG,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_lag = max_lag
+        self.clock = clock
+        self._revoked: Dict[str, Set[str]] = {}
+        self._versions: Dict[str, int] = {}
+        self._staging: Optional[Tuple[Dict, Dict, str]] = None
+        # versions are counted by the primary and restart with it
+        self.source_id = ""
+        self.applied_seq = 0
+        self.primary_seq = 0
+        self._caught_up_at: Optional[float] = None
+        self._synced = asyncio.Event()
+        self.snapshots_applied = 0
+        self.changes_applied = 0
+
+    def apply(self, message: Dict):
+        kind = message["type"]
+        if kind == "snapshot_start":
+            self._staging = ({}, {}, message.get("boot_id", ""))
+        elif kind == "snapshot_chunk":
+            revoked, versions, _ = self._staging
+            for user_id, version, revoked_features in message["users"]:
+                versions[user_id] = version
+                if revoked_features:
+                    revoked[user_id] = set(revoked_features)
+        elif kind == "snapshot_end":
+            # swapped in whole, so reads never see half a snapshot
+            self._revoked, self._versions, self.source_id = self._staging
+            self._staging = None
+            self.applied_seq = message["seq"]
+            self.snapshots_applied += 1
+            self._synced.set()
+        elif kind == "change" and message["seq"] > self.applied_seq:
+            revoked = self._revoked.setdefault(message["user_id"], set())
+            if message["has_grant"]:
+                revoked.discard(message["feature"])
+            else:
+                revoked.add(message["feature"])
+            self._versions[message["user_id"]] = message["version"]
+            self.applied_seq = message["seq"]
+            self.changes_applied += 1
+
+        self.primary_seq = message["primary_seq"]
+        if self._synced.is_set() and self.applied_seq >= self.primary_seq:
+            self._caught_up_at = self.clock()
+
+    @property
+    def users(self) -> int:
+        return len(self._versions)
+
+    def lag_seconds(self) -> float:
+        if self._caught_up_at is None:
+            return math.inf
+        return self.clock() - self._caught_up_at
+
+    async def wait_synced(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits for the first snapshot, returns whether it was applied in time.
+        """
+        try:
+            await asyncio.wait_for(self._synced.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def has_grant(self, user_id: str, feature_name: str) -> Tuple[bool, int]:
+        lag = self.lag_seconds()
+        if lag > self.max_lag:
+            raise ReplicationLagError(
+                f"Replica is {lag:.1f}s behind the primary, over {self.max_lag}s."
+            )
+        revoked = self._revoked.get(user_id, ())
+        return feature_name not in revoked, self._versions.get(user_id, 0)
+
+    def stats(self) -> Dict:
+        lag = self.lag_seconds()
+        return {
+            "users": self.users,
+            "applied_seq": self.applied_seq,
+            "primary_seq": self.primary_seq,
+            "lag_entries": self.primary_seq - self.applied_seq,
+            "lag_seconds": None if math.isinf(lag) else lag,
+            "max_lag_seconds": self.max_lag,
+            "snapshots_applied": self.snapshots_applied,
+            "changes_applied": self.changes_applied,
+        }
+
+
+class ReplicationClient:
+    """
+    Runs on a replica, keeps a connection to the primary and feeds every
+    message into the table. The primary starts every connection with a
+    snapshot, so reconnecting needs no resume position.
+    """
+
+    def __init__(
+        self,
+        table: ReplicaGrantTable,
+        address: str,
+        logger: logging.Logger,
+        reconnect_interval: float = DEFAULT_RECONNECT_INTERVAL,
+    ):
+        self.table = table
+        self.address = address
+        self.logger = logger
+        self.reconnect_interval = reconnect_interval
+        self.connected = False
+        self.reconnects = 0
+
+    async def run(self):
+        while True:
+            try:
+                reader, writer = await open_connection(
+                    self.address, limit=MAX_MESSAGE_BYTES
+                )
+            except OSError as e:
+                self.logger.warning(f"Can't reach primary at {self.address}: {e}")
+                await asyncio.sleep(self.reconnect_interval)
+                continue
+
+            self.connected = True
+            try:
+                while line := await reader.readline():
+                    self.table.apply(json.loads(line))
+            except (ConnectionError, ValueError) as e:
+                self.logger.warning(f"Replication stream failed: {e}")
+            except (KeyError, TypeError) as e:
+                # the table may be half way through the message, the next
+                # connection starts over with a snapshot
+                self.logger.error(f"Malformed replication message: {e!r}")
+            finally:
+                self.connected = False
+                self.reconnects += 1
+                writer.close()
+            await asyncio.sleep(self.reconnect_interval)
+
+    def stats(self) -> Dict:
+        return {
+            "role": "replica",
+            "address": self.address,
+            "connected": self.connected,
+            "reconnects": self.reconnects,
+            **self.table.stats(),
+        }
@@ -0,0 +1,128 @@
+import logging
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List
+
+from models.rules import PlatformFeature, Rule, RuleOperation, RulesStore
+
+DEFAULT_SHADOW_CPU_BUDGET = 0.1
+# seconds of shadow evaluation that can be banked for bursts
+MAX_SHADOW_CREDIT = 0.001
+
+
+class ShadowRule:
+    """
+    Candidate rule evaluated in place of `replaces` in every feature that
+    uses it. Only counts where its verdict would differ from the live one.
+    """
+
+    def __init__(self, rule: Rule, replaces: Rule, features: List[PlatformFeature]):
+        self.rule = rule
+        self.replaces = replaces
+        self.features = features
+        self.evaluations = 0
+        self.agreements = 0
+        self.would_grant = 0
+        self.would_revoke = 0
+
+    def stats(self) -> dict:
+        return {
+            "replaces": self.replaces.name,
+            "evaluations": self.evaluations,
+            "agreements": self.agreements,
+            "would_grant": self.would_grant,
+            "would_revoke": self.would_revoke,
+        }
+
+
+class ShadowEvaluator:
+    """
+    Evaluates shadow rules on the same events as the live rules. Aggregate
+    values and live verdicts are read through the caches the live path just
+    filled, and nothing is ever granted or revoked.
+
+    Shadow work is limited to cpu_budget times the live processing time: each
+    processed event earns that much credit, each shadow evaluation spends its
+    measured time and evaluations are skipped while the credit is negative.
+    """
+
+    def __init__(
+        self,
+        shadow_rules: Iterable[ShadowRule],
+        rule_store: RulesStore,
+        cpu_budget: float = DEFAULT_SHADOW_CPU_BUDGET,
+        logger: logging.Logger = logging.getLogger(__name__),
+    ):
+        self.shadow_rules = {shadow.rule.name: shadow for shadow in shadow_rules}
+        self.rule_store = rule_store
+        self.cpu_budget = cpu_budget
+        self.logger = logger
+        self._by_aggregate = defaultdict(list)
+        for shadow in self.shadow_rules.values():
+            self._by_aggregate[shadow.rule.aggregate1.name].append(shadow)
+            if shadow.rule.operation == RuleOperation.DIVIDE:
+                self._by_aggregate[shadow.rule.aggregate2.name].append(shadow)
+        self._credit = MAX_SHADOW_CREDIT
+        self.skipped = 0
+        self.live_seconds = 0.0
+        self.shadow_seconds = 0.0
+
+    def evaluate(
+        self, user_id: str, changed_aggregates: List[str], live_seconds: float
+    ):
+        self.live_seconds += live_seconds
+        self._credit = min(
+            MAX_SHADOW_CREDIT, self._credit + live_seconds * self.cpu_budget
+        )
+
+        triggered = {}
+        for name in changed_aggregates:
+            for shadow in self._by_aggregate.get(name, ()):
+                triggered[shadow.rule.name] = shadow
+
+        for shadow in triggered.values():
+            if self._credit < 0:
+                self.skipped += 1
+                continue
+            started_at = time.perf_counter()
+            try:
+                self._evaluate_shadow(shadow, user_id)
+            except Exception as e:
+                self.logger.error(
+                    f"error evaluating shadow rule {shadow.rule.name}: {e}"
+                )
+            elapsed = time.perf_counter() - started_at
+            self.shadow_seconds += elapsed
+            self._credit -= elapsed
+
+    def stats(self) -> Dict:
+        return {
+            "rules": {
+                name: shadow.stats() for name, shadow in self.shadow_rules.items()
+            },
+            "skipped_evaluations": self.skipped,
+            "cpu_budget": self.cpu_budget,
+            "overhead": (
+                self.shadow_seconds / self.live_seconds if self.live_seconds else 0.0
+            ),
+        }
+
+    def _evaluate_shadow(self, shadow: ShadowRule, user_id: str):
+        shadow.evaluations += 1
+        candidate = shadow.rule.abides(user_id)
+        for feature in shadow.features:
+            live = True
+            proposed = True
+            for rule in feature.rules:
+                # kept out of the live rules' cost and failure rates
+                verdict = self.rule_store.abides(rule, user_id, record_stats=False)
+                live = live and verdict
+                if rule is shadow.replaces:
+                    verdict = candidate
+                proposed = proposed and verdict
+            if live == proposed:
+                shadow.agreements += 1
+            elif proposed:
+                shadow.would_grant += 1
+            else:
+                shadow.would_revoke += 1
@@ -0,0 +1,37 @@
+import asyncio
+import os
+from typing import Callable, Optional, Tuple
+
+
+def parse_address(address: str) -> Tuple[str, object]:
+    """
+    "host:port" is tcp, anything else is the path of a unix socket.
+    """
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit() and not address.startswith("/"):
+        return "tcp", (host, int(port))
+    return "unix", address
+
+
+async def open_connection(address: str, limit: Optional[int] = None):
+    kind, target = parse_address(address)
+    kwargs = {} if limit is None else {"limit": limit}
+    if kind == "tcp":
+        return await asyncio.open_connection(*target, **kwargs)
+    return await asyncio.open_unix_connection(target, **kwargs)
+
+
+async def start_server(address: str, handler: Callable) -> asyncio.AbstractServer:
+    kind, target = parse_address(address)
+    if kind == "tcp":
+        return await asyncio.start_server(handler, *target)
+    # left over by a server that didn't shut down cleanly
+    if os.path.exists(target):
+        os.remove(target)
+    return await asyncio.start_unix_server(handler, target)
+
+
+def remove_socket_file(address: str):
+    kind, target = parse_address(address)
+    if kind == "unix" and os.path.exists(target):
+        os.remove(target)
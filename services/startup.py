@@ -0,0 +1,75 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+
+class StartupProfiler:
+    """
+    Records how long each startup phase takes, in order.
+    """
+
+    def __init__(self):
+        self.phases = []
+        self._started_at = time.perf_counter()
+        self.total_seconds = None
+
+    @contextmanager
+    def phase(self, name: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started_at)
+
+    def record(self, name: str, seconds: float):
+        self.phases.append((name, seconds))
+
+    def finish(self):
+        self.total_seconds = time.perf_counter() - self._started_at
+
+    def report(self) -> dict:
+        total = self.total_seconds
+        return {
+            "phases_ms": {
+                name: round(seconds * 1000, 3) for name, seconds in self.phases
+            },
+            "startup_ms": None if total is None else round(total * 1000, 3),
+        }
+
+
+class Readiness:
+    """
+    Set once all state needed to answer access checks is loaded. Handlers that
+    need that state wait on it for a bounded time.
+    """
+
+    def __init__(self):
+        self._ready = False
+        # set once loading either finished or failed
+        self._settled = asyncio.Event()
+        self.error: Optional[BaseException] = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self._ready
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+    def set_ready(self):
+        self._ready = True
+        self._settled.set()
+
+    def set_failed(self, error: BaseException):
+        self.error = error
+        self._settled.set()
+
+    async def wait(self, timeout: float) -> bool:
+        if not self._settled.is_set():
+            try:
+                await asyncio.wait_for(self._settled.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                return False
+        return self.is_ready
@@ -1,12 +1,18 @@
-import asyncio
 import datetime
 import logging
+import time
 import uuid
-from collections import defaultdict, deque
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
 
 from models.event import Event
+from models.memory import estimate_size
 from models.rules import PlatformFeature
+from models.striping import DEFAULT_NUM_STRIPES, StripedLocks
+from services.circuit_breaker import CircuitBreakerConfig, FeatureCircuitBreaker
 from services.feature_registry import PlatformFeaturesRegistry
+from services.grant_feed import GrantChangeFeed, access_etag
+from services.grant_table import GrantTableError, SharedGrantTable
 from services.notifications import NotificationsService
 
 
@@ -16,68 +22,252 @@ class UserFeatureService:
         feature_registry: PlatformFeaturesRegistry,
         notifications_service: NotificationsService,
         logger: logging.Logger,
+        change_feed: Optional[GrantChangeFeed] = None,
+        circuit_configs: Optional[Dict[str, CircuitBreakerConfig]] = None,
+        num_stripes: int = DEFAULT_NUM_STRIPES,
+        grant_table: Optional[SharedGrantTable] = None,
     ):
         features = feature_registry.list_features()
+        self.features = features
         self.logger = logger
-        self._grants = defaultdict(lambda: self._generate_default_grants(features))
+        self.change_feed = change_feed or GrantChangeFeed()
+        # when set, every transition is also published for reader processes
+        self.grant_table = grant_table
+        self.grant_table_errors = 0
+        # user state is split into shards by user id hash, each guarded by its
+        # own lock so different users never wait on each other
+        self._locks = StripedLocks(num_stripes)
+        self._grant_shards = [
+            defaultdict(lambda: self._generate_default_grants(features))
+            for _ in range(num_stripes)
+        ]
+        # bumped on every grant transition of a user, used as the ETag of
+        # access answers together with the circuit epoch
+        self._version_shards = [defaultdict(int) for _ in range(num_stripes)]
         self._notifications_service = notifications_service
-        self._circuits = self._generate_default_grants(features)
-        self._lock = asyncio.Lock()
-        self._access_logs = defaultdict(
-            lambda: deque()
-        )  # Logs of (timestamp, user_id, success)
-        self._total_users = defaultdict(set)  # Track all users per feature
-        self._denied_users = defaultdict(set)  # Track denied users per feature
+        circuit_configs = circuit_configs or {}
+        default_config = circuit_configs.get("default", CircuitBreakerConfig())
+        self._circuits = {
+            feature: FeatureCircuitBreaker(
+                feature.name,
+                circuit_configs.get(feature.name, default_config),
+                logger=logger,
+            )
+            for feature in features
+        }
 
     async def grant(self, user_id: str, feature: PlatformFeature):
-        async with self._lock:
+        async with self._locks.stripe_for(user_id):
             if self._has_grant(user_id, feature):
                 return
-            self._grants[user_id][feature] = True
-            self._send_state_change_message(user_id, feature.name, True)
+            self._grants_for(user_id)[user_id][feature] = True
+            self._record_transition(user_id, feature, True)
 
     async def revoke(self, user_id: str, feature: PlatformFeature):
-        async with self._lock:
+        async with self._locks.stripe_for(user_id):
             if not self._has_grant(user_id, feature):
                 return
-            self._grants[user_id][feature] = False
-            self._send_state_change_message(user_id, feature.name, False)
+            self._grants_for(user_id)[user_id][feature] = False
+            self._record_transition(user_id, feature, False)
 
     async def has_grant(self, user_id: str, feature: PlatformFeature) -> bool:
-        async with self._lock:
-            grant = self._has_grant(user_id, feature)
-            circuit_broken = not self._circuits[feature]
+        async with self._locks.stripe_for(user_id):
+            return self._check_access(user_id, feature)[0]
+
+    async def has_grant_with_etag(
+        self, user_id: str, feature: PlatformFeature
+    ) -> Tuple[bool, str]:
+        """
+        Same as has_grant, also returns an ETag that changes whenever the
+        answer for this user can change: on the user's grant transitions and
+        when any circuit segment opens or closes.
+        """
+        async with self._locks.stripe_for(user_id):
+            has_access, circuit_epoch = self._check_access(user_id, feature)
+            version = self._versions_for(user_id).get(user_id, 0)
+            return has_access, access_etag(version, circuit_epoch)
+
+    def _check_access(
+        self, user_id: str, feature: PlatformFeature
+    ) -> Tuple[bool, int]:
+        """
+        Returns the answer and the circuit epoch it was given at. Logging the
+        attempt may open or close a circuit, the answer doesn't reflect that
+        transition so its ETag must not count it either.
+        """
+        grant = self._has_grant(user_id, feature)
+        circuit_broken = not self._circuits[feature].is_closed(user_id)
+        circuit_epoch = self._circuit_epoch
+
+        # If the circuit is broken, allow all access
+        has_access = circuit_broken or grant
+        # log the real grant
+        self._log_access_attempt(user_id, feature, success=grant)
+        return has_access, circuit_epoch
+
+    async def has_grants(
+        self, user_ids: List[str], features: List[PlatformFeature]
+    ) -> Dict[str, Dict[str, bool]]:
+        """
+        Bulk version of has_grant. Users are grouped by stripe so each stripe
+        lock is taken once, and the access attempts are logged in one pass.
+        """
+        by_stripe = defaultdict(list)
+        for user_id in user_ids:
+            by_stripe[self._locks.index_for(user_id)].append(user_id)
 
-            # If the circuit is broken, allow all access
-            has_access = circuit_broken or grant
-            # log the real grant
-            self._log_access_attempt(user_id, feature, success=grant)
-            return has_access
+        results = dict.fromkeys(user_ids)
+        now = time.monotonic()
+        for index, stripe_user_ids in by_stripe.items():
+            async with self._locks.stripes[index]:
+                grants = self._grant_shards[index]
+                for user_id in stripe_user_ids:
+                    # don't materialize default grants for users we never saw
+                    user_grants = grants.get(user_id)
+                    answers = {}
+                    for feature in features:
+                        grant = True if user_grants is None else user_grants[feature]
+                        circuit_broken = not self._circuits[feature].is_closed(
+                            user_id, now=now
+                        )
+                        answers[feature.name] = circuit_broken or grant
+                        self._log_access_attempt(
+                            user_id, feature, success=grant, now=now
+                        )
+                    results[user_id] = answers
+        return results
 
     def _log_access_attempt(
-        self, user_id: str, feature: PlatformFeature, success: bool
+        self,
+        user_id: str,
+        feature: PlatformFeature,
+        success: bool,
+        now: Optional[float] = None,
     ):
-        now = datetime.datetime.now()
-        log = self._access_logs[feature]
-        log.append((now, user_id, success))
-        # Maintain a sliding window of 10 minutes
-        cutoff = now - datetime.timedelta(minutes=10)
-        while log and log[0][0] < cutoff:
-            _, old_user_id, old_success = log.popleft()
-            self._total_users[feature].discard(old_user_id)
-            if not old_success:
-                self._denied_users[feature].discard(old_user_id)
-
-        self._total_users[feature].add(user_id)
-        if not success:
-            self._denied_users[feature].add(user_id)
+        # the circuit of the user's segment is re-evaluated right away, no
+        # periodic sweep over all features needed
+        self._circuits[feature].record(user_id, success, now=now)
+
+    @property
+    def _circuit_epoch(self) -> int:
+        # changes with every circuit transition, whether an access attempt or
+        # a check found it
+        return sum(breaker.transitions for breaker in self._circuits.values())
+
+    def circuit_breakers(self) -> List[FeatureCircuitBreaker]:
+        return list(self._circuits.values())
+
+    def circuit_breaker_stats(self) -> Dict[str, Dict]:
+        return {
+            feature.name: breaker.stats() for feature, breaker in self._circuits.items()
+        }
+
+    def grant_snapshot(self) -> Tuple[int, List[Tuple[str, int, List[str]]]]:
+        """
+        Returns the change feed sequence and (user id, version, revoked
+        feature names) of every user that ever had a transition. Taken without
+        awaiting, so it is exactly the state after that sequence.
+        """
+        users = []
+        for grants, versions in zip(self._grant_shards, self._version_shards):
+            for user_id, version in versions.items():
+                revoked = [
+                    feature.name
+                    for feature, granted in grants[user_id].items()
+                    if not granted
+                ]
+                users.append((user_id, version, revoked))
+        return self.change_feed.last_seq, users
+
+    @property
+    def num_stripes(self) -> int:
+        return len(self._version_shards)
+
+    def grant_user_ids(self, stripe: int) -> List[str]:
+        """
+        Users of the lock stripe that ever had a grant transition, everyone
+        else has the default grants.
+        """
+        return list(self._version_shards[stripe])
+
+    def grant_rows(
+        self, stripe: int, user_ids: List[str]
+    ) -> List[Tuple[str, int, Dict[PlatformFeature, bool]]]:
+        """
+        (user id, version, grants) of users of the lock stripe, for bulk reads.
+        Taken without awaiting, so the rows are consistent with each other.
+        """
+        versions = self._version_shards[stripe]
+        grants = self._grant_shards[stripe]
+        rows = []
+        for user_id in user_ids:
+            user_grants = grants.get(user_id)
+            if user_grants is None:
+                user_grants = self._generate_default_grants(self.features)
+            rows.append((user_id, versions.get(user_id, 0), user_grants))
+        return rows
+
+    def lock_stats(self) -> Dict:
+        return self._locks.stats()
+
+    def memory_usage(self) -> Dict:
+        grant_users = sum(len(shard) for shard in self._grant_shards)
+        # users whose default grants were materialized without ever changing,
+        # e.g. by access checks for users we have no events for
+        untouched_users = sum(
+            len(grants.keys() - versions.keys())
+            for grants, versions in zip(self._grant_shards, self._version_shards)
+        )
+        return {
+            "grants": {
+                "users": grant_users,
+                "untouched_users": untouched_users,
+                "bytes": estimate_size(self._grant_shards),
+            },
+            "versions": {
+                "users": sum(len(shard) for shard in self._version_shards),
+                "bytes": estimate_size(self._version_shards),
+            },
+            "access_logs": {
+                feature.name: breaker.memory_usage()
+                for feature, breaker in self._circuits.items()
+            },
+        }
+
+    def _grants_for(self, user_id: str) -> Dict:
+        return self._grant_shards[self._locks.index_for(user_id)]
+
+    def _versions_for(self, user_id: str) -> Dict:
+        return self._version_shards[self._locks.index_for(user_id)]
 
     def _has_grant(self, user_id: str, feature: PlatformFeature) -> bool:
-        return self._grants[user_id][feature]
+        return self._grants_for(user_id)[user_id][feature]
 
     def _generate_default_grants(self, features):
         return dict.fromkeys(features, True)
 
+    def _record_transition(
+        self, user_id: str, feature: PlatformFeature, new_grant_state: bool
+    ):
+        versions = self._versions_for(user_id)
+        versions[user_id] += 1
+        self.change_feed.publish(
+            user_id, feature.name, new_grant_state, versions[user_id]
+        )
+        if self.grant_table is not None:
+            try:
+                self.grant_table.set_grants(
+                    user_id, self._grants_for(user_id)[user_id], versions[user_id]
+                )
+            except GrantTableError as e:
+                # the transition already happened and the feed and the
+                # notification still go out, readers of the table would
+                # answer with the old grants so they stop serving it
+                self.grant_table_errors += 1
+                self.grant_table.mark_degraded()
+                self.logger.error(f"Grant table not updated for {user_id}: {e}")
+        self._send_state_change_message(user_id, feature.name, new_grant_state)
+
     def _send_state_change_message(
         self, user_id: str, feature_name: str, new_grant_state: bool
     ):
@@ -93,34 +283,4 @@ class UserFeatureService:
             timestamp=datetime.datetime.now(),
             event_properties=payload,
         )
-        self._notifications_service.send_notification(event)
-
-    async def evaluate_circuit_breakers(self):
-        """
-        Periodically evaluate whether to open or close feature circuits based on user access metrics.
-        """
-        while True:
-            await self._evaluate_circuit_breakers_once()
-            await asyncio.sleep(15)  # Evaluate every minute
-
-    async def _evaluate_circuit_breakers_once(self):
-        self.logger.info("Evaluating circuit breakers")
-        async with self._lock:
-            for feature, total_users in self._total_users.items():
-                total_user_count = len(total_users)
-                denied_user_count = len(self._denied_users[feature])
-                if total_user_count == 0:
-                    continue
-
-                # Calculate the denial percentage
-                denial_rate = (
-                    0 if total_user_count == 0 else denied_user_count / total_user_count
-                )
-                self.logger.info(f"Denial rate for {feature}: {denial_rate}")
-                # Open or close the circuit based on the 5% threshold
-                if denial_rate > 0.05:
-                    self.logger.info(f"Breaking circuit for {feature}")
-                    self._circuits[feature] = False
-                else:
-                    self.logger.info(f"Closing circuit for {feature}")
-                    self._circuits[feature] = True
+        self._notifications_service.send_notification(event, key=user_id)
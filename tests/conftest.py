@@ -1,5 +1,52 @@
 import sys
 from pathlib import Path
 
+import pytest
+
 root_dir = Path(__file__).resolve().parent.parent
 sys.path.insert(0, str(root_dir))
+
+
+class MockPlatformFeature:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"MockPlatformFeature(name='{self.name}')"
+
+
+class MockPlatformFeaturesRegistry:
+    def __init__(self, *names):
+        names = names or ["test_feature"]
+        self.features = [MockPlatformFeature(name) for name in names]
+        self.test_feature = self.features[0]
+
+    def list_features(self):
+        return self.features
+
+
+class FakeClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def make_feature_registry():
+    """
+    Registry of mock features with the given names, a single "test_feature"
+    by default.
+    """
+    return MockPlatformFeaturesRegistry
+
+
+@pytest.fixture
+def feature_registry(make_feature_registry):
+    return make_feature_registry()
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
@@ -1,3 +1,4 @@
+import logging
 import uuid
 from datetime import datetime
 from unittest.mock import Mock
@@ -9,10 +10,19 @@ from models.aggregate import (
     AggregateType,
     EventAggregate,
     EventAggregateConfig,
+    EventAggregateStore,
 )
 from models.event import (
+    CompactEvent,
     Event,
+    PurchaseEventProperties,
+    ScamFlagEventProperties,
 )
+from models.rules import PlatformFeature, Rule, RuleCondition, RuleOperation, RulesStore
+from services.event_processer import EventProcessor
+from services.feature_registry import PlatformFeaturesRegistry
+from services.notifications import NotificationsService
+from services.user_feature import UserFeatureService
 
 
 def test_event_aggregate_config_count_no_field():
@@ -101,33 +111,25 @@ def test_event_aggregate_count():
     assert value_2 == 1
 
 
-def test_event_aggregate_count_dedup():
-    # Create an EventAggregate of type COUNT
+def test_event_aggregate_count_counts_every_update():
+    # duplicates are dropped at ingest by the EventDeduplicator, the
+    # aggregate itself no longer keeps the uuids around
     aggregate = EventAggregate(
         name="count_aggregate", event_name="test_event", type=AggregateType.COUNT
     )
 
-    # Create events with user_id
     user_id = "user_1"
-    event_properties = {}
     event = Event(
         uuid=uuid.uuid4(),
         name="test_event",
         timestamp=datetime.now(),
-        event_properties=event_properties,
+        event_properties={},
     )
 
-    event2 = event
-
-    # Update the aggregate with the event
+    aggregate.update(user_id=user_id, event=event)
     aggregate.update(user_id=user_id, event=event)
     value = aggregate.get_user_aggregate(user_id=user_id)
-    assert value == 1
-
-    # Update again, should get the same count
-    aggregate.update(user_id=user_id, event=event2)
-    value = aggregate.get_user_aggregate(user_id=user_id)
-    assert value == 1
+    assert value == 2
 
 
 def test_event_aggregate_sum_with_mock_properties():
@@ -167,3 +169,228 @@ def test_event_aggregate_sum_with_mock_properties():
     aggregate.update(user_id=user_id_2, event=mock_event_3)
     value_2 = aggregate.get_user_aggregate(user_id=user_id_2)
     assert value_2 == 200.0
+
+
+def test_event_aggregate_value_cache_invalidated_on_change():
+    aggregate = EventAggregate(
+        name="distinct_aggregate",
+        event_name="test_event",
+        type=AggregateType.DISTINCT_COUNT,
+        field="zipcode",
+    )
+    user_id = "user_1"
+    event = Mock()
+    event.event_properties = Mock(zipcode="12345")
+
+    assert aggregate.get_user_aggregate(user_id=user_id) == 0
+    assert aggregate.update(user_id=user_id, event=event) is True
+    assert aggregate.get_user_aggregate(user_id=user_id) == 1
+
+    # a repeated zipcode does not change the value so the cached value is kept
+    assert aggregate.update(user_id=user_id, event=event) is False
+    assert user_id in aggregate._values
+    assert aggregate.get_user_aggregate(user_id=user_id) == 1
+
+
+def test_event_aggregate_value_cache_is_bounded():
+    aggregate = EventAggregate(
+        name="count_aggregate",
+        event_name="test_event",
+        type=AggregateType.COUNT,
+        value_cache_size=2,
+    )
+    for user_id in ("user_1", "user_2", "user_3"):
+        aggregate.get_user_aggregate(user_id=user_id)
+
+    assert len(aggregate._values) == 2
+    assert "user_1" not in aggregate._values
+    assert aggregate._values.evictions == 1
+
+
+def test_event_aggregate_sum_with_compact_event():
+    aggregate = EventAggregate(
+        name="sum_aggregate",
+        event_name="purchase",
+        type=AggregateType.SUM,
+        field="amount",
+    )
+    event = CompactEvent.from_event(
+        Event(
+            uuid=uuid.uuid4(),
+            name="purchase",
+            timestamp=datetime.now(),
+            event_properties=PurchaseEventProperties(user_id="user_1", amount=25.0),
+        )
+    )
+
+    assert event.user_id == "user_1"
+    assert event.properties == {"amount": 25.0}
+    aggregate.update(user_id=event.user_id, event=event)
+    aggregate.update(user_id=event.user_id, event=event)
+    assert aggregate.get_user_aggregate(user_id="user_1") == 50.0
+
+
+def test_compact_event_without_properties():
+    event_id = uuid.uuid4()
+    timestamp = datetime.now()
+    event = CompactEvent.from_event(
+        Event(
+            uuid=event_id,
+            name="scam_flag",
+            timestamp=timestamp,
+            event_properties=ScamFlagEventProperties(user_id="user_1"),
+        )
+    )
+
+    assert event.uuid == event_id.int
+    assert event.timestamp == timestamp.timestamp()
+    assert event.properties is None
+    assert event.get("amount") is None
+    assert not hasattr(event, "__dict__")
+
+
+def make_purchase(user_id, amount):
+    return CompactEvent(
+        uuid=0,
+        name="purchase",
+        timestamp=0.0,
+        user_id=user_id,
+        properties={"amount": amount},
+    )
+
+
+def test_event_aggregate_config_percentile_needs_quantile():
+    with pytest.raises(ValueError, match="quantile"):
+        EventAggregateConfig(
+            type="percentile", name="p95", event_name="purchase", field="amount"
+        )
+    with pytest.raises(ValueError, match="Quantile"):
+        EventAggregateConfig(
+            type="avg",
+            name="avg",
+            event_name="purchase",
+            field="amount",
+            quantile=0.5,
+        )
+
+
+def test_event_aggregate_running_stats():
+    aggregates = {
+        type: EventAggregate(
+            name=type.value, event_name="purchase", type=type, field="amount"
+        )
+        for type in (
+            AggregateType.MIN,
+            AggregateType.MAX,
+            AggregateType.AVG,
+            AggregateType.VARIANCE,
+        )
+    }
+    changes = []
+    for amount in (10.0, 30.0, 20.0):
+        event = make_purchase("user_1", amount)
+        changes.append(aggregates[AggregateType.MAX].update("user_1", event))
+        for type in (AggregateType.MIN, AggregateType.AVG, AggregateType.VARIANCE):
+            aggregates[type].update("user_1", event)
+
+    # the max only changed when a larger amount came in
+    assert changes == [True, True, False]
+    assert aggregates[AggregateType.MIN].get_user_aggregate("user_1") == 10.0
+    assert aggregates[AggregateType.MAX].get_user_aggregate("user_1") == 30.0
+    assert aggregates[AggregateType.AVG].get_user_aggregate("user_1") == 20.0
+    assert aggregates[AggregateType.VARIANCE].get_user_aggregate(
+        "user_1"
+    ) == pytest.approx(200 / 3)
+    assert aggregates[AggregateType.AVG].get_user_aggregate("user_2") == 0
+
+
+def test_percentile_aggregate_in_rule():
+    aggregate = EventAggregate(
+        name="purchase_amount_p95",
+        event_name="purchase",
+        type=AggregateType.PERCENTILE,
+        field="amount",
+        quantile=0.95,
+    )
+    rule = Rule(
+        name="big_spender",
+        operation=RuleOperation.VALUE,
+        aggregate1=aggregate,
+        aggregate2=None,
+        value=90,
+        condition=RuleCondition.GREATER_THAN,
+    )
+    for amount in range(1, 101):
+        aggregate.update("user_1", make_purchase("user_1", float(amount)))
+        aggregate.update("user_2", make_purchase("user_2", float(amount) / 2))
+
+    assert aggregate.get_user_aggregate("user_1") == pytest.approx(95, abs=1)
+    assert rule.abides("user_1")
+    assert not rule.abides("user_2")
+    assert not rule.monotonic
+
+
+def test_partial_states_merge_into_the_aggregate():
+    aggregate = EventAggregate(
+        name="purchase_amount_p50",
+        event_name="purchase",
+        type=AggregateType.PERCENTILE,
+        field="amount",
+        quantile=0.5,
+    )
+    aggregate.update("user_1", make_purchase("user_1", 1.0))
+    assert aggregate.get_user_aggregate("user_1") == 1.0
+
+    # e.g. a batch of events aggregated by another shard
+    batch = aggregate.new_state()
+    for amount in (5.0, 6.0, 7.0, 8.0):
+        batch.add(amount)
+    aggregate.merge("user_1", batch)
+
+    assert aggregate.get_user_aggregate("user_1") == pytest.approx(6.0, abs=0.5)
+
+    counts = EventAggregate(
+        name="count_aggregate", event_name="test_event", type=AggregateType.COUNT
+    )
+    counts.merge("user_1", 3)
+    assert counts.get_user_aggregate("user_1") == 3
+
+
+@pytest.mark.asyncio
+async def test_merges_crossing_a_threshold_change_the_grant():
+    aggregate = EventAggregate(
+        name="purchase_count", event_name="purchase", type=AggregateType.COUNT
+    )
+    agg_store = EventAggregateStore()
+    agg_store.add_aggregate(aggregate)
+    rule = Rule(
+        name="few_purchases",
+        operation=RuleOperation.VALUE,
+        aggregate1=aggregate,
+        aggregate2=None,
+        value=5,
+        condition=RuleCondition.LESS_THAN,
+    )
+    rule_store = RulesStore()
+    rule_store.add_rule(rule)
+    feature = PlatformFeature("purchase", [rule])
+    feature_registry = PlatformFeaturesRegistry()
+    feature_registry.add_feature(feature)
+    logger = logging.getLogger(__name__)
+    user_feature_service = UserFeatureService(
+        feature_registry, NotificationsService(), logger=logger
+    )
+    processor = EventProcessor(
+        agg_store, rule_store, feature_registry, user_feature_service, logger
+    )
+
+    await processor.process_event(make_purchase("user_1", 1.0))
+    # one purchase, the verdict is cached with headroom for three more
+    assert rule_store.abides(rule, "user_1")
+    assert await user_feature_service.has_grant("user_1", feature)
+
+    await processor.merge_state("user_1", "purchase_count", 10)
+
+    assert aggregate.get_user_aggregate("user_1") == 11
+    assert not rule_store.abides(rule, "user_1")
+    assert not await user_feature_service.has_grant("user_1", feature)
@@ -0,0 +1,102 @@
+import asyncio
+import uuid
+
+import pytest
+
+import app_builder
+from load_testing.workload import asgi_request
+from services.event_dispatcher import KeyedEventDispatcher
+
+
+@pytest.fixture
+def app(monkeypatch):
+    import app as app_module
+
+    # the module level queue is bound to the event loop of the first test that
+    # waits on it
+    queue = KeyedEventDispatcher(
+        lanes=app_builder.get_event_lanes(app_builder.DEFAULT_EVENT_LANES_CONFIG_DICT),
+    )
+    monkeypatch.setattr(app_builder, "event_queue", queue)
+    monkeypatch.setattr(app_module, "event_queue", queue)
+    return app_module.app
+
+
+def make_event():
+    return {
+        "uuid": str(uuid.uuid4()),
+        "name": "purchase",
+        "timestamp": "2024-01-01T00:00:00",
+        "event_properties": {"user_id": "user_1", "amount": 10.0},
+    }
+
+
+@pytest.mark.asyncio
+async def test_events_are_rejected_once_loading_failed(app, monkeypatch):
+    async def broken_rule_store(*args):
+        raise ValueError("bad rule config")
+
+    monkeypatch.setattr(app_builder, "build_rule_store", broken_rule_store)
+    async with app.router.lifespan_context(app):
+        assert not await app.state.readiness.wait(1)
+        assert await asgi_request(app, "POST", "/event", make_event()) == 503
+        assert app.state.event_queue.qsize() == 0
+        assert await asgi_request(app, "GET", "/ready") == 503
+
+
+@pytest.mark.asyncio
+async def test_feature_checks_wait_for_startup(app, monkeypatch):
+    build_rule_store = app_builder.build_rule_store
+
+    async def slow_rule_store(*args):
+        await asyncio.sleep(0.1)
+        return await build_rule_store(*args)
+
+    monkeypatch.setattr(app_builder, "build_rule_store", slow_rule_store)
+    headers = {"x-user-id": "user_1"}
+    async with app.router.lifespan_context(app):
+        # sent before the feature routes exist
+        assert not app.state.readiness.is_ready
+        known, unknown = await asyncio.gather(
+            asgi_request(app, "GET", "/canpurchase", headers=headers),
+            asgi_request(app, "GET", "/canfly", headers=headers),
+        )
+        assert (known, unknown) == (200, 404)
+
+
+@pytest.mark.asyncio
+async def test_memory_report_waits_for_startup(app, monkeypatch):
+    build_rule_store = app_builder.build_rule_store
+
+    async def slow_rule_store(*args):
+        await asyncio.sleep(0.1)
+        return await build_rule_store(*args)
+
+    monkeypatch.setattr(app_builder, "build_rule_store", slow_rule_store)
+    async with app.router.lifespan_context(app):
+        assert await asgi_request(app, "GET", "/dedupe-stats") == 200
+        assert await asgi_request(app, "GET", "/queue-lanes") == 200
+        assert not app.state.readiness.is_ready
+        assert await asgi_request(app, "GET", "/debug/memory") == 200
+        assert app.state.readiness.is_ready
+
+
+@pytest.mark.asyncio
+async def test_feature_routes(app):
+    from app import register_feature_routes, unknown_feature
+
+    headers = {"x-user-id": "user_1"}
+    async with app.router.lifespan_context(app):
+        assert await app.state.readiness.wait(5)
+        assert await asgi_request(app, "GET", "/canpurchase", headers=headers) == 200
+        assert await asgi_request(app, "GET", "/canfly", headers=headers) == 404
+        assert await asgi_request(app, "GET", "/canFOO1", headers=headers) == 400
+        assert await asgi_request(app, "GET", "/purchase", headers=headers) == 400
+
+        register_feature_routes(
+            app, app.state.feature_registry, app.state.user_feature_service
+        )
+        paths = [getattr(route, "path", None) for route in app.router.routes]
+        assert paths.count("/canpurchase") == 1
+        assert app.router.routes[-1].endpoint is unknown_feature
+        assert await asgi_request(app, "GET", "/canpurchase", headers=headers) == 200
@@ -0,0 +1,122 @@
+import pytest
+
+from models.aggregate import AggregateType, EventAggregate
+from models.cold_store import SqliteColdStore, TieredUserStore
+from models.event import CompactEvent
+
+
+@pytest.fixture
+def cold_store():
+    store = SqliteColdStore()
+    yield store
+    store.close()
+
+
+def make_event(user_id, **properties):
+    return CompactEvent(
+        uuid=0, name="test_event", timestamp=0.0, user_id=user_id, properties=properties
+    )
+
+
+def test_cold_users_are_promoted_on_access(cold_store):
+    tiered = TieredUserStore("agg", cold_store, int, hot_size=2)
+    for user_id in ("user_1", "user_2", "user_3"):
+        tiered[user_id] += 1
+
+    # user_1 was the least recently used one
+    assert tiered.stats()["hot_users"] == 2
+    assert cold_store.count("agg") == 1
+    assert len(tiered) == 3
+
+    assert tiered.get("user_1") == 1
+    stats = tiered.stats()
+    assert stats["promotions"] == 1
+    assert stats["demotions"] == 2
+    # promoting user_1 pushed user_2 out
+    assert cold_store.count("agg") == 1
+    assert tiered.get("unknown") is None
+    # first seen users are looked up in the cold store too
+    assert tiered.stats()["cold_misses"] == 4
+    assert "unknown" not in tiered._hot
+
+
+def test_user_ids_are_paged_in_chunks(cold_store):
+    tiered = TieredUserStore("agg", cold_store, int, hot_size=2)
+    for i in range(7):
+        tiered[f"user_{i}"] += 1
+
+    chunks = tiered.user_id_chunks(2)
+    assert next(chunks) == ["user_5", "user_6"]
+    # demoted while the cold users are paged through, not listed twice
+    tiered["user_7"] += 1
+    rest = list(chunks)
+    assert [len(chunk) for chunk in rest] == [2, 2, 1]
+    assert sorted(sum(rest, [])) == [f"user_{i}" for i in range(5)]
+    assert cold_store.user_ids("agg", after="user_3") == ["user_4", "user_5"]
+
+
+def test_users_promoted_between_chunks_are_still_listed(cold_store):
+    tiered = TieredUserStore("agg", cold_store, int, hot_size=2)
+    for i in range(7):
+        tiered[f"user_{i}"] += 1
+
+    chunks = tiered.user_id_chunks(2)
+    listed = next(chunks) + next(chunks)
+    assert listed == ["user_5", "user_6", "user_0", "user_1"]
+    # user_3's row is gone before its page is read, user_0 was listed already
+    assert tiered.get("user_3") == 1
+    assert tiered.get("user_0") == 1
+    for chunk in chunks:
+        listed += chunk
+
+    assert sorted(listed) == [f"user_{i}" for i in range(7)]
+    assert not tiered._scans
+
+
+@pytest.mark.parametrize(
+    "type, field, values, expected",
+    [
+        (AggregateType.COUNT, None, [None, None, None], 3),
+        (AggregateType.SUM, "amount", [10, 2.5, 7], 19.5),
+        (AggregateType.DISTINCT_COUNT, "zipcode", ["1", "2", "1", 3], 3),
+    ],
+)
+def test_tiered_aggregate_matches_in_memory(cold_store, type, field, values, expected):
+    in_memory = EventAggregate("agg", "test_event", type, field=field)
+    tiered = EventAggregate(
+        "agg", "test_event", type, field=field, cold_store=cold_store, hot_size=1
+    )
+    user_ids = [f"user_{i}" for i in range(5)]
+    for value in values:
+        for user_id in user_ids:
+            event = make_event(user_id, **({field: value} if field else {}))
+            in_memory.update(user_id, event)
+            tiered.update(user_id, event)
+
+    for user_id in user_ids:
+        assert tiered.get_user_aggregate(user_id) == expected
+        assert in_memory.get_user_aggregate(user_id) == expected
+    stats = tiered.tier_stats()
+    assert stats["hot_users"] == 1
+    assert stats["cold_users"] == 4
+    assert stats["cold_read_ms"]["max"] > 0
+
+
+def test_sketch_state_survives_demotion(cold_store):
+    aggregate = EventAggregate(
+        name="p90",
+        event_name="test_event",
+        type=AggregateType.PERCENTILE,
+        field="amount",
+        quantile=0.9,
+        cold_store=cold_store,
+        hot_size=1,
+    )
+    for amount in range(1, 101):
+        aggregate.update("user_1", make_event("user_1", amount=float(amount)))
+    expected = aggregate.get_user_aggregate("user_1")
+    aggregate._values.pop("user_1")
+
+    aggregate.update("user_2", make_event("user_2", amount=1.0))
+    assert cold_store.count("p90") == 1
+    assert aggregate.get_user_aggregate("user_1") == expected
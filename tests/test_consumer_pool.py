@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import time
+
+import pytest
+
+from models.event import CompactEvent
+from services.consumer_pool import AutoscaleConfig, ConsumerPool
+from services.event_dispatcher import KeyedEventDispatcher
+from services.event_processer import EventConsumer
+
+logger = logging.getLogger(__name__)
+
+
+class WaitingProcessor:
+    """Spends its time waiting, like on a lock or a subscriber."""
+
+    async def process_event(self, event):
+        await asyncio.sleep(0.01)
+
+
+class BusyProcessor:
+    """Holds the event loop, more consumers can't make it any faster."""
+
+    async def process_event(self, event):
+        time.sleep(0.002)
+        await asyncio.sleep(0)
+
+
+def build_pool(processor, clock, events=400):
+    queue = KeyedEventDispatcher()
+    for seq in range(events):
+        queue.put_nowait(
+            CompactEvent(uuid=seq, name="purchase", timestamp=0.0, user_id=f"u{seq}")
+        )
+    consumer = EventConsumer(queue, processor, logger)
+    # evaluate() is called by the tests instead of the controller task
+    config = AutoscaleConfig(
+        min_consumers=1, max_consumers=8, interval=3600, scale_down_after=30
+    )
+    return ConsumerPool(consumer, logger, config, initial_consumers=1, clock=clock)
+
+
+def test_config_bounds_are_validated():
+    with pytest.raises(ValueError):
+        AutoscaleConfig(min_consumers=0)
+    with pytest.raises(ValueError):
+        AutoscaleConfig(min_consumers=4, max_consumers=2)
+
+
+@pytest.mark.asyncio
+async def test_pool_grows_with_a_backlog_and_shrinks_once_idle(clock):
+    pool = build_pool(WaitingProcessor(), clock)
+    pool.start()
+    await asyncio.sleep(0.2)
+
+    clock.now = 1
+    assert pool.evaluate() == 2
+    assert pool.decisions[-1]["reason"] == "scale_up"
+
+    await asyncio.sleep(0.2)
+    clock.now = 2
+    pool.evaluate()
+    assert not pool.saturated
+    assert pool.size >= 2
+
+    await asyncio.wait_for(pool.queue.join(), timeout=10)
+    clock.now = 40
+    size = pool.evaluate()
+    assert size >= 2  # not retired right away
+    clock.now = 71
+    assert pool.evaluate() == 1
+    assert pool.decisions[-1]["reason"] == "scale_down"
+    await asyncio.sleep(0)
+    assert pool.stats()["consumers"] == 1
+    assert len(pool._workers) == 1
+
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_scale_up_that_does_not_help_is_undone(clock):
+    pool = build_pool(BusyProcessor(), clock, events=2000)
+    pool.start()
+    await asyncio.sleep(0.3)
+
+    clock.now = 1
+    assert pool.evaluate() == 2
+    await asyncio.sleep(0.3)
+    clock.now = 2
+    assert pool.evaluate() == 1
+    assert pool.saturated
+    assert pool.decisions[-1]["reason"] == "saturated"
+
+    # held until the backlog is gone
+    await asyncio.sleep(0.3)
+    clock.now = 3
+    assert pool.evaluate() == 1
+
+    await pool.close()
@@ -0,0 +1,90 @@
+import uuid
+
+import pytest
+
+from services.dedupe import BloomFilter, EventDeduplicator
+
+
+def test_bloom_filter_membership():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    keys = [uuid.uuid4().bytes for _ in range(1000)]
+    for key in keys:
+        bloom.add(key)
+
+    assert all(key in bloom for key in keys)
+    assert bloom.is_full()
+    false_positives = sum(uuid.uuid4().bytes in bloom for _ in range(10000))
+    assert false_positives < 300
+
+
+def test_bloom_filter_invalid_error_rate():
+    with pytest.raises(ValueError):
+        BloomFilter(capacity=10, error_rate=1.5)
+
+
+def test_deduplicator_drops_recent_duplicates(clock):
+    dedupe = EventDeduplicator(clock=clock)
+    event_id = uuid.uuid4()
+
+    assert dedupe.check_and_add(event_id) is False
+    assert dedupe.check_and_add(event_id) is True
+    assert dedupe.check_and_add(uuid.uuid4()) is False
+    assert dedupe.exact_duplicates == 1
+
+
+def test_reserved_ids_are_duplicates_until_released(clock):
+    dedupe = EventDeduplicator(clock=clock)
+    event_id = uuid.uuid4()
+
+    assert dedupe.check_and_reserve(event_id) is False
+    assert dedupe.check_and_reserve(event_id) is True
+    dedupe.release(event_id)
+    assert dedupe.check_and_reserve(event_id) is False
+    dedupe.commit(event_id)
+    assert dedupe.check_and_reserve(event_id) is True
+    assert dedupe.stats()["reserved_ids"] == 0
+
+
+def test_deduplicator_folds_old_buckets_into_bloom_filter(clock):
+    dedupe = EventDeduplicator(bucket_seconds=1, num_buckets=2, clock=clock)
+    event_id = uuid.uuid4()
+    dedupe.check_and_add(event_id)
+
+    clock.now = 5
+    assert dedupe.check_and_add(event_id) is True
+    assert dedupe.probable_duplicates == 1
+    assert dedupe.stats()["recent_ids"] == 0
+    assert dedupe.stats()["bloom_ids"] == 1
+
+
+def test_deduplicator_memory_is_bounded_by_bloom_generations(clock):
+    dedupe = EventDeduplicator(
+        bucket_seconds=1,
+        num_buckets=1,
+        bloom_capacity=10,
+        bloom_generations=2,
+        clock=clock,
+    )
+    first = uuid.uuid4()
+    dedupe.check_and_add(first)
+    for i in range(1, 40):
+        clock.now = i
+        dedupe.check_and_add(uuid.uuid4())
+
+    assert dedupe.stats()["bloom_filters"] == 2
+    # the oldest ids have been rotated out with their filter
+    assert dedupe.check_and_add(first) is False
+
+
+def test_expiring_a_bucket_does_no_bloom_work(monkeypatch, clock):
+    dedupe = EventDeduplicator(bucket_seconds=1, num_buckets=1, clock=clock)
+    for _ in range(100):
+        dedupe.check_and_add(uuid.uuid4())
+
+    added = []
+    monkeypatch.setattr(BloomFilter, "add", lambda self, key: added.append(key))
+    clock.now = 5
+    dedupe._rotate(clock())
+    assert added == []
+    assert dedupe.stats()["recent_ids"] == 0
+    assert dedupe.stats()["bloom_ids"] == 100
@@ -0,0 +1,173 @@
+import asyncio
+
+import pytest
+
+from config import DEFAULT_EVENT_LANES_CONFIG_DICT, get_event_lanes
+from models.event import CompactEvent
+from services.event_dispatcher import EventLane, KeyedEventDispatcher
+
+
+def make_event(user_id, seq):
+    return CompactEvent(uuid=seq, name="scam_flag", timestamp=0.0, user_id=user_id)
+
+
+@pytest.mark.asyncio
+async def test_user_is_held_by_one_consumer_until_task_done():
+    dispatcher = KeyedEventDispatcher()
+    await dispatcher.put(make_event("user_1", 1))
+    await dispatcher.put(make_event("user_1", 2))
+
+    user_id, event = await dispatcher.get()
+    assert event.uuid == 1
+
+    # the second event for the same user is not available while the first
+    # one is still being processed
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(dispatcher.get(), timeout=0.01)
+
+    dispatcher.task_done(user_id)
+    user_id, event = await dispatcher.get()
+    assert event.uuid == 2
+    dispatcher.task_done(user_id)
+    await asyncio.wait_for(dispatcher.join(), timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_consumers_process_each_user_in_order():
+    dispatcher = KeyedEventDispatcher()
+    users = [f"user_{i}" for i in range(10)]
+    for seq in range(20):
+        for user_id in users:
+            await dispatcher.put(make_event(user_id, seq))
+
+    processed = {user_id: [] for user_id in users}
+    in_flight = set()
+
+    async def consume():
+        while True:
+            user_id, event = await dispatcher.get()
+            assert user_id == event.user_id
+            assert event.user_id not in in_flight
+            in_flight.add(event.user_id)
+            await asyncio.sleep(0)
+            processed[event.user_id].append(event.uuid)
+            in_flight.discard(event.user_id)
+            dispatcher.task_done(user_id)
+
+    consumers = [asyncio.create_task(consume()) for _ in range(5)]
+    await asyncio.wait_for(dispatcher.join(), timeout=5)
+    for task in consumers:
+        task.cancel()
+    await asyncio.gather(*consumers, return_exceptions=True)
+
+    assert dispatcher.qsize() == 0
+    for user_id in users:
+        assert processed[user_id] == list(range(20))
+
+
+def make_named_event(user_id, seq, name):
+    return CompactEvent(uuid=seq, name=name, timestamp=0.0, user_id=user_id)
+
+
+@pytest.mark.asyncio
+async def test_high_weight_lane_is_served_ahead_of_a_backlog():
+    dispatcher = KeyedEventDispatcher(
+        lanes=[EventLane("revocations", weight=8, event_names=["chargeback"])],
+    )
+    users = [f"user_{i}" for i in range(11)]
+    for seq in range(100):
+        await dispatcher.put(make_named_event(users[seq % 10], seq, "purchase"))
+    await dispatcher.put(make_named_event(users[10], 100, "chargeback"))
+
+    order = []
+    for _ in range(10):
+        user_id, event = await dispatcher.get()
+        order.append(event.name)
+        dispatcher.task_done(user_id)
+
+    assert "chargeback" in order[:2]
+    stats = dispatcher.lane_stats()
+    assert stats["revocations"]["depth"] == 0
+    assert stats["default"]["depth"] == 91
+
+
+@pytest.mark.asyncio
+async def test_lanes_never_reorder_a_users_events():
+    dispatcher = KeyedEventDispatcher(
+        lanes=[EventLane("revocations", weight=8, event_names=["chargeback"])],
+    )
+    users = [f"user_{i}" for i in range(5)]
+    for seq, user_id in enumerate(users):
+        await dispatcher.put(make_named_event(user_id, seq, "purchase"))
+    # the chargeback must not be applied before the purchase it follows
+    await dispatcher.put(make_named_event(users[0], 5, "purchase"))
+    await dispatcher.put(make_named_event(users[0], 6, "chargeback"))
+
+    order = []
+    for _ in range(7):
+        user_id, event = await dispatcher.get()
+        if event.user_id == users[0]:
+            order.append(event.uuid)
+        dispatcher.task_done(user_id)
+
+    assert order == [0, 5, 6]
+
+
+@pytest.mark.asyncio
+async def test_revocation_overtakes_a_burst_of_other_users_purchases():
+    dispatcher = KeyedEventDispatcher(
+        lanes=get_event_lanes(DEFAULT_EVENT_LANES_CONFIG_DICT)
+    )
+    for seq in range(10_000):
+        await dispatcher.put(make_named_event(f"user_{seq}", seq, "purchase"))
+    await dispatcher.put(make_named_event("user_10000", 10_000, "chargeback"))
+
+    for position in range(10_001):
+        user_id, event = await dispatcher.get()
+        dispatcher.task_done(user_id)
+        if event.name == "chargeback":
+            break
+    assert position < 2
+    assert dispatcher.qsize() == 10_000 - position
+
+
+@pytest.mark.asyncio
+async def test_lanes_share_dequeues_by_weight():
+    dispatcher = KeyedEventDispatcher(
+        lanes=[EventLane("high", weight=3, event_names=["scam_flag"])],
+    )
+    for seq, user_id in enumerate(f"user_{i}" for i in range(400)):
+        name = "scam_flag" if seq % 2 else "purchase"
+        await dispatcher.put(make_named_event(user_id, seq, name))
+
+    names = []
+    for _ in range(200):
+        user_id, event = await dispatcher.get()
+        names.append(event.name)
+        dispatcher.task_done(user_id)
+
+    assert names.count("scam_flag") == 150
+
+
+@pytest.mark.asyncio
+async def test_lane_waits_are_reported_against_their_target():
+    clock = iter([0.0, 0.0, 0.5, 0.5])
+    dispatcher = KeyedEventDispatcher(
+        lanes=[
+            EventLane(
+                "revocations", event_names=["chargeback"], wait_target_ms=100
+            )
+        ],
+        clock=lambda: next(clock),
+    )
+    await dispatcher.put(make_named_event("user_1", 1, "chargeback"))
+    await dispatcher.put(make_named_event("user_2", 2, "purchase"))
+    for _ in range(2):
+        user_id, _ = await dispatcher.get()
+        dispatcher.task_done(user_id)
+
+    stats = dispatcher.lane_stats()["revocations"]
+    assert stats["over_target"] == 1
+    assert stats["wait_ms"]["max"] == 500
+    assert dispatcher.lane_for("chargeback") == "revocations"
+    assert dispatcher.lane_for("purchase") == "default"
@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+import pytest
+
+from models.event import CompactEvent
+from services.freshness import FreshnessTracker
+
+
+@pytest.fixture
+def clock(clock):
+    clock.now = 100.0
+    return clock
+
+
+def make_event(seq, timestamp):
+    return CompactEvent(uuid=seq, name="purchase", timestamp=timestamp, user_id="u")
+
+
+def test_lag_is_recorded_per_hop(clock):
+    tracker = FreshnessTracker(target_ms=1000, clock=clock)
+    event = make_event(1, timestamp=99.5)
+
+    tracker.accepted(event)
+    clock.now = 100.25
+    dequeued_at = tracker.dequeued(event)
+    clock.now = 101.0
+    tracker.processed(event, dequeued_at)
+
+    hops = tracker.stats()["hops"]
+    assert hops["ingest"]["max_ms"] == 500
+    assert hops["queue"]["max_ms"] == 250
+    assert hops["process"]["max_ms"] == 750
+    assert hops["end_to_end"]["max_ms"] == 1500
+    assert hops["end_to_end"]["over_target"] == 1
+
+
+def test_watermark_is_the_oldest_unprocessed_event_time(clock):
+    tracker = FreshnessTracker(clock=clock)
+    events = [make_event(seq, timestamp) for seq, timestamp in enumerate([5, 3, 8])]
+    for event in events:
+        tracker.accepted(event)
+    assert tracker.watermark() == 3
+
+    # processed out of order, the watermark only moves once 3 is done
+    tracker.processed(events[0], clock())
+    assert tracker.watermark() == 3
+    tracker.processed(events[1], clock())
+    assert tracker.watermark() == 8
+    tracker.processed(events[2], clock())
+    assert tracker.watermark() == clock.now
+    assert tracker.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_reads_wait_for_the_watermark(clock):
+    tracker = FreshnessTracker(clock=clock)
+    first, second = make_event(1, timestamp=10), make_event(2, timestamp=20)
+    tracker.accepted(first)
+    tracker.accepted(second)
+
+    assert await tracker.wait_for(5, timeout=0)
+    waiter = asyncio.create_task(tracker.wait_for(10, timeout=5))
+    await asyncio.sleep(0)
+    assert not waiter.done()
+    tracker.processed(first, clock())
+    assert await waiter
+
+    assert not await tracker.wait_for(20, timeout=0.01)
+    assert tracker.stats()["wait_timeouts"] == 1
+    assert tracker.stats()["waits"] == 2
+
+
+@pytest.mark.asyncio
+async def test_reads_slightly_ahead_of_the_clock_wait_for_it():
+    tracker = FreshnessTracker()
+    started_at = time.monotonic()
+    # nothing pending, fresh_as_of from a client clock a bit ahead of ours
+    assert await tracker.wait_for(time.time() + 0.02, timeout=1)
+    assert time.monotonic() - started_at < 0.5
+    assert tracker.stats()["wait_timeouts"] == 0
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from services.grant_feed import GrantChangeFeed
+
+
+def test_since_returns_entries_after_sequence():
+    feed = GrantChangeFeed()
+    feed.publish("user_1", "purchase", False, 1)
+    feed.publish("user_2", "purchase", False, 1)
+
+    changes, truncated = feed.since(1)
+    assert [change["seq"] for change in changes] == [2]
+    assert not truncated
+    assert feed.since(2) == ([], False)
+
+
+def test_since_reports_truncation_when_reader_fell_behind():
+    feed = GrantChangeFeed(max_entries=2)
+    for i in range(5):
+        feed.publish(f"user_{i}", "purchase", False, 1)
+
+    changes, truncated = feed.since(0)
+    assert truncated
+    assert [change["seq"] for change in changes] == [4, 5]
+
+
+@pytest.mark.asyncio
+async def test_wait_since_wakes_up_on_publish():
+    feed = GrantChangeFeed()
+    waiter = asyncio.create_task(feed.wait_since(0, timeout=5))
+    await asyncio.sleep(0)
+    feed.publish("user_1", "message", False, 1)
+
+    changes, _ = await asyncio.wait_for(waiter, timeout=1)
+    assert changes[0]["user_id"] == "user_1"
+
+
+@pytest.mark.asyncio
+async def test_wait_since_times_out_without_changes():
+    feed = GrantChangeFeed()
+    assert await feed.wait_since(0, timeout=0.01) == ([], False)
+
+
+@pytest.mark.asyncio
+async def test_sequence_from_before_a_restart_is_truncated():
+    feed = GrantChangeFeed()
+    assert await feed.wait_since(5000, timeout=0.01) == ([], True)
+
+    feed.publish("user_1", "purchase", False, 1)
+    changes, truncated = feed.since(5000)
+    assert [change["seq"] for change in changes] == [1]
+    assert truncated
+
+
+def test_cursor_of_another_boot_resets():
+    old = GrantChangeFeed(boot_id="old")
+    feed = GrantChangeFeed(boot_id="new")
+    feed.publish("user_1", "purchase", False, 1)
+
+    assert feed.parse_cursor(feed.cursor(1)) == (1, False)
+    assert feed.parse_cursor("1") == (1, False)
+    assert feed.parse_cursor(old.cursor(1)) == (0, True)
+    assert feed.parse_cursor(feed.cursor(2)) == (0, True)
+    assert feed.parse_cursor("garbage") == (0, True)
@@ -0,0 +1,317 @@
+import logging
+import multiprocessing
+import uuid
+
+import pytest
+
+from services.circuit_breaker import CircuitBreakerConfig, FeatureCircuitBreaker
+from services.grant_feed import BOOT_ID
+from services.grant_table import (
+    _HEARTBEAT,
+    _HEARTBEAT_OFFSET,
+    AccessAttemptCollector,
+    AccessAttemptLog,
+    FollowingGrantTable,
+    GrantTableDegraded,
+    GrantTableError,
+    GrantTableFull,
+    GrantTableNotFound,
+    GrantTableReader,
+    GrantTableStale,
+    SharedGrantTable,
+    _now_ms,
+)
+from services.notifications import NotificationsService
+from services.user_feature import UserFeatureService
+
+FEATURE_NAMES = ["purchase", "message"]
+
+
+@pytest.fixture
+def registry(make_feature_registry):
+    return make_feature_registry(*FEATURE_NAMES)
+
+
+@pytest.fixture
+def table():
+    table = SharedGrantTable.create(
+        FEATURE_NAMES, name=f"test_grants_{uuid.uuid4().hex[:8]}", capacity=64
+    )
+    yield table
+    table.close()
+
+
+def _read_in_child(name, user_id, results):
+    table = SharedGrantTable.attach(FEATURE_NAMES, name)
+    results.put(table.get(user_id))
+    table.close()
+
+
+def test_unknown_users_have_every_feature(table):
+    assert table.get("user_1") == (0b11, 0)
+    assert table.has_grant("user_1", "purchase") == (True, 0)
+
+
+def test_published_grants_are_visible_to_attached_tables(table, registry):
+    purchase, message = registry.features
+    table.set_grants("user_1", {purchase: False, message: True}, version=3)
+
+    reader = SharedGrantTable.attach(FEATURE_NAMES, table._shm.name)
+    assert reader.has_grant("user_1", "purchase") == (False, 3)
+    assert reader.has_grant("user_1", "message") == (True, 3)
+    assert reader.stats()["users"] == 1
+    reader.close()
+
+
+def test_reader_in_another_process(table, registry):
+    table.set_grants("user_1", {registry.features[1]: False}, version=1)
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    child = context.Process(
+        target=_read_in_child, args=(table._shm.name, "user_1", results)
+    )
+    child.start()
+    bits, version = results.get(timeout=30)
+    child.join(timeout=30)
+
+    assert (bits, version) == (0b01, 1)
+    # the child must not have unlinked the writer's segment
+    assert SharedGrantTable.attach(FEATURE_NAMES, table._shm.name).users == 1
+
+
+def test_attach_checks_features(table):
+    with pytest.raises(GrantTableError):
+        SharedGrantTable.attach(["purchase"], table._shm.name)
+    with pytest.raises(GrantTableNotFound):
+        SharedGrantTable.attach(FEATURE_NAMES, "test_grants_missing")
+
+
+def test_new_users_are_refused_past_the_load_factor(table, registry):
+    purchase = registry.features[0]
+    for i in range(table.max_users):
+        table.set_grants(f"user_{i}", {purchase: False}, version=1)
+    with pytest.raises(GrantTableFull):
+        table.set_grants("one_more", {purchase: False}, version=1)
+    assert table.users == table.max_users
+    assert table.get("one_more") == (0b11, 0)
+    # users already in the table are still updated
+    table.set_grants("user_0", {purchase: True}, version=2)
+    assert table.get("user_0") == (0b11, 2)
+
+
+@pytest.mark.asyncio
+async def test_transitions_complete_when_the_table_is_full(table, registry):
+    purchase = registry.features[0]
+    service = UserFeatureService(
+        registry,
+        NotificationsService(),
+        logger=logging.getLogger(__name__),
+        grant_table=table,
+    )
+    reader = SharedGrantTable.attach(FEATURE_NAMES, table._shm.name)
+    for i in range(table.max_users + 1):
+        await service.revoke(f"user_{i}", purchase)
+
+    assert service.grant_table_errors == 1
+    assert not await service.has_grant(f"user_{table.max_users}", purchase)
+    assert service.change_feed.last_seq == table.max_users + 1
+    # readers would still grant the last user, they stop serving instead
+    assert reader.stats()["degraded"]
+    with pytest.raises(GrantTableDegraded):
+        reader.has_grant(f"user_{table.max_users}", "purchase")
+    reader.close()
+
+
+def test_readers_follow_a_restarted_writer(table, registry):
+    purchase = registry.features[0]
+    name = table._shm.name
+    reader = FollowingGrantTable(
+        SharedGrantTable.attach(FEATURE_NAMES, name),
+        max_staleness=5,
+        heartbeat_interval=1,
+    )
+    assert reader.has_grant("user_1", "purchase") == (True, 0)
+
+    # the old writer is gone and a new one took over the name
+    _HEARTBEAT.pack_into(table._buf, _HEARTBEAT_OFFSET, 0)
+    restarted = SharedGrantTable.create(FEATURE_NAMES, name, capacity=64)
+    try:
+        restarted.set_grants("user_1", {purchase: False}, version=1)
+        assert reader.has_grant("user_1", "purchase") == (False, 1)
+        assert reader.stats()["reattaches"] == 1
+        assert reader.stats()["generation"] == restarted.generation
+
+        # and stopped stamping the table as well
+        _HEARTBEAT.pack_into(restarted._buf, _HEARTBEAT_OFFSET, 0)
+        with pytest.raises(GrantTableStale):
+            reader.has_grant("user_1", "purchase")
+        restarted.heartbeat()
+        assert reader.has_grant("user_1", "purchase") == (False, 1)
+    finally:
+        reader.close()
+        restarted.close()
+
+
+def test_stale_table_is_looked_up_once_per_interval(table, monkeypatch):
+    reader = FollowingGrantTable(
+        SharedGrantTable.attach(FEATURE_NAMES, table._shm.name),
+        max_staleness=5,
+        heartbeat_interval=1,
+    )
+    attach = SharedGrantTable.attach
+    lookups = []
+
+    def counting_attach(*args):
+        lookups.append(args)
+        return attach(*args)
+
+    monkeypatch.setattr(SharedGrantTable, "attach", counting_attach)
+    # late, but not stale yet
+    _HEARTBEAT.pack_into(table._buf, _HEARTBEAT_OFFSET, _now_ms() - 3000)
+    try:
+        for _ in range(100):
+            assert reader.has_grant("user_1", "purchase") == (True, 0)
+        assert len(lookups) == 1
+    finally:
+        reader.close()
+
+
+@pytest.mark.asyncio
+async def test_readers_share_the_writers_circuits(table, registry):
+    purchase = registry.features[0]
+    service = UserFeatureService(
+        registry,
+        NotificationsService(),
+        logger=logging.getLogger(__name__),
+        circuit_configs={"default": CircuitBreakerConfig(threshold=0.5)},
+        grant_table=table,
+    )
+    collector = AccessAttemptCollector(table, service.circuit_breakers())
+    readers = [
+        GrantTableReader(
+            SharedGrantTable.attach(FEATURE_NAMES, table._shm.name),
+            registry,
+            logging.getLogger(__name__),
+            attempt_log=AccessAttemptLog.create(FEATURE_NAMES, table._shm.name),
+        )
+        for _ in range(2)
+    ]
+    try:
+        await service.revoke("user_1", purchase)
+        await service.revoke("user_2", purchase)
+        first, second = readers
+        assert not await first.has_grant("user_1", purchase)
+        _, etag = await second.has_grant_with_etag("user_2", purchase)
+
+        # the denial the first reader served opens the circuit for both
+        collector.collect()
+        assert collector.stats() == {"readers": 2, "attempts": 2}
+        assert await first.has_grant("user_1", purchase)
+        assert await second.has_grant("user_2", purchase)
+        assert second.circuit_breaker_stats()["purchase"]["open_segments"] == 1
+        _, new_etag = await second.has_grant_with_etag("user_2", purchase)
+        assert new_etag != etag
+        assert new_etag == (await first.has_grant_with_etag("user_2", purchase))[1]
+    finally:
+        for reader in readers:
+            reader.table.close()
+            reader.attempt_log.close()
+
+
+def test_attempts_are_dropped_while_the_log_is_full(table):
+    log = AccessAttemptLog.create(FEATURE_NAMES, table._shm.name, capacity=2)
+    collected = AccessAttemptLog.attach(FEATURE_NAMES, table._shm.name, 0)
+    try:
+        for user_id in ["user_1", "user_2", "user_3"]:
+            log.log(user_id, "message", False)
+        assert log.stats()["dropped"] == 1
+        assert collected.drain() == [
+            ("user_1", "message", False),
+            ("user_2", "message", False),
+        ]
+        log.log("user_3", "purchase", True)
+        assert collected.drain() == [("user_3", "purchase", True)]
+    finally:
+        collected.close()
+        log.close()
+
+
+def test_long_user_ids_are_keyed_by_digest(table, registry):
+    purchase = registry.features[0]
+    long_id = "u" * 100
+    table.set_grants(long_id, {purchase: False}, version=1)
+    table.set_grants(long_id + "2", {purchase: True}, version=4)
+
+    reader = SharedGrantTable.attach(FEATURE_NAMES, table._shm.name)
+    assert reader.has_grant(long_id, "purchase") == (False, 1)
+    assert reader.has_grant(long_id + "2", "purchase") == (True, 4)
+    assert reader.has_grant("u" * 75, "purchase") == (True, 0)
+    assert reader.users == 2
+    reader.close()
+
+
+@pytest.mark.asyncio
+async def test_service_transitions_reach_readers(table, registry):
+    purchase, message = registry.features
+    service = UserFeatureService(
+        registry,
+        NotificationsService(),
+        logger=logging.getLogger(__name__),
+        grant_table=table,
+    )
+    reader = GrantTableReader(
+        SharedGrantTable.attach(FEATURE_NAMES, table._shm.name),
+        registry,
+        logging.getLogger(__name__),
+        # keep the circuit closed so answers are the plain grants
+        circuit_configs={"default": CircuitBreakerConfig(min_users=100)},
+    )
+
+    await service.revoke("user_1", purchase)
+    assert not await reader.has_grant("user_1", purchase)
+    assert await reader.has_grant("user_1", message)
+    assert await reader.has_grants(["user_1", "user_2"], [purchase]) == {
+        "user_1": {"purchase": False},
+        "user_2": {"purchase": True},
+    }
+
+    await service.grant("user_1", purchase)
+    has_grant, etag = await reader.has_grant_with_etag("user_1", purchase)
+    assert has_grant
+    # the writer's table and this worker's process are both part of it, the
+    # version and circuit epoch restart with either
+    assert etag == f'"{table.generation:016x}.{BOOT_ID}-2-0"'
+
+
+@pytest.mark.asyncio
+async def test_reader_etags_count_circuits_the_answer_saw(table, registry):
+    purchase = registry.features[0]
+    table.set_grants("user_1", {purchase: False}, version=1)
+    reader = GrantTableReader(
+        SharedGrantTable.attach(FEATURE_NAMES, table._shm.name),
+        registry,
+        logging.getLogger(__name__),
+        circuit_configs={"default": CircuitBreakerConfig(threshold=0)},
+    )
+
+    # the denied attempt opens this worker's circuit, only the next answer
+    # sees it
+    denied, denied_etag = await reader.has_grant_with_etag("user_1", purchase)
+    allowed, allowed_etag = await reader.has_grant_with_etag("user_1", purchase)
+
+    assert (denied, allowed) == (False, True)
+    assert denied_etag.endswith('-1-0"')
+    assert allowed_etag.endswith('-1-1"')
+    reader.table.close()
+
+
+def test_circuit_state_reads_the_epoch_with_the_open_bits(table, registry):
+    breaker = FeatureCircuitBreaker(
+        "purchase", CircuitBreakerConfig(threshold=0, segments=2)
+    )
+    breaker.record("user_1", False, now=0)
+    table.publish_circuits([breaker])
+
+    assert table.circuit_state("user_1", "purchase") == (True, 1)
+    assert table.circuit_state("user_1", "message") == (False, 1)
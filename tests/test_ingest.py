@@ -0,0 +1,150 @@
+import asyncio
+import datetime
+import logging
+import uuid
+
+import msgpack
+import pytest
+
+from app_builder import initialize_schema_registry
+from services.dedupe import EventDeduplicator
+from services.event_dispatcher import KeyedEventDispatcher
+from services.event_processer import EventConsumer
+from services.event_registry import EventTypeNotRegistered
+from services.ingest import (
+    FRAME_HEADER,
+    EventIngestor,
+    IngestServer,
+    InvalidEvent,
+    pack_frame,
+)
+from services.sockets import open_connection
+
+logger = logging.getLogger(__name__)
+
+
+def build_ingestor():
+    return EventIngestor(
+        initialize_schema_registry(), EventDeduplicator(), KeyedEventDispatcher()
+    )
+
+
+def purchase_frame(user_id="user_1", amount=10.0, event_id=None):
+    return {
+        "uuid": (event_id or uuid.uuid4()).bytes,
+        "name": "purchase",
+        "timestamp": datetime.datetime(2024, 1, 1).timestamp(),
+        "event_properties": {"user_id": user_id, "amount": amount},
+    }
+
+
+async def read_ack(reader):
+    header = await reader.readexactly(FRAME_HEADER.size)
+    (length,) = FRAME_HEADER.unpack(header)
+    return msgpack.unpackb(await reader.readexactly(length))
+
+
+@pytest.mark.asyncio
+async def test_frames_are_validated_like_http_events():
+    ingestor = build_ingestor()
+    event_id = uuid.uuid4()
+
+    assert not await ingestor.ingest_frame(purchase_frame(event_id=event_id))
+    assert await ingestor.ingest_frame(purchase_frame(event_id=event_id))
+    assert ingestor.queue.qsize() == 1
+
+    frame = purchase_frame()
+    frame["timestamp"] = "2024-01-01T00:00:00"
+    frame["uuid"] = str(uuid.uuid4())
+    assert not await ingestor.ingest_frame(frame)
+
+    with pytest.raises(EventTypeNotRegistered):
+        await ingestor.ingest_frame(dict(purchase_frame(), name="unknown"))
+    with pytest.raises(InvalidEvent):
+        await ingestor.ingest_frame(purchase_frame(amount="lots"))
+    with pytest.raises(InvalidEvent):
+        await ingestor.ingest_frame({"name": "purchase"})
+    for field, value in [("uuid", 123), ("timestamp", [1]), ("name", 7)]:
+        with pytest.raises(InvalidEvent):
+            await ingestor.ingest_frame(dict(purchase_frame(), **{field: value}))
+
+
+class FlakyProcessor:
+    """Fails the first event it sees, like an aggregate rejecting a value."""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def process_event(self, event):
+        self.calls += 1
+        return self.calls > 1
+
+
+@pytest.mark.asyncio
+async def test_failed_events_are_accepted_again_on_retry():
+    ingestor = build_ingestor()
+    consumer = EventConsumer(
+        ingestor.queue, FlakyProcessor(), logger, deduplicator=ingestor.deduplicator
+    )
+    frame = purchase_frame()
+
+    assert not await ingestor.ingest_frame(frame)
+    # a retry while the first copy is queued is still a duplicate
+    assert await ingestor.ingest_frame(frame)
+    await consumer.handle(*await ingestor.queue.get())
+
+    # processing failed, the retry is applied
+    assert not await ingestor.ingest_frame(frame)
+    await consumer.handle(*await ingestor.queue.get())
+    assert await ingestor.ingest_frame(frame)
+    assert ingestor.deduplicator.stats()["reserved_ids"] == 0
+
+
+@pytest.mark.asyncio
+async def test_server_acknowledges_batches(tmp_path):
+    ingestor = build_ingestor()
+    server = IngestServer(ingestor, str(tmp_path / "ingest.sock"), logger)
+    await server.start()
+    reader, writer = await open_connection(server.address)
+
+    frames = [pack_frame(purchase_frame(f"user_{i}")) for i in range(50)]
+    frames.insert(10, pack_frame(purchase_frame(amount="lots")))
+    frames.insert(20, FRAME_HEADER.pack(3) + b"\xc1\xc1\xc1")
+    frames.insert(30, pack_frame(dict(purchase_frame(), uuid=123)))
+    writer.write(b"".join(frames))
+    await writer.drain()
+
+    errors = []
+    through = 0
+    while through < len(frames):
+        ack = await read_ack(reader)
+        through = ack["through"]
+        errors.extend(index for index, _ in ack["errors"])
+
+    assert errors == [10, 20, 30]
+    assert ingestor.queue.qsize() == 50
+    assert server.stats()["accepted"] == 50
+    assert server.stats()["rejected"] == 3
+
+    writer.close()
+    await server.close()
+
+
+@pytest.mark.asyncio
+async def test_oversized_frames_close_the_connection(tmp_path):
+    server = IngestServer(
+        build_ingestor(),
+        str(tmp_path / "ingest.sock"),
+        logger,
+        max_frame_bytes=100,
+    )
+    await server.start()
+    reader, writer = await open_connection(server.address)
+    writer.write(FRAME_HEADER.pack(1000) + b"x" * 1000)
+    await writer.drain()
+
+    assert "error" in await read_ack(reader)
+    assert await asyncio.wait_for(reader.read(), 5) == b""
+
+    writer.close()
+    await server.close()
@@ -0,0 +1,73 @@
+import logging
+import sys
+
+import pytest
+
+from models.event import CompactEvent
+from models.memory import estimate_size
+from services.memory_diagnostics import MemoryDiagnostics, TracingNotStartedError
+from services.notifications import NotificationsService
+from services.user_feature import UserFeatureService
+
+
+def test_estimate_size_follows_containers_and_slots():
+    values = [f"value-{i}" for i in range(10)]
+    assert estimate_size(values) == sys.getsizeof(values) + sum(
+        sys.getsizeof(value) for value in values
+    )
+
+    event = CompactEvent(1, "purchase", 0.0, "user_1", {"amount": 10})
+    assert estimate_size(event) > sys.getsizeof(event) + sys.getsizeof({})
+
+
+def test_estimate_size_extrapolates_large_containers():
+    data = {f"user_{i}": i * 1000 for i in range(10_000)}
+    exact = estimate_size(data, sample_size=len(data) * 2)
+    estimate = estimate_size(data, sample_size=100)
+    assert abs(estimate - exact) / exact < 0.05
+
+
+def test_estimate_size_does_not_walk_into_plain_objects():
+    class Heavy:
+        def __init__(self):
+            self.payload = list(range(100_000))
+
+    heavy = Heavy()
+    assert estimate_size({"user_1": heavy}) < estimate_size(heavy.payload)
+
+
+@pytest.mark.asyncio
+async def test_unknown_user_grant_materialization_shows_up(feature_registry):
+    service = UserFeatureService(
+        feature_registry, NotificationsService(), logger=logging.getLogger(__name__)
+    )
+    feature = feature_registry.test_feature
+
+    await service.revoke("user_1", feature)
+    before = service.memory_usage()["grants"]
+    for i in range(100):
+        await service.has_grant(f"unknown_{i}", feature)
+    after = service.memory_usage()["grants"]
+
+    assert before["untouched_users"] == 0
+    assert after["untouched_users"] == 100
+    assert after["bytes"] > before["bytes"]
+
+
+def test_snapshot_diff_reports_growth_since_last_diff():
+    diagnostics = MemoryDiagnostics()
+    diagnostics.register("numbers", lambda: {"entries": 3})
+    assert diagnostics.report()["structures"] == {"numbers": {"entries": 3}}
+
+    with pytest.raises(TracingNotStartedError):
+        diagnostics.snapshot_diff()
+
+    diagnostics.start_tracing()
+    try:
+        retained = [bytearray(1000) for _ in range(100)]
+        diff = diagnostics.snapshot_diff(limit=5)
+        assert diff["top"][0]["size_diff"] >= 100 * 1000
+        assert __file__ in diff["top"][0]["location"]
+    finally:
+        diagnostics.stop_tracing()
+    del retained
@@ -0,0 +1,145 @@
+import asyncio
+import datetime
+import uuid
+
+import pytest
+
+from models.event import Event
+from notification_sink.stub_subscriber import StubSubscriberServer
+from services.notification_transport import NotificationDeliveryEngine
+from services.notifications import NotificationsService
+
+
+@pytest.mark.asyncio
+async def test_delivery_engine_batches_over_one_connection():
+    server = StubSubscriberServer()
+    await server.start()
+    engine = NotificationDeliveryEngine(batch_size=10, max_connections_per_subscriber=1)
+    try:
+        for i in range(25):
+            engine.enqueue(server.url, {"user_id": f"user_{i}"})
+        await asyncio.wait_for(engine.flush(), timeout=5)
+    finally:
+        await engine.close()
+        await server.close()
+
+    assert server.notifications == 25
+    assert server.requests == 3
+    assert server.connections == 1
+    assert engine.stats()["delivered"] == 25
+
+
+@pytest.mark.asyncio
+async def test_delivery_engine_retries_failed_requests():
+    server = StubSubscriberServer(fail_every=2)
+    await server.start()
+    engine = NotificationDeliveryEngine(
+        batch_size=1, max_connections_per_subscriber=1, backoff_base=0.001
+    )
+    try:
+        for i in range(4):
+            engine.enqueue(server.url, {"user_id": f"user_{i}"})
+        await asyncio.wait_for(engine.flush(), timeout=5)
+    finally:
+        await engine.close()
+        await server.close()
+
+    stats = engine.stats()
+    assert server.notifications == 4
+    assert stats["delivered"] == 4
+    assert stats["retries"] > 0
+    assert stats.get("failed", 0) == 0
+
+
+@pytest.mark.asyncio
+async def test_delivery_engine_keeps_order_per_key_across_retries():
+    server = StubSubscriberServer(fail_every=3, keep_notifications=True)
+    await server.start()
+    engine = NotificationDeliveryEngine(
+        batch_size=2, max_connections_per_subscriber=4, backoff_base=0.001
+    )
+    try:
+        for i in range(40):
+            user_id = f"user_{i % 3}"
+            engine.enqueue(server.url, {"user_id": user_id, "seq": i}, key=user_id)
+        await asyncio.wait_for(engine.flush(), timeout=5)
+    finally:
+        await engine.close()
+        await server.close()
+
+    assert engine.stats()["retries"] > 0
+    for user in range(3):
+        seqs = [n["seq"] for n in server.received if n["user_id"] == f"user_{user}"]
+        assert seqs == list(range(user, 40, 3))
+
+
+@pytest.mark.asyncio
+async def test_delivery_engine_gives_up_after_max_retries():
+    engine = NotificationDeliveryEngine(max_retries=1, backoff_base=0.001)
+    # nothing listens on port 9 on localhost
+    engine.enqueue("http://127.0.0.1:9/event", {"user_id": "user_1"})
+    await asyncio.wait_for(engine.flush(), timeout=5)
+    await engine.close()
+
+    assert engine.stats()["failed"] == 1
+    assert engine.stats()["retries"] == 1
+
+
+@pytest.mark.asyncio
+async def test_malformed_responses_count_as_failed():
+    async def reply_garbage(reader, writer):
+        await reader.read(1024)
+        writer.write(b"garbage\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(reply_garbage, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    engine = NotificationDeliveryEngine(max_retries=1, backoff_base=0.001)
+    try:
+        engine.enqueue(f"http://127.0.0.1:{port}/event", {"user_id": "user_1"})
+        await asyncio.wait_for(engine.flush(), timeout=5)
+        engine.enqueue(f"http://127.0.0.1:{port}/event", {"user_id": "user_2"})
+        await asyncio.wait_for(engine.flush(), timeout=5)
+    finally:
+        await engine.close()
+        server.close()
+        await server.wait_closed()
+
+    assert engine.stats()["failed"] == 2
+    assert engine.stats()["retries"] == 2
+
+
+@pytest.mark.asyncio
+async def test_notifications_service_hands_events_to_delivery_engine():
+    engine = NotificationDeliveryEngine()
+    service = NotificationsService(
+        event_subscribers={"access_revoked": ["http://127.0.0.1:9/event"]},
+        delivery_engine=engine,
+    )
+    service.send_notification(
+        Event(
+            uuid=uuid.uuid4(),
+            name="access_revoked",
+            timestamp=datetime.datetime.now(),
+            event_properties={"user_id": "user_1"},
+        )
+    )
+
+    assert engine.stats()["pending"] == 1
+
+
+def test_delivery_engine_sheds_from_another_lane_when_full():
+    engine = NotificationDeliveryEngine(max_connections_per_subscriber=2, max_pending=3)
+    for i in range(3):
+        engine.enqueue("http://subscriber", {"seq": i}, key="a")
+    lane_a = hash("a") % 2
+    other = next(f"b{i}" for i in range(10) if hash(f"b{i}") % 2 != lane_a)
+
+    engine.enqueue("http://subscriber", {"seq": 3}, key=other)
+
+    stats = engine.stats()
+    assert stats["pending"] == 3
+    assert stats["dropped"] == 1
+    # the oldest notification of the full lane made room
+    assert [n["seq"] for n in engine._pending[("http://subscriber", lane_a)]] == [1, 2]
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+from contextlib import asynccontextmanager
+
+import pytest
+
+from services.grant_feed import DEFAULT_FEED_SIZE, GrantChangeFeed
+from services.grant_feed import BOOT_ID
+from services.notifications import NotificationsService
+from services.replication import (
+    ReplicaGrantTable,
+    ReplicationClient,
+    ReplicationLagError,
+    ReplicationServer,
+)
+from services.sockets import parse_address, start_server
+from services.user_feature import UserFeatureService
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def registry(make_feature_registry):
+    return make_feature_registry("purchase", "message")
+
+
+async def wait_for(condition, timeout=5):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+def start_replica(table, address):
+    return ReplicationClient(table, address, logger).run()
+
+
+def _replicate_in_child(address, results):
+    async def run():
+        table = ReplicaGrantTable()
+        client = asyncio.create_task(start_replica(table, address))
+        await table.wait_synced()
+        results.put(
+            (
+                table.has_grant("user_1", "purchase"),
+                table.has_grant("user_2", "message"),
+            )
+        )
+        client.cancel()
+
+    asyncio.run(run())
+
+
+@asynccontextmanager
+async def running_primary(tmp_path, registry, feed_size=DEFAULT_FEED_SIZE):
+    service = UserFeatureService(
+        registry,
+        NotificationsService(),
+        logger=logger,
+        change_feed=GrantChangeFeed(max_entries=feed_size),
+    )
+    server = ReplicationServer(
+        service, str(tmp_path / "replication.sock"), logger, heartbeat_interval=0.05
+    )
+    await server.start()
+    yield service, server
+    await server.close()
+
+
+def test_parse_address():
+    assert parse_address("localhost:9100") == ("tcp", ("localhost", 9100))
+    assert parse_address("/tmp/replica.sock") == ("unix", "/tmp/replica.sock")
+
+
+@pytest.mark.asyncio
+async def test_replica_gets_snapshot_then_changes(tmp_path, registry):
+    async with running_primary(tmp_path, registry) as (service, server):
+        purchase, message = registry.features
+        await service.revoke("user_1", purchase)
+
+        table = ReplicaGrantTable()
+        client = asyncio.create_task(start_replica(table, server.address))
+        await table.wait_synced()
+        assert table.source_id == BOOT_ID
+        assert table.has_grant("user_1", "purchase") == (False, 1)
+        assert table.has_grant("user_1", "message") == (True, 1)
+        assert table.has_grant("user_2", "purchase") == (True, 0)
+
+        await service.revoke("user_2", message)
+        await service.grant("user_1", purchase)
+        await wait_for(lambda: table.applied_seq == 3)
+        assert table.has_grant("user_1", "purchase") == (True, 2)
+        assert table.has_grant("user_2", "message") == (False, 1)
+        assert table.stats()["lag_entries"] == 0
+        assert server.stats()["changes_sent"] == 2
+
+        client.cancel()
+        await asyncio.gather(client, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_replica_without_a_snapshot_fails_access_checks():
+    table = ReplicaGrantTable()
+    assert not await table.wait_synced(timeout=0.01)
+    with pytest.raises(ReplicationLagError):
+        table.has_grant("user_1", "purchase")
+
+
+@pytest.mark.asyncio
+async def test_replica_falling_behind_the_feed_gets_a_new_snapshot(tmp_path, registry):
+    async with running_primary(tmp_path, registry, feed_size=2) as (service, server):
+        purchase = registry.features[0]
+        table = ReplicaGrantTable()
+        client = asyncio.create_task(start_replica(table, server.address))
+        await table.wait_synced()
+
+        # more transitions than the feed keeps before the stream gets to run
+        for i in range(5):
+            await service.revoke(f"user_{i}", purchase)
+
+        await wait_for(lambda: table.snapshots_applied == 2)
+        assert table.users == 5
+        assert table.has_grant("user_0", "purchase") == (False, 1)
+
+        client.cancel()
+        await asyncio.gather(client, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_replica_in_another_process(tmp_path, registry):
+    async with running_primary(tmp_path, registry) as (service, server):
+        purchase, message = registry.features
+        await service.revoke("user_1", purchase)
+        await service.revoke("user_2", message)
+
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        child = context.Process(
+            target=_replicate_in_child, args=(server.address, results)
+        )
+        child.start()
+        answers = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: results.get(timeout=30)
+        )
+        child.join(timeout=30)
+
+        assert answers == ((False, 1), (False, 1))
+
+
+@pytest.mark.asyncio
+async def test_replica_reconnects_after_a_malformed_message(tmp_path):
+    address = str(tmp_path / "replication.sock")
+    connections = []
+
+    async def serve(reader, writer):
+        connections.append(writer)
+        if len(connections) == 1:
+            messages = [{"type": "change", "primary_seq": 1}]
+        else:
+            messages = [
+                {"type": "snapshot_start", "primary_seq": 0},
+                {"type": "snapshot_end", "seq": 0, "primary_seq": 0},
+            ]
+        for message in messages:
+            writer.write(json.dumps(message).encode() + b"\n")
+        await writer.drain()
+
+    server = await start_server(address, serve)
+    table = ReplicaGrantTable()
+    client = ReplicationClient(table, address, logger, reconnect_interval=0.01)
+    run = asyncio.create_task(client.run())
+    try:
+        assert await table.wait_synced(timeout=5)
+        assert client.reconnects == 1
+        assert not run.done()
+    finally:
+        run.cancel()
+        for writer in connections:
+            writer.close()
+        server.close()
+        await server.wait_closed()
+
+
+def test_access_checks_fail_once_lag_is_over_the_bound(clock):
+    table = ReplicaGrantTable(max_lag=5, clock=clock)
+    with pytest.raises(ReplicationLagError):
+        table.has_grant("user_1", "purchase")
+
+    table.apply({"type": "snapshot_start", "seq": 0, "primary_seq": 0})
+    table.apply({"type": "snapshot_end", "seq": 0, "primary_seq": 0})
+    assert table.has_grant("user_1", "purchase") == (True, 0)
+
+    # the primary moved on but the replica hasn't seen the change yet
+    clock.now = 3
+    table.apply({"type": "heartbeat", "primary_seq": 1})
+    clock.now = 6
+    assert table.stats()["lag_entries"] == 1
+    with pytest.raises(ReplicationLagError):
+        table.has_grant("user_1", "purchase")
+
+    table.apply(
+        {
+            "type": "change",
+            "seq": 1,
+            "user_id": "user_1",
+            "feature": "purchase",
+            "has_grant": False,
+            "version": 1,
+            "primary_seq": 1,
+        }
+    )
+    assert table.lag_seconds() == 0
+    assert table.has_grant("user_1", "purchase") == (False, 1)
@@ -1,8 +1,17 @@
+import math
 from unittest.mock import Mock
 
 import pytest
 
-from models.rules import Rule, RuleCondition, RuleOperation
+from models.aggregate import AggregateType, EventAggregate
+from models.event import CompactEvent
+from models.rules import (
+    PlatformFeature,
+    Rule,
+    RuleCondition,
+    RuleOperation,
+    RulesStore,
+)
 
 
 @pytest.mark.asyncio
@@ -149,3 +158,208 @@ async def test_rule_abides_denom_min_not_met():
 
     # Since denom_min is not met, the rule should abide regardless of condition
     assert result is True
+
+
+def test_rules_store_caches_verdicts_until_aggregate_changes():
+    aggregate1 = Mock()
+    aggregate1.name = "agg1"
+    aggregate1.get_user_aggregate.return_value = 1
+
+    rule = Rule(
+        name="test_rule_cached",
+        operation=RuleOperation.VALUE,
+        aggregate1=aggregate1,
+        aggregate2=None,
+        value=2,
+        condition=RuleCondition.LESS_THAN,
+    )
+    store = RulesStore()
+    store.add_rule(rule)
+
+    assert store.abides(rule, "user1") is True
+    aggregate1.get_user_aggregate.return_value = 5
+    # served from the cache, the aggregate was not reported as changed
+    assert store.abides(rule, "user1") is True
+    assert aggregate1.get_user_aggregate.call_count == 1
+
+    store.invalidate("user1", "agg1")
+    assert store.abides(rule, "user1") is False
+    assert aggregate1.get_user_aggregate.call_count == 2
+
+
+def test_rules_store_invalidate_only_touches_dependent_rules():
+    aggregate1 = Mock()
+    aggregate1.name = "agg1"
+    aggregate1.get_user_aggregate.return_value = 1
+    aggregate2 = Mock()
+    aggregate2.name = "agg2"
+    aggregate2.get_user_aggregate.return_value = 1
+
+    rule1 = Rule(
+        name="rule1",
+        operation=RuleOperation.VALUE,
+        aggregate1=aggregate1,
+        aggregate2=None,
+        value=2,
+        condition=RuleCondition.LESS_THAN,
+    )
+    rule2 = Rule(
+        name="rule2",
+        operation=RuleOperation.VALUE,
+        aggregate1=aggregate2,
+        aggregate2=None,
+        value=2,
+        condition=RuleCondition.LESS_THAN,
+    )
+    store = RulesStore()
+    store.add_rule(rule1)
+    store.add_rule(rule2)
+    store.abides(rule1, "user1")
+    store.abides(rule2, "user1")
+
+    store.invalidate("user1", "agg2")
+
+    assert ("user1", "rule1") in store._verdicts
+    assert ("user1", "rule2") not in store._verdicts
+
+
+@pytest.mark.asyncio
+async def test_rule_evaluate_divide_by_zero():
+    aggregate1 = Mock()
+    aggregate2 = Mock()
+
+    aggregate1.get_user_aggregate.return_value = 10
+    aggregate2.get_user_aggregate.return_value = 0
+
+    rule = Rule(
+        name="test_rule_zero",
+        operation=RuleOperation.DIVIDE,
+        aggregate1=aggregate1,
+        aggregate2=aggregate2,
+        value=4,
+        condition=RuleCondition.LESS_THAN,
+    )
+
+    result = rule._evaluate(user_id="user1")
+    assert result[0] == 0
+
+
+def count_rule(condition, value):
+    aggregate = EventAggregate("flags", "scam_flag", AggregateType.COUNT)
+    rule = Rule(
+        name="flag_rule",
+        operation=RuleOperation.VALUE,
+        aggregate1=aggregate,
+        aggregate2=None,
+        value=value,
+        condition=condition,
+    )
+    return aggregate, rule
+
+
+def flag(aggregate, user_id="user1"):
+    aggregate.update(user_id, CompactEvent(0, "scam_flag", 0.0, user_id))
+
+
+def test_rule_headroom_from_aggregate_type_and_condition():
+    aggregate, less_than = count_rule(RuleCondition.LESS_THAN, 3)
+    assert less_than.monotonic
+    # 0 flags: one more flag still abides, the second one may not
+    assert less_than.abides_with_headroom("user1") == (True, 2)
+    for _ in range(3):
+        flag(aggregate)
+    assert less_than.abides_with_headroom("user1") == (False, math.inf)
+
+    aggregate, greater_than = count_rule(RuleCondition.GREATER_THAN, 2.5)
+    assert greater_than.abides_with_headroom("user1") == (False, 2)
+    for _ in range(3):
+        flag(aggregate)
+    assert greater_than.abides_with_headroom("user1") == (True, math.inf)
+
+    sums = EventAggregate("amounts", "purchase", AggregateType.SUM, field="amount")
+    divide = Rule(
+        name="ratio",
+        operation=RuleOperation.DIVIDE,
+        aggregate1=aggregate,
+        aggregate2=sums,
+        value=0.1,
+        condition=RuleCondition.LESS_THAN,
+    )
+    assert not divide.monotonic
+    assert divide.abides_with_headroom("user1")[1] == 0
+
+
+def test_rules_store_skips_decided_and_far_from_threshold_rules():
+    aggregate, rule = count_rule(RuleCondition.LESS_THAN, 3)
+    store = RulesStore()
+    store.add_rule(rule)
+
+    verdicts = []
+    for _ in range(6):
+        verdicts.append(store.abides(rule, "user1"))
+        flag(aggregate)
+        store.invalidate("user1", "flags")
+
+    assert verdicts == [True, True, True, False, False, False]
+    # evaluated with 0 flags (headroom 2), 3 flags (final) and nothing else
+    assert store.pruning_stats()["evaluations"] == 2
+    assert store.skipped_headroom == 2
+    assert store.skipped_final == 3
+    assert store.abides(rule, "user1") is False
+
+
+def test_feature_rules_are_ordered_by_cost_and_failure_rate():
+    def value_rule(name, value):
+        aggregate = Mock()
+        aggregate.name = f"{name}_agg"
+        aggregate.get_user_aggregate.return_value = value
+        return Rule(
+            name=name,
+            operation=RuleOperation.VALUE,
+            aggregate1=aggregate,
+            aggregate2=None,
+            value=2,
+            condition=RuleCondition.LESS_THAN,
+        )
+
+    # rarely_fails is listed first but never fails for these users
+    rarely_fails = value_rule("rarely_fails", 0)
+    often_fails = value_rule("often_fails", 5)
+    feature = PlatformFeature(name="purchase", rules=[rarely_fails, often_fails])
+    store = RulesStore(reorder_interval=10)
+    store.add_rule(rarely_fails)
+    store.add_rule(often_fails)
+
+    assert store.ordered_rules(feature) == [rarely_fails, often_fails]
+    verdicts = []
+    for i in range(50):
+        # both rules are looked up like the rules an event triggers
+        store.abides(rarely_fails, f"user_{i}")
+        store.abides(often_fails, f"user_{i}")
+        verdicts.append(store.walk_feature(feature, f"user_{i}"))
+
+    assert verdicts == [False] * 50
+    assert store.ordered_rules(feature)[0] is often_fails
+    stats = store.ordering_stats()
+    assert stats["features"]["purchase"] == ["often_fails", "rarely_fails"]
+    assert stats["rules"]["often_fails"]["failure_rate"] > 0.9
+    assert stats["rules"]["rarely_fails"]["failure_rate"] < 0.1
+
+
+def test_rule_stats_count_evaluations_and_walks():
+    aggregate, rule = count_rule(RuleCondition.LESS_THAN, 1)
+    feature = PlatformFeature(name="purchase", rules=[rule])
+    store = RulesStore()
+    store.add_rule(rule)
+    flag(aggregate)
+
+    # looked up once for the event and once more in the walk
+    assert store.abides(rule, "user1") is False
+    assert store.walk_feature(feature, "user1") is False
+    # shadow lookups stay out of the live stats
+    assert store.abides(rule, "user2", record_stats=False) is True
+
+    stats = store.ordering_stats()["rules"][rule.name]
+    assert stats["evaluations"] == 1
+    assert stats["walks"] == 1
+    assert stats["failure_rate"] == 1.0
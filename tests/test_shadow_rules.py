@@ -0,0 +1,80 @@
+from unittest.mock import Mock
+
+from models.rules import PlatformFeature, Rule, RuleCondition, RuleOperation, RulesStore
+from services.shadow_rules import ShadowEvaluator, ShadowRule
+
+
+def make_value_rule(name, aggregate, value):
+    return Rule(
+        name=name,
+        operation=RuleOperation.VALUE,
+        aggregate1=aggregate,
+        aggregate2=None,
+        value=value,
+        condition=RuleCondition.LESS_THAN,
+    )
+
+
+def make_evaluator(aggregate_value, live_threshold, shadow_threshold, cpu_budget=1.0):
+    aggregate = Mock()
+    aggregate.name = "total_scam_flags"
+    aggregate.get_user_aggregate.return_value = aggregate_value
+    live = make_value_rule("live", aggregate, live_threshold)
+    candidate = make_value_rule("candidate", aggregate, shadow_threshold)
+    rule_store = RulesStore()
+    rule_store.add_rule(live)
+    feature = PlatformFeature(name="message", rules=[live])
+    shadow = ShadowRule(candidate, live, [feature])
+    return ShadowEvaluator([shadow], rule_store, cpu_budget=cpu_budget), shadow
+
+
+def test_shadow_rule_counts_would_revoke():
+    evaluator, shadow = make_evaluator(
+        aggregate_value=2, live_threshold=3, shadow_threshold=2
+    )
+    evaluator.evaluate("user_1", ["total_scam_flags"], live_seconds=0.001)
+
+    assert shadow.stats()["would_revoke"] == 1
+    assert shadow.stats()["would_grant"] == 0
+
+
+def test_shadow_rule_counts_would_grant_and_agreements():
+    evaluator, shadow = make_evaluator(
+        aggregate_value=2, live_threshold=2, shadow_threshold=3
+    )
+    evaluator.evaluate("user_1", ["total_scam_flags"], live_seconds=0.001)
+    evaluator.evaluate("user_2", ["unrelated_aggregate"], live_seconds=0.001)
+
+    assert shadow.stats()["would_grant"] == 1
+    assert shadow.evaluations == 1
+
+
+def test_shadow_rule_agrees_with_live_rule():
+    evaluator, shadow = make_evaluator(
+        aggregate_value=1, live_threshold=2, shadow_threshold=3
+    )
+    evaluator.evaluate("user_1", ["total_scam_flags"], live_seconds=0.001)
+
+    assert shadow.agreements == 1
+
+
+def test_shadow_evaluation_is_skipped_over_budget():
+    evaluator, shadow = make_evaluator(
+        aggregate_value=1, live_threshold=2, shadow_threshold=3, cpu_budget=0.0
+    )
+    # drain the initial burst credit
+    evaluator._credit = -1
+    evaluator.evaluate("user_1", ["total_scam_flags"], live_seconds=0.001)
+
+    assert shadow.evaluations == 0
+    assert evaluator.stats()["skipped_evaluations"] == 1
+
+
+def test_shadow_lookups_stay_out_of_live_rule_stats():
+    evaluator, shadow = make_evaluator(
+        aggregate_value=2, live_threshold=3, shadow_threshold=2
+    )
+    evaluator.evaluate("user_1", ["total_scam_flags"], live_seconds=0.001)
+
+    assert shadow.evaluations == 1
+    assert evaluator.rule_store.ordering_stats()["rules"] == {}
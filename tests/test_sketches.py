@@ -0,0 +1,78 @@
+import random
+import statistics
+
+import pytest
+
+from models.sketches import RunningStats, TDigest
+
+
+def lognormal_values(count, seed=0):
+    rng = random.Random(seed)
+    return [rng.lognormvariate(3, 1) for _ in range(count)]
+
+
+def test_running_stats_match_exact_values():
+    values = lognormal_values(1000)
+    stats = RunningStats()
+    for value in values:
+        stats.add(value)
+
+    assert stats.count == 1000
+    assert stats.mean == pytest.approx(statistics.fmean(values))
+    assert stats.variance == pytest.approx(statistics.pvariance(values))
+    assert (stats.min, stats.max) == (min(values), max(values))
+
+
+def test_merged_running_stats_equal_a_single_pass():
+    values = lognormal_values(1000)
+    parts = [RunningStats() for _ in range(3)]
+    for i, value in enumerate(values):
+        parts[i % 3].add(value)
+    merged = RunningStats()
+    for part in parts:
+        merged.merge(part)
+
+    assert merged.mean == pytest.approx(statistics.fmean(values))
+    assert merged.variance == pytest.approx(statistics.pvariance(values))
+    assert merged.count == 1000
+
+
+@pytest.mark.parametrize("q", [0.01, 0.5, 0.95, 0.99])
+def test_tdigest_quantiles_are_close(q):
+    values = lognormal_values(50_000)
+    digest = TDigest()
+    for value in values:
+        digest.add(value)
+
+    exact = sorted(values)[int(q * len(values))]
+    assert digest.quantile(q) == pytest.approx(exact, rel=0.02)
+    # memory stays bounded by the compression, not the number of values
+    assert digest.centroids() <= digest.compression
+
+
+def test_merged_tdigests_agree_with_a_single_digest():
+    values = lognormal_values(20_000)
+    whole = TDigest()
+    shards = [TDigest() for _ in range(4)]
+    for i, value in enumerate(values):
+        whole.add(value)
+        shards[i % 4].add(value)
+    merged = TDigest()
+    for shard in shards:
+        merged.merge(shard)
+
+    assert merged.count == whole.count
+    assert merged.quantile(0.95) == pytest.approx(whole.quantile(0.95), rel=0.02)
+    assert (merged.min, merged.max) == (min(values), max(values))
+
+
+def test_sketches_round_trip_through_json():
+    digest = TDigest()
+    stats = RunningStats()
+    for value in lognormal_values(500):
+        digest.add(value)
+        stats.add(value)
+
+    assert TDigest.from_json(digest.to_json()).quantile(0.9) == digest.quantile(0.9)
+    assert RunningStats.from_json(stats.to_json()).variance == stats.variance
+    assert TDigest.from_json(TDigest().to_json()).quantile(0.5) == 0.0
@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from services.startup import Readiness, StartupProfiler
+
+
+def test_profiler_records_phases_in_order():
+    profiler = StartupProfiler()
+    with profiler.phase("first"):
+        pass
+    profiler.record("second", 0.5)
+    profiler.finish()
+
+    report = profiler.report()
+    assert list(report["phases_ms"]) == ["first", "second"]
+    assert report["phases_ms"]["second"] == 500
+    assert report["startup_ms"] is not None
+
+
+def test_profiler_records_failed_phase():
+    profiler = StartupProfiler()
+    with pytest.raises(ValueError):
+        with profiler.phase("broken"):
+            raise ValueError("bad config")
+
+    assert profiler.phases[0][0] == "broken"
+    assert profiler.report()["startup_ms"] is None
+
+
+@pytest.mark.asyncio
+async def test_readiness_wait_times_out_then_succeeds():
+    readiness = Readiness()
+    assert await readiness.wait(0.01) is False
+
+    asyncio.get_running_loop().call_later(0.01, readiness.set_ready)
+    assert await readiness.wait(1) is True
+    assert readiness.is_ready
+
+
+@pytest.mark.asyncio
+async def test_readiness_does_not_wait_after_failure():
+    readiness = Readiness()
+    readiness.set_failed(ValueError("bad config"))
+    assert await readiness.wait(10) is False
+
+
+@pytest.mark.asyncio
+async def test_readiness_waiters_are_released_on_failure():
+    readiness = Readiness()
+    asyncio.get_running_loop().call_later(
+        0.01, readiness.set_failed, ValueError("bad config")
+    )
+    assert await asyncio.wait_for(readiness.wait(10), timeout=1) is False
+    assert readiness.failed
@@ -0,0 +1,60 @@
+import asyncio
+import logging
+
+import pytest
+
+from models.striping import StripedLocks
+from services.circuit_breaker import CircuitBreakerConfig
+from services.notifications import NotificationsService
+from services.user_feature import UserFeatureService
+
+
+def test_keys_map_to_stable_stripes():
+    locks = StripedLocks(num_stripes=8)
+    assert locks.index_for("user_1") == locks.index_for("user_1")
+    assert {locks.index_for(f"user_{i}") for i in range(100)} == set(range(8))
+
+
+@pytest.mark.asyncio
+async def test_contention_is_counted_per_stripe():
+    locks = StripedLocks(num_stripes=4)
+    stripe = locks.stripe_for("user_1")
+
+    async def hold():
+        async with stripe:
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(hold(), hold())
+
+    stats = locks.stats()
+    assert stats["acquisitions"] == 2
+    assert stats["contended"] == 1
+    assert stats["per_stripe"][locks.index_for("user_1")]["contended"] == 1
+    assert stats["wait_seconds"] > 0
+
+
+@pytest.mark.asyncio
+async def test_users_on_different_stripes_do_not_contend(feature_registry):
+    service = UserFeatureService(
+        feature_registry,
+        NotificationsService(),
+        logger=logging.getLogger(__name__),
+        # keep the circuit closed so answers are the plain grants
+        circuit_configs={"default": CircuitBreakerConfig(min_users=100)},
+        num_stripes=16,
+    )
+    feature = feature_registry.test_feature
+    user_1, user_2 = "user_1", next(
+        f"user_{i}"
+        for i in range(2, 100)
+        if service._locks.index_for(f"user_{i}") != service._locks.index_for("user_1")
+    )
+
+    # hold user_1's stripe, user_2 is still served right away
+    async with service._locks.stripe_for(user_1):
+        await asyncio.wait_for(service.revoke(user_2, feature), timeout=1)
+        assert not await asyncio.wait_for(service.has_grant(user_2, feature), 1)
+
+    assert service.lock_stats()["contended"] == 0
+    results = await service.has_grants([user_1, user_2], [feature])
+    assert results == {user_1: {"test_feature": True}, user_2: {"test_feature": False}}
@@ -3,30 +3,17 @@ import logging
 import pytest
 from freezegun import freeze_time
 
+from config import DEFAULT_CIRCUIT_BREAKER_CONFIG_DICT, get_circuit_breaker_configs
+from services.circuit_breaker import CircuitBreakerConfig, FeatureCircuitBreaker
+from services.grant_feed import BOOT_ID
 from services.notifications import NotificationsService
 from services.user_feature import UserFeatureService
 
 
-class MockPlatformFeature:
-    def __init__(self, name):
-        self.name = name
-
-    def __repr__(self):
-        return f"MockPlatformFeature(name='{self.name}')"
-
-
-class MockPlatformFeaturesRegistry:
-    def __init__(self):
-        self.test_feature = MockPlatformFeature("test_feature")
-        self.features = [self.test_feature]
-
-    def list_features(self):
-        return self.features
-
-
 @pytest.mark.asyncio
-async def test_circuit_breaker_opens_when_denial_rate_exceeds_threshold():
-    feature_registry = MockPlatformFeaturesRegistry()
+async def test_circuit_breaker_opens_when_denial_rate_exceeds_threshold(
+    feature_registry,
+):
     notifications_service = NotificationsService()
     service = UserFeatureService(
         feature_registry, notifications_service, logger=logging.getLogger(__name__)
@@ -47,16 +34,13 @@ async def test_circuit_breaker_opens_when_denial_rate_exceeds_threshold():
             await service.grant(user_id, feature)
             await service.has_grant(user_id, feature)
 
-        # Manually call the evaluate_circuit_breakers method
-        await service._evaluate_circuit_breakers_once()
-
-        # Circuit should be open (broken) because denial rate > 5%
-        assert not service._circuits[feature]
+        # Circuit should be open (broken) because denial rate > 5%, without
+        # any periodic evaluation
+        assert not service._circuits[feature].is_closed("user_0")
 
 
 @pytest.mark.asyncio
-async def test_access_allowed_when_circuit_breaker_is_open():
-    feature_registry = MockPlatformFeaturesRegistry()
+async def test_access_allowed_when_circuit_breaker_is_open(feature_registry):
     notifications_service = NotificationsService()
     service = UserFeatureService(
         feature_registry, notifications_service, logger=logging.getLogger(__name__)
@@ -68,15 +52,16 @@ async def test_access_allowed_when_circuit_breaker_is_open():
     await service.revoke(user_id, feature)
 
     # Manually break the circuit
-    service._circuits[feature] = False
+    service._circuits[feature].segments[0].closed = False
 
     has_access = await service.has_grant(user_id, feature)
     assert has_access
 
 
 @pytest.mark.asyncio
-async def test_access_denied_when_circuit_breaker_is_closed_and_no_grant():
-    feature_registry = MockPlatformFeaturesRegistry()
+async def test_access_denied_when_circuit_breaker_is_closed_and_no_grant(
+    feature_registry,
+):
     notifications_service = NotificationsService()
     service = UserFeatureService(
         feature_registry, notifications_service, logger=logging.getLogger(__name__)
@@ -87,15 +72,16 @@ async def test_access_denied_when_circuit_breaker_is_closed_and_no_grant():
 
     await service.revoke(user_id, feature)
 
-    service._circuits[feature] = True
+    service._circuits[feature].segments[0].closed = True
 
     has_access = await service.has_grant(user_id, feature)
     assert not has_access
 
 
 @pytest.mark.asyncio
-async def test_access_granted_when_circuit_breaker_is_closed_and_user_has_grant():
-    feature_registry = MockPlatformFeaturesRegistry()
+async def test_access_granted_when_circuit_breaker_is_closed_and_user_has_grant(
+    feature_registry,
+):
     notifications_service = NotificationsService()
     service = UserFeatureService(
         feature_registry, notifications_service, logger=logging.getLogger(__name__)
@@ -106,8 +92,166 @@ async def test_access_granted_when_circuit_breaker_is_closed_and_user_has_grant(
 
     await service.grant(user_id, feature)
 
-    service._circuits[feature] = True
+    service._circuits[feature].segments[0].closed = True
 
     # User should have access
     has_access = await service.has_grant(user_id, feature)
     assert has_access
+
+
+@pytest.mark.asyncio
+async def test_has_grants_bulk_matches_has_grant(feature_registry):
+    notifications_service = NotificationsService()
+    service = UserFeatureService(
+        feature_registry, notifications_service, logger=logging.getLogger(__name__)
+    )
+    feature = feature_registry.test_feature
+
+    await service.revoke("user_1", feature)
+    await service.grant("user_2", feature)
+
+    results = await service.has_grants(["user_1", "user_2", "user_3"], [feature])
+
+    assert results == {
+        "user_1": {"test_feature": False},
+        "user_2": {"test_feature": True},
+        "user_3": {"test_feature": True},
+    }
+    # unknown users are answered without creating grant entries for them
+    assert "user_3" not in service._grants_for("user_3")
+    # every answer is fed to the circuit breaker
+    segment = service._circuits[feature].segments[0]
+    assert segment.total_users == 3
+    assert segment.denied_users == 1
+
+
+@pytest.mark.asyncio
+async def test_etag_changes_only_on_grant_transitions(feature_registry):
+    notifications_service = NotificationsService()
+    service = UserFeatureService(
+        feature_registry, notifications_service, logger=logging.getLogger(__name__)
+    )
+    feature = feature_registry.test_feature
+
+    _, etag = await service.has_grant_with_etag("user_1", feature)
+    # granting an already granted user is not a transition
+    await service.grant("user_1", feature)
+    assert (await service.has_grant_with_etag("user_1", feature))[1] == etag
+
+    await service.revoke("user_1", feature)
+    has_access, new_etag = await service.has_grant_with_etag("user_1", feature)
+    assert not has_access
+    assert new_etag != etag
+    # a restarted process counts versions from 0 again
+    assert new_etag.startswith(f'"{BOOT_ID}-1-')
+
+    changes, _ = service.change_feed.since(0)
+    assert len(changes) == 1
+    assert changes[0]["user_id"] == "user_1"
+    assert changes[0]["has_grant"] is False
+
+
+@pytest.mark.asyncio
+async def test_etag_doesnt_count_the_transition_its_own_attempt_caused(
+    feature_registry,
+):
+    service = UserFeatureService(
+        feature_registry,
+        NotificationsService(),
+        logger=logging.getLogger(__name__),
+        circuit_configs={"test_feature": CircuitBreakerConfig(threshold=0)},
+    )
+    feature = feature_registry.test_feature
+    await service.revoke("user_1", feature)
+
+    # the denied attempt opens the circuit, only the next answer sees it
+    denied, denied_etag = await service.has_grant_with_etag("user_1", feature)
+    allowed, allowed_etag = await service.has_grant_with_etag("user_1", feature)
+
+    assert (denied, allowed) == (False, True)
+    assert denied_etag == f'"{BOOT_ID}-1-0"'
+    assert allowed_etag == f'"{BOOT_ID}-1-1"'
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_only_opens_for_the_denied_segment(feature_registry):
+    notifications_service = NotificationsService()
+    config = CircuitBreakerConfig(threshold=0.05, min_users=10, segments=4)
+    service = UserFeatureService(
+        feature_registry,
+        notifications_service,
+        logger=logging.getLogger(__name__),
+        circuit_configs={"test_feature": config},
+    )
+    feature = feature_registry.test_feature
+    breaker = service._circuits[feature]
+    user_ids = [f"user_{i}" for i in range(200)]
+    denied_segment = breaker.segment_for("user_0")
+    denied = [u for u in user_ids if breaker.segment_for(u) is denied_segment]
+
+    _, etag = await service.has_grant_with_etag("user_0", feature)
+    for user_id in denied[:5]:
+        await service.revoke(user_id, feature)
+    for user_id in user_ids:
+        await service.has_grant(user_id, feature)
+
+    assert not denied_segment.closed
+    assert breaker.stats()["open_segments"] == 1
+    # revoked users of the broken segment are let through, other segments
+    # still enforce grants
+    assert await service.has_grant(denied[0], feature)
+    other = next(u for u in user_ids if breaker.segment_for(u) is not denied_segment)
+    await service.revoke(other, feature)
+    assert not await service.has_grant(other, feature)
+    assert (await service.has_grant_with_etag("user_0", feature))[1] != etag
+
+
+def test_circuit_closes_again_when_denials_leave_the_window():
+    clock = [0.0]
+    breaker = FeatureCircuitBreaker(
+        "test_feature",
+        CircuitBreakerConfig(threshold=0.5, window_seconds=10),
+        clock=lambda: clock[0],
+    )
+
+    assert breaker.record("user_1", success=False)
+    assert not breaker.is_closed("user_2")
+
+    clock[0] = 5
+    breaker.record("user_1", success=True)
+    # user_1 was seen again inside the window, still counted as one user
+    assert breaker.segments[0].total_users == 1
+    assert not breaker.is_closed("user_2")
+
+    clock[0] = 11
+    assert breaker.record("user_2", success=True)
+    assert breaker.is_closed("user_1")
+    assert breaker.segments[0].total_users == 2
+    assert breaker.segments[0].denied_users == 0
+
+
+def test_idle_circuit_closes_when_checked():
+    clock = [0.0]
+    breaker = FeatureCircuitBreaker(
+        "test_feature",
+        CircuitBreakerConfig(threshold=0.5, window_seconds=10),
+        clock=lambda: clock[0],
+    )
+
+    assert breaker.record("user_1", success=False)
+    assert not breaker.is_closed("user_1")
+
+    # no attempts at all since, the denial left the window
+    clock[0] = 11
+    assert breaker.is_closed("user_1")
+    assert breaker.segments[0].total_users == 0
+    assert breaker.transitions == 2
+
+
+def test_default_circuit_config_keeps_the_new_knobs_off():
+    configs = get_circuit_breaker_configs(DEFAULT_CIRCUIT_BREAKER_CONFIG_DICT)
+    assert configs == {
+        "default": CircuitBreakerConfig(
+            threshold=0.05, window_seconds=600, min_users=1, segments=1
+        )
+    }
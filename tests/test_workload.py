@@ -0,0 +1,56 @@
+import json
+from collections import Counter
+
+import pytest
+
+from load_testing.workload import (
+    WorkloadConfig,
+    WorkloadGenerator,
+    read_workload,
+    replay,
+    write_workload,
+)
+
+
+def test_same_seed_generates_same_workload(tmp_path):
+    config = WorkloadConfig(users=100, operations=200, history=50, seed=7)
+    path = tmp_path / "workload.jsonl"
+    write_workload(path, config, WorkloadGenerator(config).generate())
+
+    operations = read_workload(path)
+    assert operations == list(WorkloadGenerator(config).generate())
+    assert sum(1 for op in operations if op.get("history")) == 50
+    assert json.loads(path.read_text().splitlines()[0])["config"]["seed"] == 7
+
+
+def test_users_are_skewed_and_events_follow_the_mix():
+    config = WorkloadConfig(
+        users=1000,
+        operations=0,
+        history=5000,
+        event_mix={"purchase": 3, "chargeback": 1},
+    )
+    events = [op["body"] for op in WorkloadGenerator(config).generate()]
+
+    users = Counter(event["event_properties"]["user_id"] for event in events)
+    # the heaviest user alone carries a large share of the traffic
+    assert users.most_common(1)[0] == ("user0", users["user0"])
+    assert users["user0"] > len(events) * 0.05
+    names = Counter(event["name"] for event in events)
+    assert set(names) == {"purchase", "chargeback"}
+    assert 2 < names["purchase"] / names["chargeback"] < 4
+
+
+@pytest.mark.asyncio
+async def test_replay_reports_latency_per_operation():
+    from app import app
+
+    config = WorkloadConfig(users=20, operations=100, history=50)
+    report = await replay(app, list(WorkloadGenerator(config).generate()), 4)
+
+    assert report["operations"] == 100
+    assert report["history_events"] == 50
+    assert set(report["latency"]) == {"event", "access"}
+    assert sum(report["statuses"].values()) == 100
+    assert all(key.endswith("_200") for key in report["statuses"])
+    assert report["latency"]["access"]["p99_ms"] > 0